@@ -0,0 +1,173 @@
+"""
+Microbenchmarks of the helpers that run on every update
+
+Compares allocations per call with baseline.json and exits with status 1
+if any of them grew more than the tolerance. Allocations don't depend on
+the machine or its load, times do even as the best of many repeats, so
+times are only reported: as a ratio to a reference workload measured
+right before each case, which holds on a faster or slower machine. Gate
+on them too with --check-time on a quiet machine. Save a new baseline
+in the change that alters the measured code:
+
+    python benchmarks/run.py --save
+    python benchmarks/run.py
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import timeit
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "glpi_bot"))
+
+import keyboard  # noqa: E402
+import user_state  # noqa: E402
+import utils  # noqa: E402
+
+BASELINE = os.path.join(HERE, "baseline.json")
+
+with open(os.path.join(HERE, "fixtures", "list_tickets.json")) as f:
+    TICKETS = json.load(f)
+
+FILENAMES = [
+    "Скан договора №15 от 01.03.2022.pdf",
+    "Фото ошибки 1С (экран).jpg",
+    "Акт выполненных работ: март/апрель.xlsx",
+]
+STATE = {
+    "session": "9u1nr0j2k4s6v8x0z2b4d6f8h0",
+    "name": "ivanov",
+    "id": 5,
+    "profiles_id": "4",
+    "entity": "12",
+    "credential": "gAAAAABiH" + "x" * 140,
+}
+PACKED = user_state.pack(STATE)
+COUNTERS = {"assigned": 7, "overdue": 2, "total": 40}
+
+
+def tickets_page():
+    markup = keyboard.pagination(len(TICKETS), 5, 5, "cb_tickets_all_current")
+    return keyboard.ticket_buttons(markup, TICKETS[5:10], 5)
+
+
+CASES = {
+    "keyboard.pagination": lambda: keyboard.pagination(40, 5, 5, "cb_tickets_mine"),
+    "keyboard.ticket_buttons": tickets_page,
+    "keyboard.ticket_buttons+json": lambda: json.dumps(tickets_page()),
+    "keyboard.default": lambda: keyboard.default(COUNTERS),
+    "utils.format_date": lambda: utils.format_date(TICKETS[1]["time_to_resolve"]),
+    "utils.translit_replace": lambda: [utils.translit_replace(f) for f in FILENAMES],
+    "user_state.pack": lambda: user_state.pack(STATE),
+    "user_state.unpack": lambda: user_state.unpack(PACKED),
+}
+
+
+def reference():
+    # Plain Python work of the same kind: dicts, strings and formatting
+    rows = [{"id": str(i), "name": "Заявка {}".format(i)} for i in range(50)]
+    return ",".join(sorted("{id}:{name}".format(**row).upper() for row in rows))
+
+
+def measure_time(func, repeat=15):
+    """
+    :return: best time per call in microseconds
+    :rtype: float
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def measure_alloc(func, repeat=5):
+    """
+    :return: peak bytes allocated during a call
+    :rtype: int
+    """
+    func()
+    peaks = []
+    for _ in range(repeat):
+        tracemalloc.start()
+        start, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak - start)
+    return int(statistics.median(peaks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--save", action="store_true", help="save new baseline")
+    parser.add_argument(
+        "--check-time", action="store_true", help="fail on slower times too"
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.5,
+        help="allowed slowdown with --check-time, 0.5 is 50%%",
+    )
+    parser.add_argument(
+        "--alloc-tolerance", type=float, default=0.1, help="allowed allocation growth"
+    )
+    parser.add_argument("cases", nargs="*", help="run only these cases")
+    args = parser.parse_args()
+    tolerance = {"ratio": args.time_tolerance, "alloc": args.alloc_tolerance}
+    checked = ["ratio", "alloc"] if args.check_time else ["alloc"]
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    worse = []
+    print(
+        "{:32} {:>10} {:>8} {:>9} {:>10} {:>9}".format(
+            "", "µs/call", "x ref", "Δ", "B/call", "Δ"
+        )
+    )
+    for name, func in CASES.items():
+        if args.cases and name not in args.cases:
+            continue
+        # Reference measured next to the case sees the same machine load
+        elapsed = measure_time(func)
+        res = {
+            "ratio": elapsed / measure_time(reference),
+            "alloc": measure_alloc(func),
+        }
+        results[name] = res
+        deltas = []
+        for metric in ("ratio", "alloc"):
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                deltas.append("")
+                continue
+            delta = res[metric] / old - 1
+            deltas.append("{:+.0%}".format(delta))
+            if metric in checked and delta > tolerance[metric]:
+                worse.append("{} {}".format(name, metric))
+        print(
+            "{:32} {:10.2f} {:8.3f} {:>9} {:10} {:>9}".format(
+                name, elapsed, res["ratio"], deltas[0], res["alloc"], deltas[1]
+            )
+        )
+
+    if args.save:
+        baseline = {name: res for name, res in baseline.items() if name in CASES}
+        baseline.update(results)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baseline saved to {}".format(BASELINE))
+    elif worse:
+        print("Worse than baseline: {}".format(", ".join(worse)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Busy(Exception):
+    """
+    Raised when a limit is exceeded and the work should be shed
+    """
+
+
+class Admission(object):
+    """
+    Admission control for GLPI calls and document transfers
+    """
+
+    def __init__(self, glpi_limit, transfer_limit, user_limit, wait):
+        """
+        :type glpi_limit: int
+        :type transfer_limit: int
+        :type user_limit: int
+        :type wait: float
+        :param glpi_limit: concurrent calls to each GLPI instance
+        :param transfer_limit: concurrent document transfers for the whole bot
+        :param user_limit: in-flight updates per user
+        :param wait: seconds to wait for a free slot before giving up
+        """
+
+        self.user_limit = user_limit
+        self.wait = wait
+        self.glpi_limit = glpi_limit
+        self.glpi_semaphores = {}
+        self.transfer_semaphore = asyncio.Semaphore(transfer_limit)
+        self.in_flight = Counter()
+
+    @asynccontextmanager
+    async def user(self, user_id):
+        if self.in_flight[user_id] >= self.user_limit:
+            raise Busy(
+                "user {} has {} updates in flight".format(user_id, self.user_limit)
+            )
+        self.in_flight[user_id] += 1
+        try:
+            yield
+        finally:
+            self.in_flight[user_id] -= 1
+            if not self.in_flight[user_id]:
+                del self.in_flight[user_id]
+
+    def glpi(self, backend):
+        """
+        :type backend: str
+        :param backend: GLPI instance, each one has its own slots
+        """
+        if backend not in self.glpi_semaphores:
+            self.glpi_semaphores[backend] = asyncio.Semaphore(self.glpi_limit)
+        return self._slot(self.glpi_semaphores[backend], "glpi {}".format(backend))
+
+    def transfer(self):
+        return self._slot(self.transfer_semaphore, "transfer")
+
+    @asynccontextmanager
+    async def _slot(self, semaphore, name):
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.wait)
+        except asyncio.TimeoutError:
+            raise Busy("no free {} slot in {} s".format(name, self.wait))
+        try:
+            yield
+        finally:
+            semaphore.release()
@@ -0,0 +1,167 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import resilience
+import settings
+import workers
+from webservices_xmlrpc import XMLRPCClient
+
+logger = logging.getLogger(__name__)
+
+
+class Moved(Exception):
+    """
+    Raised when the user has switched to another instance since the work
+    was queued
+    """
+
+
+class Backend(object):
+    """
+    GLPI instance with its own threads, kept-alive connections, timeouts,
+    circuit breaker and stale cache, so a slow instance only holds up
+    its own users
+    """
+
+    def __init__(self, name, url, user, password, concurrency):
+        """
+        :type name: str
+        :type url: str
+        :type user: str
+        :type password: str
+        :type concurrency: int
+        :param name: name of the instance, also the namespace of its caches
+        :param url: base URL of GLPI
+        :param user: Webservices API user
+        :param password: Webservices API password
+        :param concurrency: concurrent calls to the instance
+        """
+
+        self.name = name
+        self.url = url
+        self.user = user
+        self.password = password
+        self.pool = workers.WorkerPool(
+            "glpi:{}".format(name), ThreadPoolExecutor, concurrency
+        )
+        self.timeouts = resilience.AdaptiveTimeout(
+            settings.GLPI_TIMEOUT,
+            settings.GLPI_TIMEOUT_MIN,
+            settings.GLPI_TIMEOUT_MAX,
+            maximums={
+                "getDocument": settings.GLPI_DOCUMENT_TIMEOUT_MAX,
+                "addTicketDocument": settings.GLPI_DOCUMENT_TIMEOUT_MAX,
+            },
+        )
+        self.breaker = resilience.CircuitBreaker(
+            settings.GLPI_BREAKER_THRESHOLD, settings.GLPI_BREAKER_RECOVERY, name=name
+        )
+        self.responses = resilience.ResponseCache(
+            settings.GLPI_STALE_SIZE, settings.GLPI_STALE_TTL
+        )
+        self.health = resilience.HealthHistory(settings.GLPI_PROBE_HISTORY)
+        # Clients with kept-alive connections and the time they were used
+        self._idle = []
+
+    def client(self, timeout=settings.GLPI_TIMEOUT_MAX):
+        return XMLRPCClient(
+            self.url,
+            self.user,
+            self.password,
+            timeout=timeout,
+            gzip_response=settings.GLPI_GZIP_RESPONSE,
+            gzip_threshold=settings.GLPI_GZIP_REQUEST_THRESHOLD,
+        )
+
+    def checkout(self, timeout):
+        """
+        Client for one call, with a connection kept alive from a previous
+        call if there is one. Return it with checkin() after a call that
+        didn't break the connection.
+
+        :type timeout: float
+        :param timeout: socket timeout of the call
+        :rtype: XMLRPCClient
+        """
+        if self._idle:
+            glpi, _ = self._idle.pop()
+            glpi.set_timeout(timeout)
+            return glpi
+        return self.client(timeout=timeout)
+
+    def checkin(self, glpi):
+        if len(self._idle) < self.pool.size:
+            self._idle.append((glpi, time.monotonic()))
+        else:
+            glpi.close()
+
+    def prune(self, max_idle):
+        """
+        Close connections unused for max_idle seconds, the server has
+        probably closed them already
+        """
+        now = time.monotonic()
+        fresh = []
+        for glpi, used in self._idle:
+            if now - used > max_idle:
+                glpi.close()
+            else:
+                fresh.append((glpi, used))
+        self._idle = fresh
+
+    def stats(self):
+        return {
+            "breaker": self.breaker.state,
+            "idle_connections": len(self._idle),
+            "health": self.health.stats(),
+            "threads": self.pool.stats(),
+            "responses": self.responses.stats(),
+        }
+
+
+class Registry(object):
+    """
+    GLPI instances by name, the first one serves users who haven't chosen
+    """
+
+    def __init__(self, config, concurrency):
+        """
+        :type config: dict
+        :type concurrency: int
+        :param config: dicts with url, user and password by instance name
+        :param concurrency: concurrent calls to each instance
+        """
+
+        self.backends = {
+            name: Backend(name, concurrency=concurrency, **options)
+            for name, options in config.items()
+        }
+        self.default = next(iter(self.backends.values()))
+
+    def get(self, name):
+        """
+        :type name: str
+        :param name: instance name from user state
+        :return: the instance or the default one if it is not configured
+        :rtype: Backend
+        """
+        backend = self.backends.get(name)
+        if backend is None:
+            if name:
+                logger.warning("GLPI instance %s is not configured", name)
+            return self.default
+        return backend
+
+    def __iter__(self):
+        return iter(self.backends.values())
+
+    def __len__(self):
+        return len(self.backends)
+
+    def stats(self):
+        return {backend.name: backend.stats() for backend in self}
+
+    def shutdown(self):
+        for backend in self:
+            backend.pool.shutdown()
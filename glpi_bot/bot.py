@@ -1,39 +1,425 @@
 import asyncio
+import functools
+import html
+import http.client
 import json
 import logging
 import os
-import pprint
 import re
+import signal
+import time
+import tracemalloc
 import xmlrpc.client
-
-import aioredis
-from aiotg import Bot
-
+from xml.parsers.expat import ExpatError
+
+import admission
+import backends
+import diagnostics
+import dictionaries
+import digests
+import idempotency
 import keyboard
+import logs
+import resilience
+import sessions as glpi_sessions
 import settings
+import storage
+import telegram
+import ticket_stats
+import tracing
+import user_state
 import utils
-from webservices_xmlrpc import XMLRPCClient
+import workers
+import write_queue
+from webservices_xmlrpc import traffic
+
+# Run as a script, so __name__ is "__main__", named for LOG_LEVELS
+logger = logging.getLogger("bot")
+
+
+bot = telegram.LazyBot()
+pool = None
+
+IMAGE_EXTENSIONS = ("bmp", "gif", "jpg", "jpeg", "png")
+
+# Read-only methods that are safe to retry and to serve from cache
+IDEMPOTENT_METHODS = ("getTicket", "listTickets", "listMyEntities", "getMyInfo")
+# Telegram file IDs of GLPI documents already sent, by document key
+TG_FILES = "tg_files"
+# Message acknowledging a queued write, edited with its result
+WRITE_REPLY = "write_reply:{}"
+
+instances = backends.Registry(settings.GLPI_BACKENDS, settings.GLPI_MAX_CONCURRENT)
+sessions = glpi_sessions.SessionManager(
+    settings.GLPI_SESSION_LIFETIME,
+    settings.GLPI_SESSION_REFRESH_MARGIN,
+    settings.GLPI_SESSION_IDLE_MAX,
+    key=settings.GLPI_CREDENTIALS_KEY,
+)
+# Handler tasks rendering into a message, by (chat_id, message_id)
+rendering = {}
+executors = workers.Workers(settings.WORKERS_IO_SIZE)
+limits = admission.Admission(
+    settings.GLPI_MAX_CONCURRENT,
+    settings.GLPI_MAX_TRANSFERS,
+    settings.BOT_MAX_USER_IN_FLIGHT,
+    settings.BOT_ADMISSION_WAIT,
+)
+outbox = telegram.SendQueue(settings.BOT_SEND_RATE)
+
+
+class Application(object):
+    """
+    Starts the bot step by step, so no update is handled before Redis,
+    GLPI and background tasks are ready, and stops it on SIGTERM without
+    losing updates
+    """
 
-logger = logging.getLogger(__name__)
+    def __init__(self):
+        self.timings = {}
+        self.tasks = []
+        # Background tasks that finish their current work before stopping
+        self.drained = []
+        self.stopping = asyncio.Event()
+        self.diagnostics = None
+
+    async def step(self, name, func, *args, **kwargs):
+        started = time.monotonic()
+        res = func(*args, **kwargs)
+        if asyncio.iscoroutine(res):
+            res = await res
+        self.timings[name] = time.monotonic() - started
+        logger.info("Startup: %s ready in %.3f s", name, self.timings[name])
+        return res
 
-if settings.BOT_PROXY_URL:
-    bot = Bot(api_token=settings.BOT_TOKEN, proxy=settings.BOT_PROXY_URL)
-else:
-    bot = Bot(api_token=settings.BOT_TOKEN)
+    async def redis(self):
+        global pool
+        pool = await storage.connect()
+        await pool.ping()
+        if not settings.REDIS_CLUSTER:
+            await user_state.migrate(pool)
+        await write_queue.recover(pool)
+
+    async def glpi(self):
+        # Checks GLPI is reachable, opens the first connections and gives
+        # adaptive timeouts their first sample
+        await asyncio.gather(*(probe(backend) for backend in instances))
+        for backend in instances:
+            if not backend.health.stats()["ok"]:
+                logger.warning("GLPI %s is not available at startup", backend.name)
+
+    def setup_tracing(self):
+        if settings.TRACING_EXPORT == "file":
+            exporter = tracing.FileExporter(settings.TRACING_FILE)
+        elif settings.TRACING_EXPORT == "otlp":
+            exporter = tracing.OTLPExporter(settings.TRACING_OTLP_ENDPOINT)
+        else:
+            return
+        tracing.setup(
+            exporter,
+            settings.TRACING_SAMPLE_RATE,
+            settings.TRACING_SLOW_THRESHOLD,
+            settings.TRACING_MAX_SPANS,
+        )
+        self.tasks.append(asyncio.ensure_future(exporter.run()))
+
+    async def start(self):
+        started = time.monotonic()
+        settings.validate()
+        await self.step("Tracing", self.setup_tracing)
+        await self.step("Redis", self.redis)
+        await self.step("GLPI", self.glpi)
+        options = {"api_token": settings.BOT_TOKEN}
+        if settings.BOT_PROXY_URL:
+            options["proxy"] = settings.BOT_PROXY_URL
+        first_time = functools.partial(
+            idempotency.first_time, pool, ttl=settings.BOT_UPDATE_TTL
+        )
+        await self.step("Telegram", bot.create, first_time, **options)
+        # Background tasks send messages, so they start after the bot
+        self.tasks += [
+            asyncio.ensure_future(sessions_keepalive()),
+            asyncio.ensure_future(health_probe()),
+            asyncio.ensure_future(outbox.run(bot)),
+        ]
+        self.drained += [
+            asyncio.ensure_future(
+                write_queue.worker(
+                    pool,
+                    write_execute,
+                    write_fail,
+                    settings.WRITE_QUEUE_MAX_ATTEMPTS,
+                    settings.WRITE_QUEUE_RETRY_CAP,
+                    settings.WRITE_QUEUE_DONE_TTL,
+                    self.stopping,
+                )
+            ),
+            asyncio.ensure_future(
+                digests.scheduler(
+                    pool,
+                    digest_tickets,
+                    functools.partial(outbox.put, parse_mode="HTML"),
+                    settings.DIGEST_INTERVAL,
+                    settings.DIGEST_CATCH_UP,
+                    settings.DIGEST_TIMEZONE,
+                    settings.DIGEST_MAX_TICKETS,
+                    self.stopping,
+                )
+            ),
+        ]
+        offset, updates = await idempotency.take_over(pool)
+        bot.resume(offset, updates)
+        if settings.DIAG_HTTP_PORT:
+            self.diagnostics = await self.step(
+                "Diagnostics",
+                diagnostics.serve,
+                settings.DIAG_HTTP_HOST,
+                settings.DIAG_HTTP_PORT,
+                diag_report,
+                settings.DIAG_PROFILE_MAX,
+            )
+        self.timings["total"] = time.monotonic() - started
+        logger.info("Started in %.3f s", self.timings["total"])
+
+    async def stop(self):
+        """
+        Drain in-flight updates, digests, GLPI writes and queued messages
+        within BOT_SHUTDOWN_TIMEOUT, then hand the offset and unhandled
+        updates over to the next process
+        """
+        started = time.monotonic()
+        logger.info("Stopping, draining for %s s", settings.BOT_SHUTDOWN_TIMEOUT)
+        self.stopping.set()
+        unhandled, (_, pending) = await asyncio.gather(
+            bot.drain(settings.BOT_SHUTDOWN_TIMEOUT),
+            asyncio.wait(self.drained, timeout=settings.BOT_SHUTDOWN_TIMEOUT),
+        )
+        for task in pending:
+            task.cancel()
+        # Handlers and digests put messages in the outbox, so it is last
+        left = settings.BOT_SHUTDOWN_TIMEOUT - (time.monotonic() - started)
+        await outbox.drain(max(left, 0))
+        await idempotency.hand_over(
+            pool, bot._offset, unhandled, settings.BOT_UPDATE_TTL
+        )
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, *pending, return_exceptions=True)
+        if self.diagnostics is not None:
+            await self.diagnostics.cleanup()
+        await bot.session.close()
+        pool.close()
+        await pool.wait_closed()
+        instances.shutdown()
+        executors.shutdown()
+        logger.info("Stopped in %.3f s", time.monotonic() - started)
+
+    async def run(self):
+        await self.start()
+        polling = asyncio.ensure_future(bot.loop())
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            # Stops taking updates, the ones received are handled by stop()
+            loop.add_signal_handler(signum, polling.cancel)
+        try:
+            await polling
+        except asyncio.CancelledError:
+            logger.info("Polling stopped at update %s", bot._offset)
+        finally:
+            await self.stop()
+
+
+def admitted(handler):
+    """
+    Decorator for handlers: answers "busy" at once instead of queueing
+    the update when the sender or the bot is over its in-flight limits
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(chat, *args):
+        # Callback handlers get (chat, cq, match), the others (chat, match)
+        cq = args[0] if len(args) == 2 else None
+        sender_id = cq.src["from"]["id"] if cq else chat.sender["id"]
+        # Names are resolved in subtasks, their stale responses count too
+        resilience.track_stale()
+        try:
+            async with limits.user(sender_id):
+                return await handler(chat, *args)
+        except admission.Busy as err:
+            logger.warning("%s shed: %s", handler.__name__, err)
+            if cq:
+                cq.answer(text=settings.BUSY_TEXT)
+            else:
+                chat.send_text(settings.BUSY_TEXT)
+
+    return wrapper
 
 
-async def main():
-    global pool
-    pool = await aioredis.create_redis_pool(
-        (settings.REDIS_HOST, settings.REDIS_PORT),
-        encoding="utf-8",
-        minsize=2,
-        maxsize=4,
+def latest_only(handler):
+    """
+    Decorator for callback handlers: a new tap on the same message cancels
+    the handler still working on the previous one, so only the latest renders
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(chat, cq, match):
+        key = (chat.id, chat.message["message_id"])
+        previous = rendering.get(key)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = asyncio.current_task()
+        rendering[key] = task
+        reaction = telegram.feedback.get()
+        if reaction is not None:
+            markup = chat.message.get("reply_markup", {"inline_keyboard": []})
+            reaction.loading(
+                settings.BOT_LOADING_DELAY,
+                functools.partial(
+                    bot.edit_message_reply_markup,
+                    chat.id,
+                    chat.message["message_id"],
+                    json.dumps(keyboard.loading(cq.data)),
+                ),
+                functools.partial(
+                    bot.edit_message_reply_markup,
+                    chat.id,
+                    chat.message["message_id"],
+                    json.dumps(markup),
+                ),
+            )
+        try:
+            return await handler(chat, cq, match)
+        except asyncio.CancelledError:
+            logger.debug("%s superseded on message %s", handler.__name__, key)
+            if reaction is not None:
+                reaction.superseded()
+        finally:
+            if rendering.get(key) is task:
+                del rendering[key]
+
+    return wrapper
+
+
+def edit_message(chat_id, message_id, text, **options):
+    """
+    Edit bot message, warning the user if it shows data from the stale cache
+    """
+    if resilience.is_stale():
+        text = settings.STALE_TEXT + text
+    edit = functools.partial(
+        bot.edit_message_text, chat_id, message_id, text, **options
     )
+    reaction = telegram.feedback.get()
+    if reaction is None:
+        return edit()
+    return reaction.render(edit)
+
+
+async def glpi_request(backend, method, params, cache_key=None):
+    """
+    Call GLPI API method with adaptive timeout, retries of idempotent
+    methods and circuit breaker, falling back to cached responses
+
+    :type backend: backends.Backend
+    :type method: str
+    :type params: dict
+    :type cache_key: tuple
+    :param backend: GLPI instance
+    :param method: API method name
+    :param params: API method options, including session
+    :param cache_key: key of the response in the stale cache
+    :return: Result of API method call
+    :rtype: dict or bool
+    :raises xmlrpc.client.Fault: GLPI refused the call
+    """
+    idempotent = method in IDEMPOTENT_METHODS
+    attempts = settings.GLPI_RETRIES + 1 if idempotent else 1
+    breaker = backend.breaker
+
+    for attempt in range(attempts):
+        if not breaker.allow():
+            cached = backend.responses.get(cache_key) if idempotent else None
+            if cached is not None:
+                logger.warning(
+                    "Circuit of %s is open, serving cached %s", backend.name, method
+                )
+                resilience.mark_stale()
+                return cached
+            logger.error("Circuit of %s is open, %s rejected", backend.name, method)
+            return False
+
+        # This call is the single trial of a half-open circuit
+        trial = breaker.state == breaker.HALF_OPEN
+        timeout = backend.timeouts.get(method)
+        glpi = backend.checkout(timeout)
+        started = time.monotonic()
+
+        def call():
+            if method == "getDocument":
+                # File is streamed to disk instead of being returned as base64
+                return glpi.download_document(settings.DOCS_TMP_PATH, **params)
+            return getattr(glpi, method)(**params)
+
+        try:
+            # Equals to glpi.method(**params), off the event loop
+            with tracing.span(
+                "glpi {}".format(method), attempt=attempt, backend=backend.name
+            ) as s:
+                try:
+                    async with limits.glpi(backend.name):
+                        res = await backend.pool.run(call)
+                finally:
+                    s.end(**glpi.sizes)
+            backend.timeouts.observe(method, time.monotonic() - started)
+            breaker.record_success()
+            if idempotent and cache_key:
+                backend.responses.set(cache_key, res)
+            backend.checkin(glpi)
+            return res
+
+        except asyncio.CancelledError:
+            # Handler was superseded, drop the connection the thread waits on
+            glpi.abort()
+            raise
+
+        except xmlrpc.client.Fault:
+            # Server is alive and answered, so it is not a breaker failure
+            backend.timeouts.observe(method, time.monotonic() - started)
+            breaker.record_success()
+            backend.checkin(glpi)
+            raise
+
+        except xmlrpc.client.ProtocolError as err:
+            breaker.record_failure()
+            logger.error(
+                "URL: %s, headers: %s, Error code: %s, Error message: %s",
+                err.url,
+                err.headers,
+                err.errcode,
+                err.errmsg,
+            )
+            error = "Что-то не так с сервером!"
+
+        except (OSError, http.client.HTTPException, ExpatError) as err:
+            # Connection refused, reset, socket timeout or broken response
+            breaker.record_failure()
+            logger.error(
+                "%s of %s failed after %.1f s: %r", method, backend.name, timeout, err
+            )
+            error = False
+
+        finally:
+            if trial:
+                # Cancelled, shed by admission or failed unexpectedly, so
+                # the trial ended without an outcome and mustn't hold the
+                # circuit half-open
+                breaker.release()
 
+        if attempt + 1 < attempts:
+            await asyncio.sleep(resilience.retry_delay(attempt))
 
-def glpi_client():
-    return XMLRPCClient(settings.API_BASE, settings.API_USER, settings.API_PASS)
+    return error
 
 
 async def glpi_api_call(method, sender_id, chat, **kwargs):
@@ -46,41 +432,304 @@ async def glpi_api_call(method, sender_id, chat, **kwargs):
     :type kwargs: Any
     :param method: API method name
     :param sender_id: ID of chat user
-    :param chat: chat with bot
+    :param chat: chat with bot, None for background calls that must not
+        ask the user to log in again
     :param kwargs: API method options
     :return: Result of API method call
     :rtype: dict or bool
     """
-    session = await utils.get_user_field(pool, sender_id, "glpi_session")
-    params = {"session": session, "id2name": True, **kwargs}
-    glpi = glpi_client()
+    state = await user_state.load(pool, sender_id)
+    backend = instances.get(state["backend"])
+    # Names are resolved locally, see id_names(), so GLPI is only asked
+    # for them with id2name=True where that can't be done
+    params = {"session": state["session"], **kwargs}
+    cache_key = (sender_id, method, tuple(sorted(kwargs.items())))
+
+    for relogged in (False, True):
+        try:
+            res = await glpi_request(backend, method, params, cache_key)
+        except xmlrpc.client.Fault as err:
+            logger.error(
+                "FaultCode: %s, FaultString: %s", err.faultCode, err.faultString
+            )
+            if err.faultCode == 13:
+                if not relogged and await relogin(sender_id, params["session"]):
+                    params["session"] = await user_state.get(pool, sender_id, "session")
+                    continue
+                if chat is not None:
+                    await reauth_msg(sender_id, chat)
+            return False
 
-    try:
-        # Equals to glpi.method(**params)
-        res = getattr(glpi, method)(**params)
         if method == "doLogout":
+            sessions.forget(sender_id)
             await reauth_msg(sender_id, chat)
+        elif res:
+            sessions.touch(sender_id)
         return res
 
+
+async def user_backend(sender_id):
+    """
+    :type sender_id: int
+    :param sender_id: ID of chat user
+    :return: GLPI instance of the user
+    :rtype: backends.Backend
+    """
+    return instances.get(await user_state.get(pool, sender_id, "backend"))
+
+
+async def id_names(sender_id, chat, itemtype, ids):
+    """
+    Resolve IDs from lean responses, without id2name, to names locally
+
+    :type sender_id: int
+    :type chat: message
+    :type itemtype: str
+    :type ids: list
+    :param sender_id: ID of chat user
+    :param chat: chat with bot
+    :param itemtype: GLPI item type
+    :param ids: IDs of objects
+    :return: names by ID as str
+    :rtype: dict
+    """
+
+    async def fetch(method, **kwargs):
+        return await glpi_api_call(method, sender_id, chat, **kwargs)
+
+    return await dictionaries.names(
+        pool,
+        fetch,
+        (await user_backend(sender_id)).name,
+        itemtype,
+        ids,
+        ttl=settings.GLPI_DICTIONARY_TTL,
+        page=settings.GLPI_DICTIONARY_PAGE,
+    )
+
+
+async def entity_catalog(sender_id, chat):
+    """
+    Entities the user can choose, cached in user state until the login
+    or profile changes
+
+    :type sender_id: int
+    :type chat: message
+    :param sender_id: ID of chat user
+    :param chat: chat with bot
+    :return: entities as dicts with id and name
+    :rtype: list
+    """
+    cached = await pool.get(storage.key(user_state.ENTITIES, sender_id))
+    if cached:
+        return json.loads(cached)
+    res = await glpi_api_call("listMyEntities", sender_id, chat)
+    if not res:
+        return []
+    catalog = [
+        {"id": str(entity["id"]), "name": entity["name"]}
+        for entity in res
+        if str(entity["id"]) not in settings.BOT_EXCLUDED_ENTITIES
+    ]
+    await pool.set(storage.key(user_state.ENTITIES, sender_id), json.dumps(catalog))
+    return catalog
+
+
+async def check_profile(sender_id, info):
+    """
+    Drop cached entity catalog if getMyInfo shows the profile has changed
+    """
+    profile = str(info.get("profiles_id", ""))
+    if profile != await user_state.get(pool, sender_id, "profiles_id"):
+        await user_state.update(pool, sender_id, profiles_id=profile)
+        await pool.delete(storage.key(user_state.ENTITIES, sender_id))
+
+
+async def ticket_counters(sender_id, chat):
+    """
+    Ticket counters of the user for menu badges, from statistics shared
+    by all users of the active entity. They are computed in background,
+    so the menu is shown at once, without badges the first time.
+
+    :type sender_id: int
+    :type chat: message
+    :param sender_id: ID of chat user
+    :param chat: chat with bot
+    :return: counters or None if they are not available
+    :rtype: dict
+    """
+
+    async def fetch(method, **kwargs):
+        # The menu is already shown, an expired session mustn't replace it
+        return await glpi_api_call(method, sender_id, None, **kwargs)
+
+    state = await user_state.load(pool, sender_id)
+    stats = await ticket_stats.entity_stats(
+        pool,
+        fetch,
+        instances.get(state["backend"]).name,
+        ticket_stats.scope_of(state["entity"], sender_id),
+        settings.BOT_STATS_TTL,
+        page=settings.BOT_STATS_PAGE,
+    )
+    return ticket_stats.user_counters(stats, state["id"])
+
+
+async def login(backend, login_name, login_password):
+    """
+    Log in to GLPI through the breaker, adaptive timeout and admission
+    like any other call
+
+    :type backend: backends.Backend
+    :type login_name: str
+    :type login_password: str
+    :param backend: GLPI instance
+    :param login_name: GLPI user
+    :param login_password: GLPI password
+    :return: session and user info or the reason of the failure
+    :rtype: dict or str
+    """
+    params = {"login_name": login_name, "login_password": login_password}
+    try:
+        res = await glpi_request(backend, "doLogin", params)
     except xmlrpc.client.Fault as err:
         logger.error("FaultCode: %s, FaultString: %s", err.faultCode, err.faultString)
-        if err.faultCode == 13:
-            await reauth_msg(sender_id, chat)
-        return False
-
-    except xmlrpc.client.ProtocolError as err:
-        logger.error(
-            "URL: %s, headers: %s, Error code: %s, Error message: %s",
-            err.url,
-            err.headers,
-            err.errcode,
-            err.errmsg,
-        )
-        return "Что-то не так с сервером!"
+        return err.faultString
+    if not isinstance(res, dict):
+        return res or "Сервер GLPI недоступен"
+    return res
+
+
+async def relogin(sender_id, expired_session):
+    """
+    Log in again with the credential stored by user's consent
+
+    :type sender_id: int
+    :type expired_session: str
+    :param sender_id: ID of chat user
+    :param expired_session: session GLPI refused
+    :return: True if the user has a fresh session
+    :rtype: bool
+    """
+    async with sessions.lock(sender_id):
+        state = await user_state.load(pool, sender_id)
+        if state["session"] and state["session"] != expired_session:
+            # Another handler has already logged in
+            return True
+        credential = sessions.unseal(state["credential"])
+        if not credential:
+            return False
+        backend = instances.get(state["backend"])
+        res = await login(backend, *credential)
+        if not isinstance(res, dict):
+            logger.warning("Re-login of %s failed: %s", sender_id, res)
+            return False
+        await user_state.update(pool, sender_id, session=res["session"])
+        sessions.touch(sender_id, used=False)
+        # New session starts in the default entity, return to the chosen one
+        if state["entity"]:
+            params = {
+                "session": res["session"],
+                "entity": state["entity"],
+                "recursive": 1,
+            }
+            try:
+                await glpi_request(backend, "setMyEntity", params)
+            except xmlrpc.client.Fault as err:
+                logger.warning("Entity of %s not restored: %s", sender_id, err)
+                await user_state.update(pool, sender_id, entity="")
+        logger.info("Session of %s renewed", sender_id)
+        return True
+
+
+async def sessions_keepalive():
+    """
+    Refresh GLPI sessions of recently active users before they expire
+    """
+    while True:
+        await asyncio.sleep(settings.GLPI_SESSION_CHECK_INTERVAL)
+        for sender_id in sessions.due():
+            state = await user_state.load(pool, sender_id)
+            session = state["session"]
+            if not session:
+                sessions.forget(sender_id)
+                continue
+            try:
+                res = await glpi_request(
+                    instances.get(state["backend"]), "getMyInfo", {"session": session}
+                )
+                if res:
+                    sessions.touch(sender_id, used=False)
+            except xmlrpc.client.Fault as err:
+                if err.faultCode != 13 or not await relogin(sender_id, session):
+                    sessions.forget(sender_id)
+            except Exception:  # noqa
+                logger.exception("Keep-alive of %s failed", sender_id)
+
+
+async def probe(backend):
+    """
+    Call status of GLPI instance, recording its health. The call goes
+    through the circuit breaker, so it is also the trial call that
+    closes the circuit after recovery.
+
+    :type backend: backends.Backend
+    :param backend: GLPI instance
+    """
+    backend.prune(settings.GLPI_KEEPALIVE)
+    started = time.monotonic()
+    try:
+        res = await glpi_request(backend, "status", {})
+        ok = isinstance(res, dict)
+    except xmlrpc.client.Fault as err:
+        res = err.faultString
+        ok = True
+    backend.health.record(ok, time.monotonic() - started, res)
+
+
+async def health_probe():
+    while True:
+        await asyncio.sleep(settings.GLPI_PROBE_INTERVAL)
+        try:
+            await asyncio.gather(*(probe(backend) for backend in instances))
+        except Exception:  # noqa
+            logger.exception("Health probe failed")
+
+
+async def session_call(backend, session, method, **kwargs):
+    return await glpi_request(backend, method, {"session": session, **kwargs})
+
+
+async def digest_tickets(members):
+    """
+    Unresolved tickets of the entity for the digests of its users, queried
+    once with the session of the first user it works for
+
+    :type members: list
+    :param members: user ID, state, digest time and previous digest time
+        of users of one entity
+    :return: tickets or None if GLPI failed
+    :rtype: list
+    """
+    for sender_id, state, _, _ in members:
+        backend = instances.get(state["backend"])
+        session = state["session"]
+        for relogged in (False, True):
+            fetch = functools.partial(session_call, backend, session)
+            try:
+                return await ticket_stats.unresolved(fetch, settings.BOT_STATS_PAGE)
+            except xmlrpc.client.Fault as err:
+                if err.faultCode == 13 and not relogged:
+                    if await relogin(sender_id, session):
+                        session = await user_state.get(pool, sender_id, "session")
+                        continue
+                logger.warning("Digest query as %s failed: %s", sender_id, err)
+                break
+    return None
 
 
 async def reauth_msg(sender_id, chat):
-    login_name = await utils.get_user_field(pool, sender_id, "glpi_name")
+    login_name = await user_state.get(pool, sender_id, "name")
     markup = keyboard.LOGIN
     if login_name:
         markup["inline_keyboard"][0][0][
@@ -88,7 +737,7 @@ async def reauth_msg(sender_id, chat):
         ] = "{} ".format(login_name)
     text = "❗*Войди для продолжения работы*❗\n{}".format(settings.LOGIN_TEXT)
     if chat.message["from"]["is_bot"]:
-        bot.edit_message_text(
+        edit_message(
             chat.message["chat"]["id"],
             chat.message["message_id"],
             text,
@@ -101,72 +750,211 @@ async def reauth_msg(sender_id, chat):
 
 async def download_file(path, filename, file_id):
     tg_file = await bot.get_file(file_id)
-    if not os.path.exists(path):
-        os.makedirs(path)
+    await executors.io(functools.partial(os.makedirs, path, exist_ok=True))
     local_file = os.path.join(path, filename)
 
     async with bot.download_file(tg_file["file_path"]) as resp:
-        with open(local_file, "wb") as fd:
+        fd = await executors.io(open, local_file, "wb")
+        try:
             while True:
-                chunk = await resp.content.read(1024)
+                chunk = await resp.content.read(65536)
                 if not chunk:
                     break
-                fd.write(chunk)
+                await executors.io(fd.write, chunk)
+        finally:
+            await executors.io(fd.close)
     return local_file
 
 
-async def ticket_followup_add(chat, session, users_login, ticket_id):
-    params = {
-        "session": session,
-        "ticket": ticket_id,
-        "content": chat.message["text"],
-        "users_login": users_login,
-        "source": "Telegram",
-    }
-    glpi = glpi_client()
-    res = glpi.addTicketFollowup(**params)
-    if res:
-        # pprint.pprint(res)
+async def queue_write(chat, kind, ticket_id, **job):
+    """
+    Acknowledge user's write at once and leave it to the write queue worker
+
+    :type chat: message
+    :type kind: str
+    :type ticket_id: str
+    :param chat: chat with bot
+    :param kind: followup, solution or document
+    :param ticket_id: ID of the ticket
+    :param job: data of the write
+    """
+    # Same message delivered again gets the same job ID and is written once
+    job_id = idempotency.write_id(
+        chat.id,
+        chat.message["message_id"],
+        kind,
+        ticket_id,
+        job.get("content", ""),
+        chat.message.get("document", {}).get("file_unique_id", ""),
+    )
+    # Queued before it is acknowledged, so a Redis failure doesn't leave
+    # the user with a false promise and without the prompt
+    await write_queue.put(
+        pool,
+        kind,
+        id=job_id,
+        sender_id=chat.sender["id"],
+        backend=await user_state.get(pool, chat.sender["id"], "backend"),
+        chat_id=chat.id,
+        reply_to=chat.message["message_id"],
+        ticket=ticket_id,
+        **job
+    )
+    reply = await chat.send_text(settings.WRITE_QUEUED[kind].format(ticket_id))
+    await pool.set(
+        storage.key(WRITE_REPLY, job_id),
+        reply["result"]["message_id"],
+        expire=settings.WRITE_QUEUE_DONE_TTL,
+    )
+    chat.delete_message(chat.message["reply_to_message"]["message_id"])
+
+
+async def write_report(job, text, **options):
+    """
+    Edit the acknowledgement of the write with its result, or reply to
+    the user's message if the acknowledgement hasn't been sent
+
+    :type job: dict
+    :type text: str
+    :param job: write job
+    :param text: result of the write
+    """
+    # Jobs queued before the acknowledgement had a key carry its ID
+    message_id = job.get("message_id")
+    # The worker may finish before the acknowledgement is sent
+    for _ in range(10):
+        message_id = message_id or await pool.get(storage.key(WRITE_REPLY, job["id"]))
+        if message_id:
+            bot.edit_message_text(job["chat_id"], message_id, text, **options)
+            return
+        await asyncio.sleep(0.3)
+    bot.send_message(
+        job["chat_id"], text, reply_to_message_id=job["reply_to"], **options
+    )
+
+
+async def ticket_followup_add(chat, ticket_id):
+    await queue_write(chat, "followup", ticket_id, content=chat.message["text"])
+
+
+async def ticket_solution_add(chat, ticket_id):
+    await queue_write(chat, "solution", ticket_id, content=chat.message["text"])
+
+
+async def write_execute(job):
+    """
+    Make the GLPI write of a queued job and report it to the user
+    """
+    sender_id = job["sender_id"]
+    state = await user_state.load(pool, sender_id)
+    if job.get("backend", state["backend"]) != state["backend"]:
+        # The ticket is in the GLPI the user has switched from
+        raise backends.Moved(job["backend"])
+    params = {"session": state["session"], "ticket": job["ticket"]}
+    if job["kind"] == "followup":
+        method = "addTicketFollowup"
+        params.update(
+            content=job["content"], users_login=state["name"], source="Telegram"
+        )
+    elif job["kind"] == "solution":
+        method = "setTicketSolution"
+        params.update(type=8, solution=job["content"])
+    else:
+        method = "addTicketDocument"
+        params.update(
+            name=job["name"],
+            base64=await executors.io(utils.file_to_b64, job["path"]),
+            content=job["content"],
+            users_login=state["name"],
+            source="Telegram",
+        )
+
+    backend = instances.get(state["backend"])
+    try:
+        if method == "addTicketDocument":
+            async with limits.transfer():
+                res = await glpi_request(backend, method, params)
+        else:
+            res = await glpi_request(backend, method, params)
+    except admission.Busy as err:
+        raise write_queue.RetryLater(err)
+    except xmlrpc.client.Fault as err:
+        if err.faultCode == 13 and await relogin(sender_id, state["session"]):
+            raise write_queue.RetryLater(err.faultString)
+        raise
+    if not res:
+        raise write_queue.RetryLater("GLPI is unavailable")
+
+    if job["kind"] == "followup":
         followup = res["followups"][0]
-        followup_fmt = settings.FOLLOWUP_ADDED.format(
+        text = settings.FOLLOWUP_ADDED.format(
             followup["tickets_id"], followup["date_mod"], followup["content"]
         )
-        chat.delete_message(chat.message["reply_to_message"]["message_id"])
-        chat.send_text(followup_fmt, parse_mode="HTML")
+    elif job["kind"] == "solution":
+        text = "Решение добавлено... вроде"
+    else:
+        doc = res["documents"][-1]
+        text = settings.DOCUMENT_ADDED.format(
+            doc["tickets_id"], doc["date_mod"], doc["filename"]
+        )
+        await executors.io(os.remove, job["path"])
+    await write_report(job, text, parse_mode="HTML")
 
 
-async def ticket_solution_add(chat, session, ticket_id):
-    params = {
-        "session": session,
-        "ticket": ticket_id,
-        "type": 8,
-        "solution": chat.message["text"],
-    }
-    glpi = glpi_client()
-    res = glpi.setTicketSolution(**params)
-    if res:
-        # pprint.pprint(res)
-        chat.delete_message(chat.message["reply_to_message"]["message_id"])
-        chat.send_text("Решение добавлено... вроде")
+async def write_fail(job, err):
+    """
+    Tell the user that the queued write was not made, returning the text
+    """
+    if isinstance(err, xmlrpc.client.Fault) and err.faultCode == 13:
+        reason = "сессия GLPI истекла, войди заново"
+    elif isinstance(err, backends.Moved):
+        reason = "выбран другой сервер GLPI"
+    elif job["kind"] == "document" and isinstance(err, xmlrpc.client.Fault):
+        if "name" in err.faultString:
+            reason = "формат файла запрещен к загрузке в настройках GLPI"
+        else:
+            reason = err.faultString
+    elif isinstance(err, xmlrpc.client.Fault):
+        reason = err.faultString
+    else:
+        reason = "GLPI недоступен"
+    text = settings.WRITE_FAILED.format(job["ticket"], reason, job.get("content", ""))
+    await write_report(job, text)
 
 
-@bot.inline(r"(.*?)\s+(.*?)\s+((?i)login)")
+@bot.inline(r"(.*?)\s+(.*?)\s+(login|remember)")
 async def inline_login(iq, match):
     sender_id = iq.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
         if match.group(3):
             login_name = match.group(1)
             login_password = match.group(2)
-            glpi = glpi_client()
-            res = glpi.connect(login_name, login_password)
-            logger.debug(res)
+            backend = await user_backend(sender_id)
+            try:
+                res = await login(backend, login_name, login_password)
+            except admission.Busy:
+                res = settings.BUSY_TEXT
+            # Whole result holds the session, don't log it
+            logger.debug(
+                "Login of %s: %s", sender_id, "ok" if isinstance(res, dict) else res
+            )
             if isinstance(res, dict):
-                glpi_user = [iq.sender["id"]]
-                for k, v in res.items():
-                    new_key = "glpi_{}".format(k)
-                    glpi_user.append(new_key)
-                    glpi_user.append(v)
-                await utils.set_user(pool, glpi_user, **iq.sender)
+                # "remember" is the consent to keep the credential for re-login
+                credential = ""
+                if match.group(3).lower() == "remember" and sessions.can_relogin:
+                    credential = sessions.seal(login_name, login_password)
+                # New session starts in the default entity, maybe with other profile
+                await user_state.update(
+                    pool,
+                    sender_id,
+                    session=res["session"],
+                    name=res["name"],
+                    id=res["id"],
+                    credential=credential,
+                    entity="",
+                )
+                await pool.delete(storage.key(user_state.ENTITIES, sender_id))
+                sessions.touch(sender_id)
                 res = "Привет, {}!".format(res["firstname"])
                 text = "/menu"
             else:
@@ -201,6 +989,8 @@ async def inline_login(iq, match):
 
 
 @bot.callback(r"cb_tickets_mine(\d+)")
+@latest_only
+@admitted
 async def tickets_mine(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
@@ -216,21 +1006,7 @@ async def tickets_mine(chat, cq, match):
             markup = keyboard.pagination(
                 item_count, page_start, page_limit, "cb_tickets_mine"
             )
-            for ticket in res[page_start:page_end]:
-                time_to_resolve = "нет даты"
-                try:
-                    time_to_resolve = utils.format_date(ticket["time_to_resolve"])
-                except ValueError:
-                    pass
-                button_text = "[{}] {}".format(time_to_resolve, ticket["name"])
-                button_markup = [
-                    {
-                        "type": "InlineKeyboardButton",
-                        "text": button_text,
-                        "callback_data": "cb_ticket_{}".format(ticket["id"]),
-                    }
-                ]
-                markup["inline_keyboard"].insert(-1, button_markup)
+            keyboard.ticket_buttons(markup, res[page_start:page_end])
 
             markup["inline_keyboard"].append(
                 [
@@ -241,7 +1017,7 @@ async def tickets_mine(chat, cq, match):
                     }
                 ]
             )
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 "👨‍💻  Назначенные мне заявки ({})".format(item_count),
@@ -250,12 +1026,14 @@ async def tickets_mine(chat, cq, match):
 
 
 @bot.callback(r"cb_tickets_all_current(\d+)")
+@latest_only
+@admitted
 async def tickets_all_current(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
     message_id = chat.message["message_id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        glpi_user_id = await utils.get_user_field(pool, sender_id, "glpi_id")
+        glpi_user_id = await user_state.get(pool, sender_id, "id")
         count = await glpi_api_call(
             "listTickets", sender_id, chat, status="2", count=True
         )
@@ -268,23 +1046,7 @@ async def tickets_all_current(chat, cq, match):
             markup = keyboard.pagination(
                 item_count, page_start, page_limit, "cb_tickets_all_current"
             )
-            for ticket in res:
-                time_to_resolve = "нет даты"
-                try:
-                    time_to_resolve = utils.format_date(ticket["time_to_resolve"])
-                except ValueError:
-                    pass
-                button_text = "[{}] {}".format(time_to_resolve, ticket["name"])
-                button_markup = [
-                    {
-                        "type": "InlineKeyboardButton",
-                        "text": button_text,
-                        "callback_data": "cb_ticket_{}".format(ticket["id"]),
-                    }
-                ]
-                if ticket["users"]["assign"][0]["id"] == glpi_user_id:
-                    button_markup[0]["text"] = "👨‍💻  {}".format(button_text)
-                markup["inline_keyboard"].insert(-1, button_markup)
+            keyboard.ticket_buttons(markup, res, glpi_user_id)
 
             markup["inline_keyboard"].append(
                 [
@@ -295,7 +1057,7 @@ async def tickets_all_current(chat, cq, match):
                     }
                 ]
             )
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 "👥  Все нерешенные ({})".format(item_count),
@@ -304,70 +1066,158 @@ async def tickets_all_current(chat, cq, match):
 
 
 @bot.callback(r"cb_tickets")
+@latest_only
+@admitted
 async def tickets(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
     message_id = chat.message["message_id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        markup = {
-            "type": "InlineKeyboardMarkup",
-            "inline_keyboard": [
-                [
-                    {
-                        "type": "InlineKeyboardButton",
-                        "text": "👨‍💻  Мои заявки",
-                        "callback_data": "cb_tickets_mine0",
-                    }
-                ],
-                [
-                    {
-                        "type": "InlineKeyboardButton",
-                        "text": "👥  Все нерешенные",
-                        "callback_data": "cb_tickets_all_current0",
-                    }
-                ],
-                [
-                    {
-                        "type": "InlineKeyboardButton",
-                        "text": "✍️  Новая заявка (не работает)",
-                        "callback_data": "cb_tickets",
-                    }
-                ],
-                [
-                    {
-                        "type": "InlineKeyboardButton",
-                        "text": keyboard.BTN_MENU,
-                        "callback_data": "cb_menu",
-                    }
-                ],
-            ],
-        }
-        bot.edit_message_text(
-            chat_id, message_id, "Заявки", reply_markup=json.dumps(markup)
-        )
+        markup = keyboard.tickets(await ticket_counters(sender_id, chat))
+        edit_message(chat_id, message_id, "Заявки", reply_markup=json.dumps(markup))
 
 
 @bot.callback(r"cb_ticket_(\d+)_document_(\d+)_send")
+@admitted
 async def ticket_document_send(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
         ticket = match.group(1)
         document = match.group(2)
         params = {"document": document, "ticket": ticket}
-        await chat.send_chat_action("upload_document")
-        res = await glpi_api_call("getDocument", sender_id, chat, **params)
-        if res:
-            doc_name = utils.translit_replace(res["filename"])
-            doc_file = utils.b64_to_file(
-                settings.DOCS_TMP_PATH, doc_name, res["base64"], res["sha1sum"]
+        async with limits.transfer():
+            await chat.send_chat_action("upload_document")
+            res = await glpi_api_call("getDocument", sender_id, chat, **params)
+            if res:
+                doc_name = utils.translit_replace(res["filename"])
+                doc_file = await executors.io(
+                    utils.checked_file,
+                    res["path"],
+                    doc_name,
+                    res["sha1"],
+                    res["sha1sum"],
+                )
+                if doc_file:
+                    doc_ext = doc_file.split(".")[-1]
+                    # The HTTP client reads it in a thread as well
+                    f = await executors.io(open, doc_file, "rb")
+                    try:
+                        if doc_ext.lower() in IMAGE_EXTENSIONS:
+                            await chat.send_photo(f, caption=res["filename"])
+                        else:
+                            await chat.send_document(f, caption=res["filename"])
+                    finally:
+                        await executors.io(f.close)
+
+
+@bot.callback(r"cb_ticket_(\d+)_documents_send_all")
+@admitted
+async def ticket_documents_send_all(chat, cq, match):
+    sender_id = cq.src["from"]["id"]
+    if str(sender_id) in settings.BOT_USERS_CHAT_ID:
+        ticket = match.group(1)
+        res = await glpi_api_call("getTicket", sender_id, chat, ticket=ticket)
+        if not res or not res["documents"]:
+            return
+        async with limits.transfer():
+            await chat.send_chat_action("upload_document")
+            docs = sorted(res["documents"], key=lambda i: int(i["id"]))
+            semaphore = asyncio.Semaphore(settings.BOT_SEND_ALL_CONCURRENCY)
+            files = await asyncio.gather(
+                *[
+                    fetch_document(sender_id, chat, ticket, doc, semaphore)
+                    for doc in docs
+                ]
             )
-            if doc_file:
-                doc_ext = doc_file.split(".")[-1]
-                with open(doc_file, "rb") as f:
-                    if doc_ext.lower() in ("bmp", "gif", "jpg", "jpeg", "png"):
-                        await chat.send_photo(f, caption=res["filename"])
-                    else:
-                        await chat.send_document(f, caption=res["filename"])
+            files = [f for f in files if f]
+            try:
+                for kind in ("photo", "document"):
+                    group = [f for f in files if f["kind"] == kind]
+                    for start in range(0, len(group), 10):
+                        await send_media_group(chat, group[start : start + 10])
+            finally:
+                for f in files:
+                    if f["path"]:
+                        await executors.io(os.remove, f["path"])
+
+
+async def fetch_document(sender_id, chat, ticket, doc, semaphore):
+    """
+    Get document for sending to Telegram, from Telegram file ID cache
+    if it was sent before or from GLPI
+
+    :return: dict with kind, caption, cache key and file ID or path
+    :rtype: dict
+    """
+    ext = doc["filename"].split(".")[-1].lower()
+    item = {
+        "kind": "photo" if ext in IMAGE_EXTENSIONS else "document",
+        "caption": doc["filename"],
+        "key": "{}:{}:{}".format(
+            (await user_backend(sender_id)).name, doc["id"], doc.get("sha1sum", "")
+        ),
+        "file_id": None,
+        "path": None,
+    }
+    item["file_id"] = await pool.hget(storage.key(TG_FILES), item["key"])
+    if item["file_id"]:
+        return item
+    async with semaphore:
+        res = await glpi_api_call(
+            "getDocument", sender_id, chat, document=doc["id"], ticket=ticket
+        )
+    if not res:
+        return None
+    # Documents are downloaded in parallel, so names must not collide
+    doc_name = "{}_{}".format(doc["id"], utils.translit_replace(res["filename"]))
+    item["path"] = await executors.io(
+        utils.checked_file, res["path"], doc_name, res["sha1"], res["sha1sum"]
+    )
+    return item if item["path"] else None
+
+
+async def send_media_group(chat, items):
+    """
+    Send documents of one kind as a media group, or alone if it is one,
+    remembering Telegram file IDs of uploaded files
+    """
+    files = {}
+    media = []
+    try:
+        for i, item in enumerate(items):
+            if item["file_id"]:
+                ref = item["file_id"]
+            else:
+                ref = "attach://file{}".format(i)
+                files["file{}".format(i)] = await executors.io(open, item["path"], "rb")
+            media.append(
+                {"type": item["kind"], "media": ref, "caption": item["caption"]}
+            )
+
+        if len(items) == 1:
+            ref = files.get("file0", media[0]["media"])
+            if items[0]["kind"] == "photo":
+                res = await chat.send_photo(ref, caption=items[0]["caption"])
+            else:
+                res = await chat.send_document(ref, caption=items[0]["caption"])
+            messages = [res["result"]]
+        else:
+            res = await bot.api_call(
+                "sendMediaGroup", chat_id=str(chat.id), media=json.dumps(media), **files
+            )
+            messages = res["result"]
+    finally:
+        for f in files.values():
+            await executors.io(f.close)
+
+    for item, message in zip(items, messages):
+        if item["file_id"]:
+            continue
+        if item["kind"] == "photo":
+            file_id = message["photo"][-1]["file_id"]
+        else:
+            file_id = message["document"]["file_id"]
+        await pool.hset(storage.key(TG_FILES), item["key"], file_id)
 
 
 @bot.callback(r"cb_ticket_(\d+)_document_add")
@@ -403,6 +1253,8 @@ async def ticket_solution_add_reply(chat, cq, match):
 
 
 @bot.callback(r"cb_ticket_(\d+)_documents(\d+)")
+@latest_only
+@admitted
 async def ticket_documents(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
@@ -414,17 +1266,27 @@ async def ticket_documents(chat, cq, match):
         ticket = match.group(1)
         res = await glpi_api_call("getTicket", sender_id, chat, ticket=ticket)
         if res:
-            pprint.pprint(res["documents"])
+            logger.debug(
+                "Documents of ticket %s: %s", ticket, logs.Payload(res["documents"])
+            )
             item_count = len(res["documents"])
             cb = "cb_ticket_{}_documents".format(ticket)
             markup = keyboard.pagination(item_count, page_start, page_limit, cb)
             sorted_list = sorted(
                 res["documents"], key=lambda i: str(i["id"]), reverse=True
             )
+            users = await id_names(
+                sender_id,
+                chat,
+                "User",
+                [i["users_id"] for i in sorted_list[page_start:page_end]],
+            )
             items = []
             for item in sorted_list[page_start:page_end]:
                 item_fmt = settings.DOCUMENT_TEXT.format(
-                    item["date_creation"], item["users_name"], item["filename"]
+                    item["date_creation"],
+                    users.get(str(item["users_id"]), ""),
+                    item["filename"],
                 )
                 items.append(item_fmt)
                 doc_button = [
@@ -445,6 +1307,15 @@ async def ticket_documents(chat, cq, match):
                         "callback_data": "cb_ticket_{}_document_add".format(res["id"]),
                     }
                 ],
+                [
+                    {
+                        "type": "InlineKeyboardButton",
+                        "text": "📦  Отправить все",
+                        "callback_data": "cb_ticket_{}_documents_send_all".format(
+                            res["id"]
+                        ),
+                    }
+                ],
                 [
                     {
                         "type": "InlineKeyboardButton",
@@ -467,7 +1338,7 @@ async def ticket_documents(chat, cq, match):
             if not res["documents"]:
                 reply = "<b>У заявки «{}» пока нет документов</b>".format(res["name"])
 
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 reply,
@@ -477,6 +1348,8 @@ async def ticket_documents(chat, cq, match):
 
 
 @bot.callback(r"cb_ticket_(\d+)_followups(\d+)")
+@latest_only
+@admitted
 async def ticket_followups(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
@@ -494,10 +1367,18 @@ async def ticket_followups(chat, cq, match):
             sorted_list = sorted(
                 res["followups"], key=lambda i: str(i["id"]), reverse=True
             )
+            users = await id_names(
+                sender_id,
+                chat,
+                "User",
+                [i["users_id"] for i in sorted_list[page_start:page_end]],
+            )
             items = []
             for item in sorted_list[page_start:page_end]:
                 item_fmt = settings.FOLLOWUP_TEXT.format(
-                    item["date_mod"], item["users_name"], item["content"]
+                    item["date_mod"],
+                    users.get(str(item["users_id"]), ""),
+                    item["content"],
                 )
                 items.append(item_fmt)
             followup_kbd = [
@@ -530,7 +1411,7 @@ async def ticket_followups(chat, cq, match):
             if not res["followups"]:
                 reply = "<b>У заявки «{}» пока нет комментариев</b>".format(res["name"])
 
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 reply,
@@ -540,6 +1421,8 @@ async def ticket_followups(chat, cq, match):
 
 
 @bot.callback(r"cb_ticket_(\d+)_history(\d+)")
+@latest_only
+@admitted
 async def ticket_history(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
@@ -582,7 +1465,7 @@ async def ticket_history(chat, cq, match):
             markup["inline_keyboard"] += history_kbd
             reply = "*История заявки «{}»\n*{}".format(res["name"], "".join(items))
 
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 reply,
@@ -592,6 +1475,8 @@ async def ticket_history(chat, cq, match):
 
 
 @bot.callback(r"cb_ticket_(\d+)")
+@latest_only
+@admitted
 async def ticket_details(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
@@ -604,16 +1489,36 @@ async def ticket_details(chat, cq, match):
                 time_to_resolve = utils.format_date(res["time_to_resolve"])
             except ValueError:
                 pass
-            requester_user = res["users"]["requester"][0]["users_name"]
-            assign_user = ", ".join([u["users_name"] for u in res["users"]["assign"]])
+            requesters = res["users"]["requester"]
+            assigned = res["users"]["assign"]
+            category_type, category_field = "ITILCategory", "itilcategories_id"
+            if category_field not in res:
+                # Names in GLPI before 0.84
+                category_type, category_field = "TicketCategory", "ticketcategories_id"
+            category_id = res.get(category_field)
+            users, category, entity = await asyncio.gather(
+                id_names(
+                    sender_id,
+                    chat,
+                    "User",
+                    [u["users_id"] for u in requesters + assigned],
+                ),
+                id_names(sender_id, chat, category_type, [category_id]),
+                id_names(sender_id, chat, "Entity", [res["entities_id"]]),
+            )
+            requester_user = users.get(str(requesters[0]["users_id"]), "")
+            # Assignees without a name, like groups only, are left out
+            assign_user = ", ".join(
+                filter(None, (users.get(str(u["users_id"])) for u in assigned))
+            )
             ticket_fmt = settings.TICKET_TEXT.format(
-                settings.API_BASE,
+                (await user_backend(sender_id)).url,
                 res["id"],
                 res["name"],
                 res["content"],
                 time_to_resolve,
-                res["ticketcategories_name"],
-                res["entities_name"].replace("&gt;", ">"),
+                category.get(str(category_id), ""),
+                entity.get(str(res["entities_id"]), "").replace("&gt;", ">"),
                 requester_user,
                 assign_user,
             )
@@ -671,7 +1576,7 @@ async def ticket_details(chat, cq, match):
                     ],
                 ],
             }
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 ticket_fmt,
@@ -681,6 +1586,8 @@ async def ticket_details(chat, cq, match):
 
 
 @bot.callback(r"cb_entity_(\d+)_set")
+@latest_only
+@admitted
 async def entity_set(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
@@ -689,10 +1596,14 @@ async def entity_set(chat, cq, match):
         params = {"entity": match.group(1), "recursive": 1}
         res = await glpi_api_call("setMyEntity", sender_id, chat, **params)
         if res:
-            markup = keyboard.DEFAULT
+            await user_state.update(pool, sender_id, entity=match.group(1))
+            markup = keyboard.default(
+                await ticket_counters(sender_id, chat),
+                (await user_backend(sender_id)).url,
+            )
             entities_text = "Выбранная организация: {}".format(res[0]["completename"])
 
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 entities_text,
@@ -702,13 +1613,16 @@ async def entity_set(chat, cq, match):
 
 
 @bot.callback(r"cb_entities")
+@latest_only
+@admitted
 async def entities(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
     message_id = chat.message["message_id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        res = await glpi_api_call("listMyEntities", sender_id, chat)
-        if res:
+        catalog = await entity_catalog(sender_id, chat)
+        if catalog:
+            active = await user_state.get(pool, sender_id, "entity")
             markup = {
                 "type": "InlineKeyboardMarkup",
                 "inline_keyboard": [
@@ -722,20 +1636,17 @@ async def entities(chat, cq, match):
                 ],
             }
             buttons = []
-            for entity in res:
-                if entity["id"] not in [
-                    "12",
-                    "13",
-                    "14",
-                    "15",
-                ]:  # FIXME hardcoded entities
-                    buttons.append(
-                        {
-                            "type": "InlineKeyboardButton",
-                            "text": "{}".format(entity["name"]),
-                            "callback_data": "cb_entity_{}_set".format(entity["id"]),
-                        }
-                    )
+            for entity in catalog:
+                text = entity["name"]
+                if entity["id"] == active:
+                    text = "✅  {}".format(text)
+                buttons.append(
+                    {
+                        "type": "InlineKeyboardButton",
+                        "text": text,
+                        "callback_data": "cb_entity_{}_set".format(entity["id"]),
+                    }
+                )
             buttons_group = [
                 [one, two] for one, two in zip(buttons[0::2], buttons[1::2])
             ]
@@ -743,7 +1654,7 @@ async def entities(chat, cq, match):
                 buttons_group.append([buttons[-1]])
             markup["inline_keyboard"] = buttons_group + markup["inline_keyboard"]
 
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 settings.ENTITIES_TEXT,
@@ -753,6 +1664,8 @@ async def entities(chat, cq, match):
 
 
 @bot.callback("cb_my_info")
+@latest_only
+@admitted
 async def my_info(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
@@ -760,11 +1673,21 @@ async def my_info(chat, cq, match):
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
         res = await glpi_api_call("getMyInfo", sender_id, chat)
         if res:
-            markup = keyboard.DEFAULT
+            await check_profile(sender_id, res)
+            markup = keyboard.default(
+                await ticket_counters(sender_id, chat),
+                (await user_backend(sender_id)).url,
+            )
+            titles = await id_names(
+                sender_id, chat, "UserTitle", [res["usertitles_id"]]
+            )
             my_info = "*{} {}*\n{}\n{}".format(
-                res["realname"], res["firstname"], res["usertitles_name"], res["email"]
+                res["realname"],
+                res["firstname"],
+                titles.get(str(res["usertitles_id"]), ""),
+                res["email"],
             )
-            bot.edit_message_text(
+            edit_message(
                 chat_id,
                 message_id,
                 my_info,
@@ -774,23 +1697,29 @@ async def my_info(chat, cq, match):
 
 
 @bot.callback("cb_logout")
+@admitted
 async def logout(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
         res = await glpi_api_call("doLogout", sender_id, chat)
         if res:
-            await utils.set_user_field(pool, sender_id, "glpi_session", "")
+            await user_state.update(pool, sender_id, session="", credential="")
             chat.send_text(res["message"])
 
 
 @bot.callback(r"cb_menu")
+@latest_only
+@admitted
 async def menu(chat, cq, match):
     sender_id = cq.src["from"]["id"]
     chat_id = chat.message["chat"]["id"]
     message_id = chat.message["message_id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        markup = keyboard.DEFAULT
-        bot.edit_message_text(
+        markup = keyboard.default(
+            await ticket_counters(sender_id, chat),
+            (await user_backend(sender_id)).url,
+        )
+        edit_message(
             chat_id,
             message_id,
             "Меню",
@@ -800,12 +1729,10 @@ async def menu(chat, cq, match):
 
 
 @bot.handle("document")
+@admitted
 async def document_add(chat, document):  # FIXME
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        # pprint.pprint(dir(chat))
-        # pprint.pprint(chat.message.keys())
-        # pprint.pprint(document)
         if "reply_to_message" in chat.message.keys():
             doc_name = ""
             try:
@@ -818,53 +1745,33 @@ async def document_add(chat, document):  # FIXME
                     except KeyError:
                         pass
 
-                    session = await utils.get_user_field(
-                        pool, sender_id, "glpi_session"
-                    )
-                    users_login = await utils.get_user_field(
-                        pool, sender_id, "glpi_name"
-                    )
                     ticket_id = re.search(r"#(\d+)", bot_message_text)
 
                     file_id = document["file_id"]
                     doc_name = utils.translit_replace(document["file_name"])
 
-                    local_file = await download_file(
-                        settings.DOCS_TMP_PATH, doc_name, file_id
-                    )
-                    encoded_string = utils.file_to_b64(local_file)
-
-                    params = {
-                        "session": session,
-                        "ticket": ticket_id.group(1),
-                        "name": doc_name,
-                        "base64": encoded_string,
-                        "content": content,
-                        "users_login": users_login,
-                        "source": "Telegram",
-                    }
-                    glpi = glpi_client()
-                    res = glpi.addTicketDocument(**params)
-                    if res:
-                        doc = res["documents"][-1]
-                        doc_fmt = settings.DOCUMENT_ADDED.format(
-                            doc["tickets_id"], doc["date_mod"], doc["filename"]
-                        )
-                        chat.delete_message(
-                            chat.message["reply_to_message"]["message_id"]
+                    # Unique local name, the file waits in the queue
+                    async with limits.transfer():
+                        local_file = await download_file(
+                            settings.DOCS_TMP_PATH,
+                            "{}_{}_{}".format(
+                                chat.id, chat.message["message_id"], doc_name
+                            ),
+                            file_id,
                         )
-                        chat.send_text(doc_fmt, parse_mode="HTML")
-            except xmlrpc.client.Fault as err:
-                if "name" in err.faultString:
-                    logger.error("%s (%s)", err.faultString, doc_name)
-                    chat.send_text(
-                        "❌  Формат файла запрещен к загрузке в настройках GLPI!"
+                    await queue_write(
+                        chat,
+                        "document",
+                        ticket_id.group(1),
+                        name=doc_name,
+                        path=local_file,
+                        content=content,
                     )
-                else:
-                    logger.error("something wrong here")
-                    chat.send_text("❌  Что-то пошло не так, документ не добавлен!")
-                    raise err
+            except admission.Busy:
+                raise
             except:  # noqa
+                logger.error("something wrong here (%s)", doc_name)
+                chat.send_text("❌  Что-то пошло не так, документ не добавлен!")
                 raise
         else:
             chat.send_text(
@@ -873,11 +1780,11 @@ async def document_add(chat, document):  # FIXME
 
 
 @bot.command(r"/newticket\s+(.*)")
+@admitted
 async def new_ticket_cmd(chat, match):
     sender_id = chat.sender["id"]
-    logger.debug(match.group(1))
     ticket = [part.strip() for part in match.group(1).split("###")]
-    logger.debug(ticket)
+    logger.debug("New ticket: %s", logs.Payload(ticket))
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
         attrs = {"title": ticket[0], "content": ticket[1], "source": "Telegram"}
         res = await glpi_api_call("createTicket", sender_id, chat, **attrs)
@@ -886,10 +1793,13 @@ async def new_ticket_cmd(chat, match):
 
 
 @bot.command(r"/ticket\s+(\d+)")
+@admitted
 async def ticket_cmd(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        res = await glpi_api_call("getTicket", sender_id, chat, ticket=match.group(1))
+        res = await glpi_api_call(
+            "getTicket", sender_id, chat, ticket=match.group(1), id2name=True
+        )
         if res:
             txt = str(res)
             if len(txt) > 4095:
@@ -902,6 +1812,7 @@ async def ticket_cmd(chat, match):
 
 
 @bot.command(r"/obj\s+(\w+)\s+(\d+)")
+@admitted
 async def object_cmd(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
@@ -915,12 +1826,89 @@ async def object_cmd(chat, match):
 async def status(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        res = await glpi_api_call("status", sender_id, chat)
-        if res:
-            chat.send_text(str(res))
+        # From the health probe, so it answers at once even if GLPI hangs
+        chat.send_text(
+            "\n\n".join(
+                utils.format_health(
+                    backend.name,
+                    backend.health.stats(),
+                    backend.breaker.state,
+                    backend.health.result,
+                )
+                for backend in instances
+            ),
+            parse_mode="HTML",
+        )
+
+
+@bot.command(r"/traffic")
+async def traffic_cmd(chat, match):
+    sender_id = chat.sender["id"]
+    if str(sender_id) in settings.BOT_USERS_CHAT_ID:
+        chat.send_text(
+            "{}\n\n{}".format(
+                utils.format_traffic(traffic.stats()),
+                utils.format_workers(
+                    dict(
+                        executors.stats(),
+                        **{b.pool.name: b.pool.stats() for b in instances}
+                    )
+                ),
+            ),
+            parse_mode="HTML",
+        )
+
+
+async def diag_report():
+    caches = {
+        "sessions": sessions.stats(),
+        "rendering": {"size": len(rendering)},
+        "outbox": outbox.stats(),
+    }
+    for backend in instances:
+        caches["responses:{}".format(backend.name)] = backend.responses.stats()
+    for name, module in (("dictionaries", dictionaries), ("stats", ticket_stats)):
+        total = module.counters["hit"] + module.counters["miss"]
+        caches[name] = dict(
+            module.counters,
+            hit_rate=round(module.counters["hit"] / total, 3) if total else None,
+        )
+    return await diagnostics.report(
+        pool, settings.DOCS_TMP_PATH, caches, telegram.latencies.stats()
+    )
+
+
+@bot.command(r"/diag(?:\s+(\w+))?(?:\s+(\d+))?")
+async def diag(chat, match):
+    sender_id = chat.sender["id"]
+    if str(sender_id) not in settings.BOT_ADMINS:
+        return
+    action = match.group(1)
+    if action == "trace":
+        tracemalloc.start()
+        chat.send_text("tracemalloc включен")
+    elif action == "untrace":
+        tracemalloc.stop()
+        chat.send_text("tracemalloc выключен")
+    elif action == "profile":
+        seconds = min(int(match.group(2) or 10), settings.DIAG_PROFILE_MAX)
+        chat.send_text("Профилирование {} с...".format(seconds))
+        try:
+            res = await diagnostics.profile(seconds)
+        except RuntimeError:
+            chat.send_text("Профилирование уже запущено")
+            return
+        chat.send_text(
+            "<pre>{}</pre>".format(html.escape(res[:3900])), parse_mode="HTML"
+        )
+    else:
+        chat.send_text(
+            diagnostics.format_report(await diag_report()), parse_mode="HTML"
+        )
 
 
 @bot.command(r"/test")
+@admitted
 async def test(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
@@ -930,24 +1918,115 @@ async def test(chat, match):
 
 
 @bot.command(r"/profile")
+@admitted
 async def profile(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        res = await glpi_api_call("getMyInfo", sender_id, chat)
+        res = await glpi_api_call("getMyInfo", sender_id, chat, id2name=True)
         if res:
             chat.send_text(str(res))
 
 
 @bot.command(r"/logout")
+@admitted
 async def logout_cmd(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
         res = await glpi_api_call("doLogout", sender_id, chat)
         if res:
-            await utils.set_user_field(pool, sender_id, "glpi_session", "")
+            await user_state.update(pool, sender_id, session="", credential="")
             chat.send_text(res["message"])
 
 
+@bot.command(r"/digest(?:\s+(.+))?")
+async def digest_cmd(chat, match):
+    sender_id = chat.sender["id"]
+    if str(sender_id) in settings.BOT_USERS_CHAT_ID:
+        arg = (match.group(1) or "").strip()
+        state = await user_state.load(pool, sender_id)
+        try:
+            if arg.lower() == "off":
+                await digests.unsubscribe(pool, sender_id)
+            elif arg.lower() == "on":
+                await digests.subscribe(
+                    pool,
+                    sender_id,
+                    settings.DIGEST_TIME,
+                    state["timezone"] or settings.DIGEST_TIMEZONE,
+                )
+            elif arg.lower().startswith("tz "):
+                timezone = digests.parse_timezone(arg[3:])
+                await user_state.update(
+                    pool, sender_id, timezone=digests.format_timezone(timezone)
+                )
+            elif arg:
+                await digests.subscribe(
+                    pool,
+                    sender_id,
+                    arg,
+                    state["timezone"] or settings.DIGEST_TIMEZONE,
+                )
+        except ValueError:
+            chat.send_text("Не понял 🤷" + settings.DIGEST_TEXT)
+            return
+        state = await user_state.load(pool, sender_id)
+        timezone = state["timezone"] or settings.DIGEST_TIMEZONE
+        if state["digest"]:
+            text = "Сводка приходит в {} (UTC{})".format(state["digest"], timezone)
+        else:
+            text = "Сводка выключена, часовой пояс UTC{}".format(timezone)
+        chat.send_text(text + "\n" + settings.DIGEST_TEXT)
+
+
+@bot.command(r"/region")
+async def region_cmd(chat, match):
+    sender_id = chat.sender["id"]
+    if str(sender_id) in settings.BOT_USERS_CHAT_ID:
+        if len(instances) < 2:
+            chat.send_text("Сервер GLPI только один")
+            return
+        active = (await user_backend(sender_id)).name
+        markup = {
+            "type": "InlineKeyboardMarkup",
+            "inline_keyboard": [
+                [
+                    {
+                        "type": "InlineKeyboardButton",
+                        "text": "{}{}".format(
+                            "✅ " if backend.name == active else "", backend.name
+                        ),
+                        "callback_data": "cb_backend_{}_set".format(backend.name),
+                    }
+                ]
+                for backend in instances
+            ],
+        }
+        chat.send_text("Сервер GLPI", reply_markup=json.dumps(markup))
+
+
+@bot.callback(r"cb_backend_(\w+)_set")
+async def region_set(chat, cq, match):
+    sender_id = cq.src["from"]["id"]
+    if str(sender_id) in settings.BOT_USERS_CHAT_ID:
+        name = match.group(1)
+        if name not in instances.backends:
+            return
+        if name != (await user_backend(sender_id)).name:
+            # Session, credential and entities belong to the other instance
+            await user_state.update(
+                pool,
+                sender_id,
+                backend=name,
+                session="",
+                credential="",
+                entity="",
+                profiles_id="",
+            )
+            await pool.delete(storage.key(user_state.ENTITIES, sender_id))
+            sessions.forget(sender_id)
+        await reauth_msg(sender_id, chat)
+
+
 @bot.command(r"/force_test")
 async def force_test(chat, match):
     sender_id = chat.sender["id"]
@@ -958,14 +2037,19 @@ async def force_test(chat, match):
 
 @bot.command(r"/menu")
 @bot.command(r"/start")
+@admitted
 async def start(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        if await utils.get_user_field(pool, sender_id, "glpi_session"):
-            markup = keyboard.DEFAULT
+        state = await user_state.load(pool, sender_id)
+        if state["session"]:
+            markup = keyboard.default(
+                await ticket_counters(sender_id, chat),
+                (await user_backend(sender_id)).url,
+            )
             chat.send_text("Меню", reply_markup=json.dumps(markup))
         else:
-            login_name = await utils.get_user_field(pool, sender_id, "glpi_name")
+            login_name = state["name"]
             markup = keyboard.LOGIN
             if login_name:
                 markup["inline_keyboard"][0][0][
@@ -981,26 +2065,22 @@ async def start(chat, match):
 
 
 @bot.default
+@admitted
 async def default(chat, match):
     sender_id = chat.sender["id"]
     if str(sender_id) in settings.BOT_USERS_CHAT_ID:
-        # pprint.pprint(dir(chat))
-        # pprint.pprint(chat.message.keys())
-        # pprint.pprint(chat.message['text'])
         if "reply_to_message" in chat.message.keys():
             try:
-                session = await utils.get_user_field(pool, sender_id, "glpi_session")
-                users_login = await utils.get_user_field(pool, sender_id, "glpi_name")
                 bot_message_text = chat.message["reply_to_message"]["text"]
                 ticket_id = re.search(r"#(\d+)", bot_message_text)
 
                 if bot_message_text.startswith("Комментарий"):
-                    await ticket_followup_add(
-                        chat, session, users_login, ticket_id.group(1)
-                    )
+                    await ticket_followup_add(chat, ticket_id.group(1))
 
                 if bot_message_text.startswith("Решение"):
-                    await ticket_solution_add(chat, session, ticket_id.group(1))
+                    await ticket_solution_add(chat, ticket_id.group(1))
+            except admission.Busy:
+                raise
             except:  # noqa
                 logger.error("something wrong here")
                 chat.send_text("❌  Что-то пошло не так, комментарий не добавлен!")
@@ -1008,9 +2088,6 @@ async def default(chat, match):
 
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        format="%(asctime)s [%(levelname)8s] [%(name)s:%(lineno)s:%(funcName)20s()] --- %(message)s",
-        level=logging.DEBUG,
-    )
+    logs.setup(settings.LOG_LEVEL, settings.LOG_LEVELS, settings.LOG_DEBUG_SAMPLE)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.gather(bot.loop(), main()))
+    loop.run_until_complete(Application().run())
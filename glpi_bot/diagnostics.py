@@ -0,0 +1,246 @@
+import asyncio
+import cProfile
+import html
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import shutil
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+_profiling = False
+
+
+def rss():
+    """
+    :return: resident set size of the process in bytes
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak instead of current size, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def top_allocations(limit=10):
+    """
+    :type limit: int
+    :param limit: number of allocation sites
+    :return: biggest allocation sites or None if tracemalloc is off
+    :rtype: list
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )
+    )
+    return [
+        {"site": str(stat.traceback), "size": stat.size, "count": stat.count}
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+def redis_pool(pool):
+    """
+    :return: connection counts of aioredis pool, None for Redis Cluster
+    :rtype: dict
+    """
+    conn = getattr(pool, "connection", None)
+    if not hasattr(conn, "freesize"):
+        return None
+    return {
+        "size": conn.size,
+        "free": conn.freesize,
+        "min": conn.minsize,
+        "max": conn.maxsize,
+    }
+
+
+def disk(path):
+    """
+    :type path: str
+    :param path: directory with temporary files
+    :return: files size in the directory and free space of its disk
+    :rtype: dict
+    """
+    if not path or not os.path.isdir(path):
+        return None
+    files = 0
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            files += 1
+            size += entry.stat().st_size
+    usage = shutil.disk_usage(path)
+    return {"files": files, "size": size, "free": usage.free, "total": usage.total}
+
+
+async def report(pool, docs_path, caches, latencies=None):
+    """
+    :type docs_path: str
+    :type caches: dict
+    :type latencies: dict
+    :param pool: Redis pool
+    :param docs_path: directory with temporary files
+    :param caches: stats of in-process caches by name
+    :param latencies: percentiles of user-facing latencies by name
+    :return: state of the process
+    :rtype: dict
+    """
+    loop = asyncio.get_event_loop()
+    return {
+        "rss": rss(),
+        "tasks": len(asyncio.all_tasks()),
+        "redis_pool": redis_pool(pool),
+        "disk": await loop.run_in_executor(None, disk, docs_path),
+        "caches": caches,
+        "latencies": latencies or {},
+        "allocations": top_allocations(),
+    }
+
+
+async def profile(seconds, limit=25):
+    """
+    Profile everything the event loop runs for a while
+
+    :type seconds: float
+    :type limit: int
+    :param seconds: profiling time
+    :param limit: number of functions in the report
+    :return: functions by cumulative time
+    :rtype: str
+    """
+    global _profiling
+    if _profiling:
+        raise RuntimeError("Profiling is already running")
+    _profiling = True
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+        await asyncio.sleep(seconds)
+    finally:
+        prof.disable()
+        _profiling = False
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def _size(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024 or unit == "GB":
+            return "{:.0f} {}".format(value, unit)
+        value /= 1024
+
+
+def format_report(data):
+    """
+    :type data: dict
+    :param data: result of report()
+    :return: report for Telegram
+    :rtype: str
+    """
+    lines = [
+        "<b>Память:</b> {}".format(_size(data["rss"])),
+        "<b>Задачи asyncio:</b> {}".format(data["tasks"]),
+    ]
+    if data["redis_pool"]:
+        lines.append(
+            "<b>Redis:</b> {size} соединений, свободно {free} (от {min} до {max})".format(
+                **data["redis_pool"]
+            )
+        )
+    if data["disk"]:
+        lines.append(
+            "<b>Временные файлы:</b> {} ({}), на диске свободно {} из {}".format(
+                data["disk"]["files"],
+                _size(data["disk"]["size"]),
+                _size(data["disk"]["free"]),
+                _size(data["disk"]["total"]),
+            )
+        )
+    lines.append("<b>Кэши:</b>")
+    for name, stats in sorted(data["caches"].items()):
+        lines.append(
+            "<code>{}</code> {}".format(
+                name, ", ".join("{} {}".format(k, v) for k, v in stats.items())
+            )
+        )
+    if data["latencies"]:
+        lines.append("<b>Отклик:</b>")
+        for name, stats in sorted(data["latencies"].items()):
+            lines.append(
+                "<code>{}</code> p50 {} с, p95 {} с ({})".format(
+                    name, stats["p50"], stats["p95"], stats["count"]
+                )
+            )
+    if data["allocations"] is None:
+        lines.append("tracemalloc выключен, включить: /diag trace")
+    else:
+        lines.append("<b>Выделения памяти:</b>")
+        for item in data["allocations"]:
+            lines.append(
+                "<code>{}</code> {} ({})".format(
+                    html.escape(item["site"]), _size(item["size"]), item["count"]
+                )
+            )
+    return "\n".join(lines)
+
+
+async def serve(host, port, collect, max_seconds=60):
+    """
+    Local HTTP endpoint with the same data as /diag:
+
+    GET /diag - report as JSON
+    GET /diag/profile?seconds=10 - CPU profile of live traffic
+    GET /diag/trace?on=1 - start or stop tracemalloc
+
+    :type host: str
+    :type port: int
+    :type max_seconds: int
+    :param collect: coroutine function returning report()
+    :param max_seconds: longest allowed profile
+    :return: aiohttp runner
+    """
+    from aiohttp import web
+
+    async def diag(request):
+        return web.Response(
+            text=json.dumps(await collect(), indent=2), content_type="application/json"
+        )
+
+    async def diag_profile(request):
+        try:
+            seconds = min(float(request.query.get("seconds", 10)), max_seconds)
+        except ValueError:
+            return web.Response(status=400, text="seconds must be a number")
+        try:
+            return web.Response(text=await profile(seconds))
+        except RuntimeError as err:
+            return web.Response(status=409, text=str(err))
+
+    async def diag_trace(request):
+        if request.query.get("on", "1") == "1":
+            tracemalloc.start()
+        else:
+            tracemalloc.stop()
+        return web.Response(text="tracemalloc: {}".format(tracemalloc.is_tracing()))
+
+    app = web.Application()
+    app.router.add_get("/diag", diag)
+    app.router.add_get("/diag/profile", diag_profile)
+    app.router.add_get("/diag/trace", diag_trace)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Diagnostics on http://%s:%s/diag", host, port)
+    return runner
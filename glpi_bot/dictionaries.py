@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from collections import Counter
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+KEY = "dict:{}:{{{}}}"
+# Seconds a failed load isn't retried, IDs are shown meanwhile
+FAILED_TTL = 60
+
+_locks = {}
+# Lookups of IDs found in the dictionary and fetched one by one, loads
+# and lookups answered with IDs after a failed load
+counters = Counter()
+
+
+def display_name(itemtype, obj):
+    """
+    :type itemtype: str
+    :type obj: dict
+    :param itemtype: GLPI item type
+    :param obj: GLPI object
+    :return: name as GLPI shows it with id2name
+    :rtype: str
+    """
+    if itemtype == "User":
+        name = "{} {}".format(obj.get("realname") or "", obj.get("firstname") or "")
+        return name.strip() or obj.get("name") or ""
+    return obj.get("completename") or obj.get("name") or ""
+
+
+async def load(pool, fetch, namespace, itemtype, ttl, page):
+    """
+    Load the whole dictionary of item type to Redis, replacing the old one
+
+    :type fetch: callable
+    :type namespace: str
+    :type itemtype: str
+    :type ttl: int
+    :type page: int
+    :param fetch: coroutine function calling GLPI API method
+    :param namespace: GLPI instance the IDs belong to
+    :param itemtype: GLPI item type
+    :param ttl: seconds to keep the dictionary
+    :param page: objects per listObjects call
+    :return: False if GLPI failed
+    :rtype: bool
+    """
+    key = storage.key(KEY, namespace, itemtype)
+    names = {}
+    start = 0
+    while True:
+        res = await fetch("listObjects", itemtype=itemtype, start=start, limit=page)
+        if not isinstance(res, list):
+            logger.warning("Can't load %s dictionary: %s", itemtype, res)
+            # Lookups don't retry the heavy load while GLPI struggles
+            await pool.set("{}:failed".format(key), 1, expire=FAILED_TTL)
+            return False
+        for obj in res:
+            names[str(obj["id"])] = display_name(itemtype, obj)
+        if len(res) < page:
+            break
+        start += page
+
+    # Same hash tag, so it can be renamed in Redis Cluster
+    loading = "{}:loading".format(key)
+    tr = (await storage.node(pool, key)).multi_exec()
+    tr.delete(loading)
+    if names:
+        tr.hmset_dict(loading, names)
+        tr.rename(loading, key)
+        tr.expire(key, ttl)
+    await tr.execute()
+    logger.debug("Loaded %s %s names", len(names), itemtype)
+    return True
+
+
+async def names(pool, fetch, namespace, itemtype, ids, ttl=3600, page=500):
+    """
+    Resolve IDs to names from the dictionary shared in Redis, loading it
+    when it has expired and fetching objects that are not in it yet
+
+    :type fetch: callable
+    :type namespace: str
+    :type itemtype: str
+    :type ids: list
+    :type ttl: int
+    :type page: int
+    :param fetch: coroutine function calling GLPI API method
+    :param namespace: GLPI instance the IDs belong to
+    :param itemtype: GLPI item type
+    :param ids: IDs of objects
+    :param ttl: seconds to keep the dictionary
+    :param page: objects per listObjects call
+    :return: names by ID as str, unknown objects are named by their ID,
+        all of them for a while after the dictionary failed to load
+    :rtype: dict
+    """
+    ids = sorted({str(i) for i in ids if i not in (None, "", 0, "0")})
+    if not ids:
+        return {}
+    key = storage.key(KEY, namespace, itemtype)
+
+    if key not in _locks:
+        _locks[key] = asyncio.Lock()
+    async with _locks[key]:
+        if not await pool.exists(key):
+            if await pool.exists("{}:failed".format(key)):
+                counters["failed"] += 1
+                return {id_: "#{}".format(id_) for id_ in ids}
+            counters["load"] += 1
+            if not await load(pool, fetch, namespace, itemtype, ttl, page):
+                return {id_: "#{}".format(id_) for id_ in ids}
+
+    found = dict(zip(ids, await pool.hmget(key, *ids)))
+    for id_, name in found.items():
+        if name is not None:
+            counters["hit"] += 1
+            continue
+        counters["miss"] += 1
+        # Created after the dictionary was loaded
+        obj = await fetch("getObject", itemtype=itemtype, id=id_, show_name=True)
+        if isinstance(obj, dict):
+            name = display_name(itemtype, obj)
+            await pool.hset(key, id_, name)
+            if await pool.ttl(key) == -1:
+                # Dictionary expired meanwhile, don't keep the stub forever
+                await pool.expire(key, ttl)
+        found[id_] = name or "#{}".format(id_)
+    return found
@@ -0,0 +1,270 @@
+import asyncio
+import datetime
+import html
+import logging
+import re
+from collections import defaultdict
+
+import storage
+import ticket_stats
+import user_state
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBERS = "digest:subscribers"
+# Claimed slot of a user, so each digest is sent once by one replica
+SENT = "digest:sent:{}:{}"
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_times(value):
+    """
+    :type value: str
+    :param value: local times, like "09:00" or "08:00,20:00" for shifts
+    :return: sorted times
+    :rtype: list
+    :raises ValueError: value is not a list of times
+    """
+    times = {
+        datetime.datetime.strptime(item.strip(), "%H:%M").time()
+        for item in value.split(",")
+        if item.strip()
+    }
+    if not times:
+        raise ValueError("No digest times in {!r}".format(value))
+    return sorted(times)
+
+
+def parse_timezone(value):
+    """
+    :type value: str
+    :param value: UTC offset, like "+05:00", "+5" or "UTC-3"
+    :return: time zone
+    :rtype: datetime.timezone
+    :raises ValueError: value is not an offset
+    """
+    value = value.strip().upper()
+    if value in ("UTC", "GMT", "Z"):
+        return datetime.timezone.utc
+    match = re.match(r"^(?:UTC|GMT)?([+-])(\d{1,2})(?::?(\d{2}))?$", value)
+    if not match:
+        raise ValueError("Not a UTC offset: {!r}".format(value))
+    sign, hours, minutes = match.groups()
+    offset = datetime.timedelta(hours=int(hours), minutes=int(minutes or 0))
+    if offset > datetime.timedelta(hours=14):
+        raise ValueError("UTC offset out of range: {!r}".format(value))
+    return datetime.timezone(-offset if sign == "-" else offset)
+
+
+def format_timezone(tz):
+    """
+    :type tz: datetime.timezone
+    :return: offset as "+05:00"
+    :rtype: str
+    """
+    minutes = int(tz.utcoffset(None).total_seconds() // 60)
+    sign = "-" if minutes < 0 else "+"
+    return "{}{:02d}:{:02d}".format(sign, *divmod(abs(minutes), 60))
+
+
+def slots(times, tz, now):
+    """
+    :type times: list
+    :type tz: datetime.timezone
+    :type now: datetime.datetime
+    :param times: local digest times
+    :param tz: time zone of the user
+    :param now: aware current time
+    :return: the latest digest time up to now and the one before it
+    :rtype: tuple
+    """
+    local = now.astimezone(tz)
+    candidates = (
+        datetime.datetime.combine(local.date() + datetime.timedelta(days=d), t, tz)
+        for d in (-1, 0)
+        for t in times
+    )
+    past = sorted(c for c in candidates if c <= local)
+    slot = past[-1]
+    previous = past[-2] if len(past) > 1 else slot - datetime.timedelta(days=1)
+    return slot, previous
+
+
+def collect(tickets, user_id, since, now):
+    """
+    Pick tickets of one user from the tickets of the entity
+
+    :type tickets: list
+    :type user_id: int
+    :type since: datetime.datetime
+    :type now: datetime.datetime
+    :param tickets: unresolved tickets from listTickets
+    :param user_id: GLPI user ID
+    :param since: naive local time of the previous digest
+    :param now: naive local time to check overdue tickets against
+    :return: assigned, overdue and updated tickets
+    :rtype: dict
+    """
+    digest = {"assigned": [], "overdue": [], "updated": []}
+    since = since.strftime(DATE_FORMAT)
+    for ticket in tickets:
+        if str(user_id) not in ticket_stats.assignees(ticket):
+            continue
+        digest["assigned"].append(ticket)
+        if ticket_stats.is_overdue(ticket, now):
+            digest["overdue"].append(ticket)
+        # Same format compares as strings
+        if (ticket.get("date_mod") or "") >= since:
+            digest["updated"].append(ticket)
+    return digest
+
+
+def format_digest(digest, limit=10):
+    """
+    :type digest: dict
+    :type limit: int
+    :param digest: result of collect()
+    :param limit: tickets in each section
+    :return: message text in HTML
+    :rtype: str
+    """
+    if not digest["assigned"]:
+        return "<b>Сводка по заявкам</b>\nНазначенных заявок нет 🎉"
+    lines = [
+        "<b>Сводка по заявкам</b>",
+        "Назначено: {}, просрочено: {}, обновлено: {}".format(
+            len(digest["assigned"]), len(digest["overdue"]), len(digest["updated"])
+        ),
+    ]
+    for section, title in (
+        ("overdue", "🔥 Просроченные"),
+        ("updated", "✏️ Обновленные"),
+        ("assigned", "👨‍💻 Назначенные"),
+    ):
+        tickets = digest[section]
+        if not tickets:
+            continue
+        lines += ["", "<b>{}</b>".format(title)]
+        for ticket in tickets[:limit]:
+            lines.append("#{} {}".format(ticket["id"], html.escape(ticket["name"])))
+        if len(tickets) > limit:
+            lines.append("и еще {}".format(len(tickets) - limit))
+    return "\n".join(lines)
+
+
+async def subscribe(pool, sender_id, times, timezone):
+    """
+    :type sender_id: int
+    :type times: str
+    :type timezone: str
+    :param sender_id: ID of chat user
+    :param times: local digest times, like "08:00,20:00"
+    :param timezone: UTC offset of the user
+    :raises ValueError: times or time zone are not valid
+    """
+    times = ",".join(t.strftime("%H:%M") for t in parse_times(times))
+    timezone = format_timezone(parse_timezone(timezone))
+    await user_state.update(pool, sender_id, digest=times, timezone=timezone)
+    await pool.sadd(storage.key(SUBSCRIBERS), sender_id)
+
+
+async def unsubscribe(pool, sender_id):
+    await user_state.update(pool, sender_id, digest="")
+    await pool.srem(storage.key(SUBSCRIBERS), sender_id)
+
+
+async def send_due(pool, fetch, send, catch_up, default_timezone, limit=10):
+    """
+    Send digests that are due now, with one ticket query for all users
+    of an entity
+
+    :type fetch: callable
+    :type send: callable
+    :type catch_up: float
+    :type default_timezone: str
+    :type limit: int
+    :param fetch: coroutine function taking members of an entity as lists
+        of user ID, state, digest time and previous digest time, returns
+        unresolved tickets of the entity or None if GLPI failed
+    :param send: function taking chat ID and message text
+    :param catch_up: seconds after the digest time it may still be sent
+    :param default_timezone: UTC offset of users who haven't set theirs
+    :param limit: tickets in each section
+    :return: number of sent digests
+    :rtype: int
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    groups = defaultdict(list)
+    for sender_id in await pool.smembers(storage.key(SUBSCRIBERS)):
+        state = await user_state.load(pool, sender_id)
+        if not state["digest"] or not state["session"]:
+            continue
+        try:
+            tz = parse_timezone(state["timezone"] or default_timezone)
+            slot, previous = slots(parse_times(state["digest"]), tz, now)
+        except ValueError as err:
+            logger.warning("Digest of %s is misconfigured: %s", sender_id, err)
+            continue
+        if (now - slot).total_seconds() > catch_up:
+            continue
+        sent = storage.key(SENT, sender_id, int(slot.timestamp()))
+        if not await pool.set(sent, 1, expire=2 * 86400, exist=pool.SET_IF_NOT_EXIST):
+            continue
+        # Users without a chosen entity see their own default entities
+        scope = ticket_stats.scope_of(state["entity"], sender_id)
+        groups[state["backend"], scope].append((int(sender_id), state, slot, previous))
+
+    count = 0
+    local_now = now.astimezone().replace(tzinfo=None)
+    unsent = {m[0]: m[2] for members in groups.values() for m in members}
+    try:
+        for (backend, scope), members in groups.items():
+            try:
+                tickets = await fetch(members)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # noqa
+                logger.exception("Digest query of %s/%s failed", backend, scope)
+                tickets = None
+            if tickets is None:
+                logger.warning("Digests of %s/%s postponed", backend, scope)
+                continue
+            for sender_id, state, slot, previous in members:
+                digest = collect(
+                    tickets,
+                    state["id"],
+                    previous.astimezone().replace(tzinfo=None),
+                    local_now,
+                )
+                send(sender_id, format_digest(digest, limit))
+                del unsent[sender_id]
+                count += 1
+    finally:
+        # Release the slots of digests not sent, so the next run tries again
+        for sender_id, slot in unsent.items():
+            await pool.delete(storage.key(SENT, sender_id, int(slot.timestamp())))
+    if count:
+        logger.info("Sent %s digests for %s entities", count, len(groups))
+    return count
+
+
+async def scheduler(
+    pool, fetch, send, interval, catch_up, default_timezone, limit, stopping=None
+):
+    """
+    Check due digests every interval seconds, see send_due(). Returns
+    when stopping is set, but not in the middle of a run, so claimed
+    digests are sent.
+    """
+    stopping = stopping or asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(stopping.wait(), interval)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await send_due(pool, fetch, send, catch_up, default_timezone, limit)
+        except Exception:  # noqa
+            logger.exception("Digests failed")
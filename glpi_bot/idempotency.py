@@ -0,0 +1,85 @@
+import hashlib
+import json
+import logging
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+UPDATE = "update:{}"
+# Offset and unhandled updates left by a stopped process for the next one
+OFFSET = "telegram:offset"
+PENDING = "telegram:pending"
+
+
+async def first_time(pool, update_id, ttl):
+    """
+    Record the update as processed
+
+    :type update_id: int
+    :type ttl: int
+    :param update_id: Telegram update ID
+    :param ttl: seconds to remember the update
+    :return: False if the update was already processed, here or by
+        another replica
+    :rtype: bool
+    """
+    return bool(
+        await pool.set(
+            storage.key(UPDATE, update_id),
+            1,
+            expire=ttl,
+            exist=pool.SET_IF_NOT_EXIST,
+        )
+    )
+
+
+async def hand_over(pool, offset, updates, ttl):
+    """
+    Save where the stopped process left off, so the next one neither
+    polls handled updates again nor loses received ones
+
+    :type offset: int
+    :type updates: list
+    :type ttl: int
+    :param offset: ID of the last received update
+    :param updates: received updates that weren't handled in time
+    :param ttl: seconds to keep them, Telegram update IDs restart after
+        a long pause
+    """
+    for update in updates:
+        # Handled again by the next process, first_time() mustn't skip it
+        await pool.delete(storage.key(UPDATE, update["update_id"]))
+        await pool.rpush(storage.key(PENDING), json.dumps(update))
+    if updates:
+        await pool.expire(storage.key(PENDING), ttl)
+    await pool.set(storage.key(OFFSET), offset, expire=ttl)
+    logger.info("Handed over offset %s and %s updates", offset, len(updates))
+
+
+async def take_over(pool):
+    """
+    :return: offset and unhandled updates of the previous process
+    :rtype: tuple
+    """
+    offset = await pool.get(storage.key(OFFSET))
+    updates = []
+    while True:
+        raw = await pool.lpop(storage.key(PENDING))
+        if raw is None:
+            break
+        updates.append(json.loads(raw))
+    return int(offset or 0), updates
+
+
+def write_id(*parts):
+    """
+    Idempotency key of a GLPI write, the same for the same message
+    delivered again
+
+    :param parts: message identity and content of the write
+    :return: SHA1 of the parts
+    :rtype: str
+    """
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
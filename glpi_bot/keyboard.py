@@ -1,4 +1,7 @@
+import copy
+
 import settings
+import utils
 
 DEFAULT = {
     "type": "InlineKeyboardMarkup",
@@ -28,7 +31,7 @@ DEFAULT = {
             {
                 "type": "InlineKeyboardButton",
                 "text": "🔗  Открыть сайт GLPI",
-                "url": settings.API_BASE,
+                "url": next(iter(settings.GLPI_BACKENDS.values()))["url"],
             }
         ],
         [
@@ -58,6 +61,64 @@ BTN_MENU = "🏠  Главное меню"
 BTN_TICKETS = "🔙  Заявки"
 BTN_DESC = "🔙  Описание"
 
+TICKETS = {
+    "type": "InlineKeyboardMarkup",
+    "inline_keyboard": [
+        [
+            {
+                "type": "InlineKeyboardButton",
+                "text": "👨‍💻  Мои заявки",
+                "callback_data": "cb_tickets_mine0",
+            }
+        ],
+        [
+            {
+                "type": "InlineKeyboardButton",
+                "text": "👥  Все нерешенные",
+                "callback_data": "cb_tickets_all_current0",
+            }
+        ],
+        [
+            {
+                "type": "InlineKeyboardButton",
+                "text": "✍️  Новая заявка (не работает)",
+                "callback_data": "cb_tickets",
+            }
+        ],
+        [
+            {
+                "type": "InlineKeyboardButton",
+                "text": BTN_MENU,
+                "callback_data": "cb_menu",
+            }
+        ],
+    ],
+}
+
+
+def loading(callback_data):
+    """
+    Single button shown while a slow render is in progress, tapping it
+    repeats the request if the render never comes
+
+    :type callback_data: str
+    :param callback_data: data of the pressed button
+    :return: InlineKeyboardMarkup
+    :rtype: dict
+    """
+    return {
+        "type": "InlineKeyboardMarkup",
+        "inline_keyboard": [
+            [
+                {
+                    "type": "InlineKeyboardButton",
+                    "text": "⏳  Загрузка…",
+                    "callback_data": callback_data,
+                }
+            ]
+        ],
+    }
+
 
 def pagination(item_count, page_start, page_limit, cb):
     """
@@ -98,3 +159,87 @@ def pagination(item_count, page_start, page_limit, cb):
         if next_start >= item_count:
             markup["inline_keyboard"][0].pop()
     return markup
+
+
+def ticket_buttons(markup, tickets, glpi_user_id=None):
+    """
+    Add a button for each ticket above the last row of the markup
+
+    :type markup: dict
+    :type tickets: list
+    :type glpi_user_id: int
+    :param markup: InlineKeyboardMarkup from pagination
+    :param tickets: tickets from listTickets
+    :param glpi_user_id: mark tickets assigned to this GLPI user
+    :return: InlineKeyboardMarkup
+    :rtype: dict
+    """
+    for ticket in tickets:
+        time_to_resolve = "нет даты"
+        try:
+            time_to_resolve = utils.format_date(ticket["time_to_resolve"])
+        except ValueError:
+            pass
+        button_text = "[{}] {}".format(time_to_resolve, ticket["name"])
+        if glpi_user_id is not None:
+            assign = ticket.get("users", {}).get("assign", [])
+            if str(glpi_user_id) in (str(u.get("users_id")) for u in assign):
+                button_text = "👨‍💻  {}".format(button_text)
+        button_markup = [
+            {
+                "type": "InlineKeyboardButton",
+                "text": button_text,
+                "callback_data": "cb_ticket_{}".format(ticket["id"]),
+            }
+        ]
+        markup["inline_keyboard"].insert(-1, button_markup)
+    return markup
+
+
+def badge(counters, overdue=True):
+    """
+    :type counters: dict
+    :type overdue: bool
+    :param counters: ticket counters
+    :param overdue: show overdue tickets too
+    :return: badge for button text
+    :rtype: str
+    """
+    if counters["overdue"] and overdue:
+        return " ({}, 🔥 {})".format(counters["assigned"], counters["overdue"])
+    return " ({})".format(counters["assigned"])
+
+
+def default(counters=None, url=None):
+    """
+    Main menu with ticket counters on the tickets button
+
+    :type counters: dict
+    :type url: str
+    :param counters: ticket counters of the user
+    :param url: GLPI site of the user, the default one if not set
+    :return: InlineKeyboardMarkup
+    :rtype: dict
+    """
+    markup = copy.deepcopy(DEFAULT)
+    if counters:
+        markup["inline_keyboard"][0][0]["text"] += badge(counters)
+    if url:
+        markup["inline_keyboard"][3][0]["url"] = url
+    return markup
+
+
+def tickets(counters=None):
+    """
+    Tickets menu with ticket counters on the list buttons
+
+    :type counters: dict
+    :param counters: ticket counters of the user
+    :return: InlineKeyboardMarkup
+    :rtype: dict
+    """
+    markup = copy.deepcopy(TICKETS)
+    if counters:
+        markup["inline_keyboard"][0][0]["text"] += badge(counters)
+        markup["inline_keyboard"][1][0]["text"] += " ({})".format(counters["total"])
+    return markup
@@ -0,0 +1,129 @@
+import atexit
+import copy
+import logging
+import pprint
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT = (
+    "%(asctime)s [%(levelname)8s] [%(name)s:%(lineno)s:%(funcName)20s()] "
+    "--- %(message)s"
+)
+# Arguments that can't change after they are logged
+IMMUTABLE = (str, bytes, int, float, bool, type(None))
+
+
+class Payload(object):
+    """
+    Log argument formatted only if the record is emitted, in the logging
+    thread, from a copy taken when it is logged, and cut to limit characters
+    """
+
+    def __init__(self, obj, limit=2000):
+        """
+        :type limit: int
+        :param obj: data to log
+        :param limit: maximum length of formatted data
+        """
+
+        self.obj = obj
+        self.limit = limit
+
+    def snapshot(self):
+        """
+        :return: payload with a copy of the data, which the event loop
+            may change while the logging thread formats it
+        :rtype: Payload
+        """
+        return Payload(copy.deepcopy(self.obj), self.limit)
+
+    def __str__(self):
+        text = pprint.pformat(self.obj, compact=True)
+        if len(text) > self.limit:
+            text = "{}... ({} chars)".format(text[: self.limit], len(text))
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only a share of DEBUG records of noisy loggers or functions
+    """
+
+    def __init__(self, rates):
+        """
+        :type rates: dict
+        :param rates: share of records to pass, 0 to 1, by logger name
+            or logger name and function name, like "bot.entities"
+        """
+
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not self.rates:
+            return True
+        rate = self.rates.get("{}.{}".format(record.name, record.funcName))
+        if rate is None:
+            rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Puts records to the queue leaving formatting of payloads to the
+    listener thread. Other messages are formatted at once, as their
+    arguments may change meanwhile.
+    """
+
+    def prepare(self, record):
+        args = record.args
+        if isinstance(args, tuple) and any(isinstance(a, Payload) for a in args):
+            record.args = tuple(snapshot(arg) for arg in args)
+        elif args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def snapshot(arg):
+    if isinstance(arg, IMMUTABLE):
+        return arg
+    try:
+        return arg.snapshot() if isinstance(arg, Payload) else copy.deepcopy(arg)
+    except Exception:  # noqa
+        # Can't be copied, like locks or sockets, so formatted now
+        return str(arg)
+
+
+def setup(level="INFO", levels=None, sample=None):
+    """
+    Send log records through a queue to a thread writing them to stderr,
+    so logging never blocks the event loop
+
+    :type level: str
+    :type levels: dict
+    :type sample: dict
+    :param level: root logger level
+    :param levels: levels by logger name
+    :param sample: share of DEBUG records to keep by logger name
+    :return: started listener
+    :rtype: QueueListener
+    """
+    records = queue.Queue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(SamplingFilter(sample or {}))
+
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(FORMAT))
+    listener = QueueListener(records, stream, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    for name, name_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(name_level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,256 @@
+import logging
+import math
+import random
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# Flag of a handler task, set when it was served from the stale cache. It
+# is in a list, as subtasks started with gather get a copy of the context.
+stale = ContextVar("stale", default=None)
+
+
+def track_stale():
+    """
+    Start a flag of stale responses shared by the current task and the
+    subtasks it starts after this
+    """
+    stale.set([False])
+
+
+def mark_stale():
+    flag = stale.get()
+    if flag is None:
+        stale.set([True])
+    else:
+        flag[0] = True
+
+
+def is_stale():
+    flag = stale.get()
+    return bool(flag and flag[0])
+
+
+class AdaptiveTimeout(object):
+    """
+    Per-method timeout derived from observed latency, like TCP RTO:
+    smoothed latency plus four mean deviations, clamped to limits
+    """
+
+    def __init__(self, initial, minimum, maximum, maximums=None):
+        """
+        :type initial: float
+        :type minimum: float
+        :type maximum: float
+        :type maximums: dict
+        :param initial: timeout before any latency is observed
+        :param minimum: lower bound for every method
+        :param maximum: default upper bound
+        :param maximums: upper bounds for specific methods
+        """
+
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.maximums = maximums or {}
+        self._srtt = {}
+        self._rttvar = {}
+
+    def get(self, method):
+        maximum = self.maximums.get(method, self.maximum)
+        if method not in self._srtt:
+            return min(max(self.initial, self.minimum), maximum)
+        timeout = self._srtt[method] + 4 * self._rttvar[method]
+        return min(max(timeout, self.minimum), maximum)
+
+    def observe(self, method, elapsed):
+        if method not in self._srtt:
+            self._srtt[method] = elapsed
+            self._rttvar[method] = elapsed / 2
+            return
+        srtt = self._srtt[method]
+        self._rttvar[method] = 0.75 * self._rttvar[method] + 0.25 * abs(srtt - elapsed)
+        self._srtt[method] = 0.875 * srtt + 0.125 * elapsed
+
+
+class CircuitBreaker(object):
+    """
+    Fails calls fast after a run of failures, then lets a single
+    trial call through once the recovery timeout has passed
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, recovery_timeout, name="glpi"):
+        """
+        :type failure_threshold: int
+        :type recovery_timeout: float
+        :type name: str
+        :param failure_threshold: consecutive failures that open the circuit
+        :param recovery_timeout: seconds to wait before a trial call
+        :param name: name of the guarded service for logs
+        """
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+        # Half-open: a trial call is already in flight
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit of %s closed", self.name)
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def release(self):
+        """
+        End a trial call that neither succeeded nor failed, so the next
+        call may try again at once
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic() - self.recovery_timeout
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(
+                    "Circuit of %s opened after %s failures", self.name, self.failures
+                )
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of recent successful responses, used as
+    a fallback while the circuit is open
+    """
+
+    def __init__(self, max_size, max_age):
+        """
+        :type max_size: int
+        :type max_age: float
+        :param max_size: maximum number of cached responses
+        :param max_age: seconds after which a response is dropped
+        """
+
+        self.max_size = max_size
+        self.max_age = max_age
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        stored_at, value = item
+        if time.monotonic() - stored_at > self.max_age:
+            del self._items[key]
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (time.monotonic(), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def stats(self):
+        """
+        :return: size and hit rate
+        :rtype: dict
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+
+class HealthHistory(object):
+    """
+    Results of recent health probes of a service
+    """
+
+    def __init__(self, size):
+        """
+        :type size: int
+        :param size: number of probes to keep
+        """
+
+        self._probes = deque(maxlen=size)
+        self.result = None
+
+    def record(self, ok, latency, result=None):
+        """
+        :type ok: bool
+        :type latency: float
+        :param ok: the service answered
+        :param latency: seconds the probe took
+        :param result: answer of the service, kept from the last good probe
+        """
+        self._probes.append((time.time(), ok, latency))
+        if ok:
+            self.result = result
+
+    def stats(self):
+        """
+        :return: availability, p95 latency of good probes and the last probe
+        :rtype: dict
+        """
+        if not self._probes:
+            return None
+        latencies = sorted(latency for _, ok, latency in self._probes if ok)
+        p95 = None
+        if latencies:
+            p95 = latencies[math.ceil(len(latencies) * 0.95) - 1]
+        checked, ok, latency = self._probes[-1]
+        return {
+            "probes": len(self._probes),
+            "availability": len(latencies) / len(self._probes),
+            "p95": p95,
+            "ok": ok,
+            "latency": latency,
+            "checked": checked,
+        }
+
+
+def retry_delay(attempt, base=0.2, cap=2.0):
+    """
+    Exponential backoff with full jitter
+
+    :type attempt: int
+    :type base: float
+    :type cap: float
+    :param attempt: number of the retry, starting from 0
+    :param base: delay of the first retry
+    :param cap: maximum delay
+    :return: seconds to sleep
+    :rtype: float
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager(object):
+    """
+    Tracks age of users' GLPI sessions and keeps credentials of users
+    who agreed to transparent re-login
+    """
+
+    def __init__(self, lifetime, margin, idle_max, key=None):
+        """
+        :type lifetime: float
+        :type margin: float
+        :type idle_max: float
+        :type key: str
+        :param lifetime: seconds an unused GLPI session stays alive
+        :param margin: refresh a session this many seconds before it expires
+        :param idle_max: stop keeping alive sessions unused for this long
+        :param key: Fernet key for stored credentials, re-login is off without it
+        """
+
+        self.lifetime = lifetime
+        self.margin = margin
+        self.idle_max = idle_max
+        self._key = key
+        self._cipher = None
+        self._refreshed = {}
+        self._used = {}
+        self._locks = {}
+
+    @property
+    def _fernet(self):
+        # Built on first use, so the module-level manager is created
+        # before settings.validate() can report a malformed key
+        if self._cipher is None and self._key:
+            from cryptography.fernet import Fernet
+
+            self._cipher = Fernet(self._key)
+        return self._cipher
+
+    @property
+    def can_relogin(self):
+        return bool(self._key)
+
+    def seal(self, login_name, login_password):
+        """
+        :type login_name: str
+        :type login_password: str
+        :return: encrypted credential token
+        :rtype: str
+        """
+        data = json.dumps([login_name, login_password]).encode("utf-8")
+        return self._fernet.encrypt(data).decode("utf-8")
+
+    def unseal(self, token):
+        """
+        :type token: str
+        :return: login name and password or None if token is not valid
+        :rtype: tuple
+        """
+        if not self._fernet or not token:
+            return None
+        from cryptography.fernet import InvalidToken
+
+        try:
+            return tuple(json.loads(self._fernet.decrypt(token.encode("utf-8"))))
+        except (InvalidToken, ValueError):
+            logger.warning("Stored GLPI credential can't be decrypted")
+            return None
+
+    def lock(self, sender_id):
+        if sender_id not in self._locks:
+            self._locks[sender_id] = asyncio.Lock()
+        return self._locks[sender_id]
+
+    def touch(self, sender_id, used=True):
+        """
+        Record that the session was refreshed on the server by a call
+        """
+        now = time.monotonic()
+        self._refreshed[sender_id] = now
+        if used or sender_id not in self._used:
+            self._used[sender_id] = now
+
+    def forget(self, sender_id):
+        self._refreshed.pop(sender_id, None)
+        self._used.pop(sender_id, None)
+        self._locks.pop(sender_id, None)
+
+    def age(self, sender_id):
+        refreshed = self._refreshed.get(sender_id)
+        return None if refreshed is None else time.monotonic() - refreshed
+
+    def stats(self):
+        """
+        :return: number of tracked sessions and locks
+        :rtype: dict
+        """
+        return {"size": len(self._refreshed), "locks": len(self._locks)}
+
+    def due(self):
+        """
+        :return: users whose sessions have to be refreshed now
+        :rtype: list
+        """
+        now = time.monotonic()
+        due = []
+        for sender_id, refreshed in list(self._refreshed.items()):
+            if now - self._used[sender_id] > self.idle_max:
+                self.forget(sender_id)
+            elif now - refreshed >= self.lifetime - self.margin:
+                due.append(sender_id)
+        return due
@@ -1,4 +1,5 @@
 import os
+import re
 
 from dotenv import load_dotenv
 
@@ -6,14 +7,141 @@ load_dotenv()
 
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD") or None
+REDIS_POOL_MIN = int(os.getenv("REDIS_POOL_MIN", 2))
+REDIS_POOL_MAX = int(os.getenv("REDIS_POOL_MAX", 10))
+# Prefix of all keys, lets several deployments share one Redis
+REDIS_NAMESPACE = os.getenv("REDIS_NAMESPACE", "glpi_bot")
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
+REDIS_CLUSTER_NODES = [
+    "redis://{}".format(node.strip())
+    for node in os.getenv(
+        "REDIS_CLUSTER_NODES", "{}:{}".format(REDIS_HOST, REDIS_PORT)
+    ).split(",")
+    if node.strip()
+]
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Levels of single loggers, like "bot=DEBUG,aiotg=WARNING"
+LOG_LEVELS = dict(
+    item.strip().split("=", 1)
+    for item in os.getenv("LOG_LEVELS", "").split(",")
+    if "=" in item
+)
+# Share of DEBUG records to keep, like "webservices_xmlrpc=0.1,bot.entities=0.5"
+LOG_DEBUG_SAMPLE = {
+    name.strip(): float(rate)
+    for name, rate in (
+        item.split("=", 1)
+        for item in os.getenv("LOG_DEBUG_SAMPLE", "").split(",")
+        if "=" in item
+    )
+}
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-BOT_USERS_CHAT_ID = os.getenv("BOT_USERS_CHAT_ID").split(",")
+BOT_USERS_CHAT_ID = [
+    i.strip() for i in os.getenv("BOT_USERS_CHAT_ID", "").split(",") if i.strip()
+]
 BOT_PROXY_URL = os.getenv("BOT_PROXY_URL")
+# Seconds to remember handled updates, Telegram keeps undelivered ones for a day
+BOT_UPDATE_TTL = int(os.getenv("BOT_UPDATE_TTL", 86400))
+# Seconds to finish in-flight updates and queued messages on SIGTERM,
+# keep it below stop_grace_period of the container
+BOT_SHUTDOWN_TIMEOUT = float(os.getenv("BOT_SHUTDOWN_TIMEOUT", 25))
+# Entities hidden from the entity picker, the ones hidden before it was
+# configurable by default, set it empty to show all
+BOT_EXCLUDED_ENTITIES = frozenset(
+    e.strip()
+    for e in os.getenv("BOT_EXCLUDED_ENTITIES", "12,13,14,15").split(",")
+    if e.strip()
+)
 
 API_BASE = os.getenv("API_BASE")
 API_USER = os.getenv("API_USER")
 API_PASS = os.getenv("API_PASS")
+# GLPI instances, "north,south" reads API_BASE_NORTH, API_USER_NORTH and
+# API_PASS_NORTH and so on. The first one is the default, without the list
+# it is API_BASE, API_USER and API_PASS.
+GLPI_BACKENDS = {
+    name: {
+        "url": os.getenv("API_BASE_{}".format(name.upper())),
+        "user": os.getenv("API_USER_{}".format(name.upper())),
+        "password": os.getenv("API_PASS_{}".format(name.upper())),
+    }
+    for name in (i.strip() for i in os.getenv("GLPI_BACKENDS", "").split(","))
+    if name
+} or {"default": {"url": API_BASE, "user": API_USER, "password": API_PASS}}
+
+GLPI_TIMEOUT = float(os.getenv("GLPI_TIMEOUT", 10))
+GLPI_TIMEOUT_MIN = float(os.getenv("GLPI_TIMEOUT_MIN", 2))
+GLPI_TIMEOUT_MAX = float(os.getenv("GLPI_TIMEOUT_MAX", 30))
+GLPI_DOCUMENT_TIMEOUT_MAX = float(os.getenv("GLPI_DOCUMENT_TIMEOUT_MAX", 120))
+GLPI_RETRIES = int(os.getenv("GLPI_RETRIES", 2))
+GLPI_BREAKER_THRESHOLD = int(os.getenv("GLPI_BREAKER_THRESHOLD", 5))
+GLPI_BREAKER_RECOVERY = float(os.getenv("GLPI_BREAKER_RECOVERY", 30))
+GLPI_STALE_SIZE = int(os.getenv("GLPI_STALE_SIZE", 1000))
+GLPI_STALE_TTL = float(os.getenv("GLPI_STALE_TTL", 3600))
+GLPI_GZIP_RESPONSE = os.getenv("GLPI_GZIP_RESPONSE", "true").lower() == "true"
+# Request bodies bigger than this are gzipped, 0 turns it off
+GLPI_GZIP_REQUEST_THRESHOLD = int(os.getenv("GLPI_GZIP_REQUEST_THRESHOLD", 0))
+GLPI_SESSION_LIFETIME = float(os.getenv("GLPI_SESSION_LIFETIME", 1440))
+GLPI_SESSION_REFRESH_MARGIN = float(os.getenv("GLPI_SESSION_REFRESH_MARGIN", 300))
+GLPI_SESSION_IDLE_MAX = float(os.getenv("GLPI_SESSION_IDLE_MAX", 28800))
+GLPI_SESSION_CHECK_INTERVAL = float(os.getenv("GLPI_SESSION_CHECK_INTERVAL", 60))
+GLPI_CREDENTIALS_KEY = os.getenv("GLPI_CREDENTIALS_KEY")
+GLPI_DICTIONARY_TTL = int(os.getenv("GLPI_DICTIONARY_TTL", 3600))
+GLPI_DICTIONARY_PAGE = int(os.getenv("GLPI_DICTIONARY_PAGE", 500))
+GLPI_MAX_CONCURRENT = int(os.getenv("GLPI_MAX_CONCURRENT", 8))
+GLPI_MAX_TRANSFERS = int(os.getenv("GLPI_MAX_TRANSFERS", 2))
+# Seconds between status calls, they also keep a connection alive
+GLPI_PROBE_INTERVAL = float(os.getenv("GLPI_PROBE_INTERVAL", 15))
+GLPI_PROBE_HISTORY = int(os.getenv("GLPI_PROBE_HISTORY", 240))
+# Idle connections are closed after this many seconds, keep it below
+# the keep-alive timeout of the GLPI web server
+GLPI_KEEPALIVE = float(os.getenv("GLPI_KEEPALIVE", 30))
+
+BOT_STATS_TTL = int(os.getenv("BOT_STATS_TTL", 60))
+BOT_STATS_PAGE = int(os.getenv("BOT_STATS_PAGE", 500))
+BOT_SEND_ALL_CONCURRENCY = int(os.getenv("BOT_SEND_ALL_CONCURRENCY", 3))
+BOT_MAX_USER_IN_FLIGHT = int(os.getenv("BOT_MAX_USER_IN_FLIGHT", 2))
+BOT_ADMISSION_WAIT = float(os.getenv("BOT_ADMISSION_WAIT", 1))
+# Seconds before a slow callback shows "loading" in place of the buttons
+BOT_LOADING_DELAY = float(os.getenv("BOT_LOADING_DELAY", 0.3))
+# Bulk messages per second, Telegram allows about 30
+BOT_SEND_RATE = float(os.getenv("BOT_SEND_RATE", 20))
+
+# Digest time of users who turn digests on without choosing a time
+DIGEST_TIME = os.getenv("DIGEST_TIME", "09:00")
+DIGEST_TIMEZONE = os.getenv("DIGEST_TIMEZONE", "+03:00")
+DIGEST_INTERVAL = float(os.getenv("DIGEST_INTERVAL", 60))
+# Digests missed while the bot was down are sent this many seconds late at most
+DIGEST_CATCH_UP = float(os.getenv("DIGEST_CATCH_UP", 3600))
+DIGEST_MAX_TICKETS = int(os.getenv("DIGEST_MAX_TICKETS", 10))
+
+WORKERS_IO_SIZE = int(os.getenv("WORKERS_IO_SIZE", 4))
+
+WRITE_QUEUE_MAX_ATTEMPTS = int(os.getenv("WRITE_QUEUE_MAX_ATTEMPTS", 50))
+WRITE_QUEUE_RETRY_CAP = float(os.getenv("WRITE_QUEUE_RETRY_CAP", 60))
+WRITE_QUEUE_DONE_TTL = int(os.getenv("WRITE_QUEUE_DONE_TTL", 86400))
+
+# Where to send traces of updates: file, otlp or nowhere if empty
+TRACING_EXPORT = os.getenv("TRACING_EXPORT", "").lower()
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+TRACING_OTLP_ENDPOINT = os.getenv(
+    "TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces"
+)
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", 0.01))
+# Traces longer than this many seconds are always kept, 0 turns it off
+TRACING_SLOW_THRESHOLD = float(os.getenv("TRACING_SLOW_THRESHOLD", 2)) or None
+TRACING_MAX_SPANS = int(os.getenv("TRACING_MAX_SPANS", 500))
+
+# Users allowed to run /diag, a subset of BOT_USERS_CHAT_ID
+BOT_ADMINS = [i.strip() for i in os.getenv("BOT_ADMINS", "").split(",") if i.strip()]
+# Local HTTP endpoint with the same diagnostics, 0 turns it off
+DIAG_HTTP_HOST = os.getenv("DIAG_HTTP_HOST", "127.0.0.1")
+DIAG_HTTP_PORT = int(os.getenv("DIAG_HTTP_PORT", 0))
+DIAG_PROFILE_MAX = int(os.getenv("DIAG_PROFILE_MAX", 60))
 
 LOGIN_THUMB_URL = os.getenv("LOGIN_THUMB_URL")
 
@@ -30,6 +158,10 @@ LOGIN_TEXT = """
 *login* - специальное слово, прямо так и написать login
 *1 пробел* между частями заклинания
 
+Если вместо *login* написать *remember*, бот запомнит пароль в зашифрованном виде \
+и будет сам входить заново, когда сессия GLPI истечет. Обычный *login* или выход \
+из GLPI стирают сохраненный пароль.
+
 Если всё сделал правильно, всплывет такая карточка:
 ```
   | |  Вход в GLPI
@@ -41,6 +173,21 @@ _P.S. Если заходишь через десктоп, то не нажим
 В данном случае это не страшно, просто удали сообщение с ним._
 """
 
+BUSY_TEXT = "⏳  Я занят, попробуй еще раз через пару секунд"
+
+STALE_TEXT = "⚠️  GLPI не отвечает, данные могут быть устаревшими\n\n"
+
+DIGEST_TEXT = """
+Сводка по назначенным, просроченным и обновленным заявкам:
+/digest on - каждый день в {}
+/digest 09:00 - каждый день в 09:00
+/digest 08:00,20:00 - в начале каждой смены
+/digest tz +05:00 - часовой пояс
+/digest off - выключить
+""".format(
+    DIGEST_TIME
+)
+
 ENTITIES_TEXT = (
     "Укажи организацию. От организации зависит, какие заявки и активы будут доступны"
 )
@@ -78,6 +225,19 @@ DOCUMENT_ADDED = """
 чтобы чат стал чище!
 """
 
+WRITE_QUEUED = {
+    "followup": "⏳  Комментарий к заявке #{} в очереди на отправку в GLPI",
+    "solution": "⏳  Решение заявки #{} в очереди на отправку в GLPI",
+    "document": "⏳  Документ к заявке #{} в очереди на отправку в GLPI",
+}
+
+WRITE_FAILED = """
+❌  Не получилось отправить в заявку #{}: {}
+
+Твой текст, чтобы не пропал:
+{}
+"""
+
 HISTORY_TEXT = """
 *{}*, {}
 {}, {}
@@ -92,3 +252,68 @@ TICKET_TEXT = """
 <b>Автор:</b> {}
 <b>Назначено:</b> {}
 """
+
+
+class SettingsError(Exception):
+    """
+    Raised at startup if the configuration can't work
+    """
+
+
+def validate():
+    """
+    Check all settings the bot can't start without, reporting every
+    problem at once
+    """
+    errors = []
+    for name in ("BOT_TOKEN", "DOCS_TMP_PATH"):
+        if not globals()[name]:
+            errors.append("{} is not set".format(name))
+    for name, backend in GLPI_BACKENDS.items():
+        if not re.match(r"^\w+$", name):
+            errors.append("GLPI backend name {} is not a word".format(name))
+        elif not backend["url"]:
+            errors.append("URL of GLPI backend {} is not set".format(name))
+    if not BOT_USERS_CHAT_ID:
+        errors.append("BOT_USERS_CHAT_ID has no users")
+    if REDIS_CLUSTER:
+        if "redis://None:None" in REDIS_CLUSTER_NODES:
+            errors.append("REDIS_CLUSTER_NODES is not set")
+    elif not REDIS_HOST or not REDIS_PORT:
+        errors.append("REDIS_HOST and REDIS_PORT are not set")
+    if not 0 < REDIS_POOL_MIN <= REDIS_POOL_MAX:
+        errors.append("REDIS_POOL_MIN must be from 1 to REDIS_POOL_MAX")
+    if not GLPI_TIMEOUT_MIN <= GLPI_TIMEOUT <= GLPI_TIMEOUT_MAX:
+        errors.append("GLPI_TIMEOUT must be from GLPI_TIMEOUT_MIN to GLPI_TIMEOUT_MAX")
+    if GLPI_SESSION_REFRESH_MARGIN >= GLPI_SESSION_LIFETIME:
+        errors.append("GLPI_SESSION_REFRESH_MARGIN must be less than lifetime")
+    for name in ("GLPI_MAX_CONCURRENT", "GLPI_MAX_TRANSFERS", "WORKERS_IO_SIZE"):
+        if globals()[name] < 1:
+            errors.append("{} must be positive".format(name))
+    if TRACING_EXPORT not in ("", "file", "otlp"):
+        errors.append("TRACING_EXPORT must be file, otlp or empty")
+    if BOT_SEND_RATE <= 0:
+        errors.append("BOT_SEND_RATE must be positive")
+    import digests
+
+    for name, parse in (
+        ("DIGEST_TIME", digests.parse_times),
+        ("DIGEST_TIMEZONE", digests.parse_timezone),
+    ):
+        try:
+            parse(globals()[name])
+        except ValueError as err:
+            errors.append("{}: {}".format(name, err))
+    if not 0 <= TRACING_SAMPLE_RATE <= 1:
+        errors.append("TRACING_SAMPLE_RATE must be from 0 to 1")
+    if set(BOT_ADMINS) - set(BOT_USERS_CHAT_ID):
+        errors.append("BOT_ADMINS must be in BOT_USERS_CHAT_ID")
+    if GLPI_CREDENTIALS_KEY:
+        from cryptography.fernet import Fernet
+
+        try:
+            Fernet(GLPI_CREDENTIALS_KEY)
+        except ValueError:
+            errors.append("GLPI_CREDENTIALS_KEY is not a valid Fernet key")
+    if errors:
+        raise SettingsError("; ".join(errors))
@@ -0,0 +1,68 @@
+import logging
+
+import settings
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+def key(template, *args):
+    """
+    Redis key in the namespace of this deployment. Keys that are used
+    together must have the same hash tag, the part in braces, to be
+    in one Redis Cluster slot.
+
+    :type template: str
+    :param template: key format string, e.g. "user:{{{}}}"
+    :param args: format arguments
+    :return: key
+    :rtype: str
+    """
+    return "{}:{}".format(settings.REDIS_NAMESPACE, template.format(*args))
+
+
+async def connect():
+    """
+    :return: pool of standalone Redis or Redis Cluster client
+    """
+    if not settings.REDIS_CLUSTER:
+        import aioredis
+
+        return await aioredis.create_redis_pool(
+            (settings.REDIS_HOST, settings.REDIS_PORT),
+            commands_factory=type(
+                "TracedRedis", (tracing.RedisMixin, aioredis.Redis), {}
+            ),
+            db=settings.REDIS_DB,
+            password=settings.REDIS_PASSWORD,
+            encoding="utf-8",
+            minsize=settings.REDIS_POOL_MIN,
+            maxsize=settings.REDIS_POOL_MAX,
+        )
+
+    from aioredis_cluster import RedisCluster, create_redis_cluster
+
+    logger.info("Connecting to Redis Cluster %s", settings.REDIS_CLUSTER_NODES)
+    return await create_redis_cluster(
+        settings.REDIS_CLUSTER_NODES,
+        cluster_commands_factory=type(
+            "TracedRedisCluster", (tracing.RedisMixin, RedisCluster), {}
+        ),
+        password=settings.REDIS_PASSWORD,
+        encoding="utf-8",
+        pool_minsize=settings.REDIS_POOL_MIN,
+        pool_maxsize=settings.REDIS_POOL_MAX,
+    )
+
+
+async def node(pool, key_):
+    """
+    Pool of the Redis node holding the key, for blocking commands and
+    WATCH that need a dedicated connection
+
+    :type key_: str
+    :param key_: key the commands will use
+    """
+    if settings.REDIS_CLUSTER:
+        return await pool.keys_master(key_)
+    return pool
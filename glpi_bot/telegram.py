@@ -0,0 +1,424 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import math
+import time
+from collections import defaultdict, deque
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Reaction to the callback query handled in this context
+feedback = contextvars.ContextVar("feedback", default=None)
+# Adds a handler task to the update it handles, see IdempotentMixin
+handling = contextvars.ContextVar("handling", default=None)
+
+
+class IdempotentMixin(object):
+    """
+    Handles each update once, even if Telegram delivers it again after
+    a restart, a webhook retry or to another replica. Keeps updates in
+    flight until their handlers are done, so the bot can stop without
+    losing them.
+    """
+
+    # Coroutine function taking update ID, False for repeated updates
+    first_time = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Update and its unfinished tasks by update ID
+        self._in_flight = {}
+
+    def _process_update(self, update):
+        # Move the offset at once, so getUpdates doesn't return it again
+        self._offset = max(self._offset, update["update_id"])
+        self._in_flight[update["update_id"]] = (update, set())
+        self._track(
+            update["update_id"], asyncio.ensure_future(self._process_new_update(update))
+        )
+
+    def _track(self, update_id, task):
+        self._in_flight[update_id][1].add(task)
+        task.add_done_callback(functools.partial(self._untrack, update_id))
+
+    def _untrack(self, update_id, task):
+        item = self._in_flight.get(update_id)
+        if item is None:
+            return
+        item[1].discard(task)
+        if not item[1]:
+            del self._in_flight[update_id]
+
+    async def _process_new_update(self, update):
+        # Handler tasks are created in this context and inherit the trace
+        tracing.start_trace("update", update_id=update["update_id"])
+        handling.set(functools.partial(self._track, update["update_id"]))
+        if self.first_time and not await self.first_time(update["update_id"]):
+            logger.info("Skipped repeated update %s", update["update_id"])
+            tracing.finish_trace(repeated=True)
+            return
+        super()._process_update(update)
+
+    def resume(self, offset, updates):
+        """
+        Continue from where the previous process stopped
+
+        :type offset: int
+        :type updates: list
+        :param offset: ID of the last update it received
+        :param updates: updates it received but didn't handle
+        """
+        self._offset = max(self._offset, offset)
+        for update in updates:
+            self._process_update(update)
+        if updates:
+            logger.info("Resumed %s updates of the previous process", len(updates))
+
+    async def drain(self, timeout):
+        """
+        Wait for the handlers of received updates, call after polling
+        has stopped
+
+        :type timeout: float
+        :param timeout: seconds to wait
+        :return: updates that weren't handled in time, their handlers
+            are cancelled
+        :rtype: list
+        """
+        deadline = time.monotonic() + timeout
+        while self._in_flight:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            # A handler task may start after the waited ones, so repeat
+            await asyncio.wait(
+                [task for _, tasks in self._in_flight.values() for task in tasks],
+                timeout=left,
+            )
+        unfinished = []
+        for update, tasks in list(self._in_flight.values()):
+            unfinished.append(update)
+            for task in tasks:
+                task.cancel()
+        if unfinished:
+            logger.warning("%s updates not handled before shutdown", len(unfinished))
+        return sorted(unfinished, key=lambda update: update["update_id"])
+
+
+def traced(handler):
+    """
+    End the trace of the update when its handler is done, and keep
+    the update in flight until then
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(*args):
+        track = handling.get()
+        if track is not None:
+            track(asyncio.current_task())
+        tracing.annotate(handler=handler.__name__)
+        try:
+            return await handler(*args)
+        finally:
+            tracing.finish_trace()
+
+    return wrapper
+
+
+class SendQueue(object):
+    """
+    Sends bulk messages at a steady rate under Telegram limits, about
+    30 messages a second, so they don't get 429 and replies to users
+    don't wait behind them
+    """
+
+    def __init__(self, rate, max_size=10000):
+        """
+        :type rate: float
+        :type max_size: int
+        :param rate: messages per second
+        :param max_size: messages to keep, newer ones are dropped
+        """
+
+        self.rate = rate
+        self._queue = asyncio.Queue(max_size)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def put(self, chat_id, text, **options):
+        """
+        :return: False if the queue is full and the message is dropped
+        :rtype: bool
+        """
+        try:
+            self._queue.put_nowait((chat_id, text, options))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Send queue is full, message to %s dropped", chat_id)
+            return False
+        return True
+
+    async def run(self, bot):
+        while True:
+            chat_id, text, options = await self._queue.get()
+            try:
+                await bot.send_message(chat_id, text, **options)
+                self.sent += 1
+            except Exception:  # noqa
+                self.failed += 1
+                logger.exception("Message to %s not sent", chat_id)
+            finally:
+                self._queue.task_done()
+            await asyncio.sleep(1 / self.rate)
+
+    async def drain(self, timeout):
+        """
+        Wait for queued messages to be sent
+
+        :type timeout: float
+        :param timeout: seconds to wait
+        :return: number of messages left unsent
+        :rtype: int
+        """
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s queued messages not sent", self._queue.qsize())
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+class Latencies(object):
+    """
+    Recent durations by name, with percentiles
+    """
+
+    def __init__(self, size=1000):
+        """
+        :type size: int
+        :param size: durations to keep of each name
+        """
+
+        self._values = defaultdict(functools.partial(deque, maxlen=size))
+
+    def add(self, name, value):
+        self._values[name].append(value)
+
+    def stats(self):
+        stats = {}
+        for name, values in self._values.items():
+            ordered = sorted(values)
+            stats[name] = {
+                "count": len(ordered),
+                "p50": round(ordered[math.ceil(len(ordered) * 0.5) - 1], 3),
+                "p95": round(ordered[math.ceil(len(ordered) * 0.95) - 1], 3),
+            }
+        return stats
+
+
+# Time to first feedback and to final render of callback queries
+latencies = Latencies()
+
+
+class Feedback(object):
+    """
+    Acknowledgement and rendering of a callback query, timed from
+    the moment its handler started
+    """
+
+    def __init__(self, cq):
+        self.started = time.monotonic()
+        self.rendered = False
+        self._answer = cq.answer
+        self._answered = False
+        self._timer = None
+        self._loading = None
+        self._restore = None
+        # Telegram accepts one answer, so later ones are dropped
+        cq.answer = self.answer
+
+    def answer(self, **options):
+        if self._answered:
+            return None
+        self._answered = True
+        future = self._answer(**options)
+        future.add_done_callback(functools.partial(self._observe, "first_feedback"))
+        return future
+
+    def _observe(self, name, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        elapsed = time.monotonic() - self.started
+        latencies.add(name, elapsed)
+        tracing.annotate(**{name: round(elapsed, 3)})
+
+    def loading(self, delay, show, restore):
+        """
+        Show loading state if nothing is rendered in delay seconds
+
+        :type delay: float
+        :type show: callable
+        :type restore: callable
+        :param delay: seconds to wait for the render
+        :param show: function editing the message, returns API call future
+        :param restore: function putting the message back as it was, used
+            if the handler ends without rendering
+        """
+        self._restore = restore
+        self._timer = asyncio.get_event_loop().call_later(delay, self._show, show)
+
+    def _show(self, show):
+        self._timer = None
+        if not self.rendered:
+            self._loading = show()
+
+    def render(self, edit):
+        """
+        Make the final edit, after the loading one if it is still in flight,
+        so they can't arrive in the wrong order
+
+        :type edit: callable
+        :param edit: function editing the message, returns API call future
+        :return: API call future
+        """
+        first = not self.rendered
+        self.rendered = True
+        self.cancel()
+        if self._loading is not None and not self._loading.done():
+            future = asyncio.ensure_future(self._after_loading(edit))
+        else:
+            future = edit()
+        if first:
+            future.add_done_callback(functools.partial(self._observe, "final_render"))
+        return future
+
+    async def _after_loading(self, edit):
+        try:
+            await self._loading
+        except Exception:  # noqa
+            pass
+        return await edit()
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def superseded(self):
+        """
+        A newer handler renders into the message, so it isn't restored
+        """
+        self.cancel()
+        self.rendered = True
+
+    def finish(self):
+        """
+        Put the message back if the handler showed loading state and
+        ended without rendering, e.g. when GLPI failed
+        """
+        self.cancel()
+        if self._loading is None or self.rendered:
+            return
+        self.rendered = True
+        if self._loading.done():
+            self._restore()
+        else:
+            asyncio.ensure_future(self._after_loading(self._restore))
+
+
+def acknowledged(handler):
+    """
+    Answer the callback query at once, so Telegram stops the spinner and
+    the user doesn't tap again
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(chat, cq, match):
+        reaction = Feedback(cq)
+        feedback.set(reaction)
+        # Runs when the handler first waits, so an answer with a text it
+        # gives before that, like "busy", takes the place of the plain one
+        asyncio.get_event_loop().call_soon(reaction.answer)
+        try:
+            return await handler(chat, cq, match)
+        finally:
+            reaction.finish()
+
+    return wrapper
+
+
+class LazyBot(object):
+    """
+    Collects handlers while modules are imported and creates aiotg Bot
+    at startup, so importing the bot doesn't load aiohttp
+    """
+
+    def __init__(self):
+        self._bot = None
+        self._routes = []
+
+    def _route(self, method, *args):
+        def decorator(fn):
+            self._routes.append((method, args, fn))
+            return fn
+
+        return decorator
+
+    def command(self, regexp):
+        return self._route("add_command", regexp)
+
+    def callback(self, regexp):
+        return self._route("add_callback", regexp)
+
+    def inline(self, regexp):
+        return self._route("add_inline", regexp)
+
+    def handle(self, msg_type):
+        return self._route("handle", msg_type)
+
+    def default(self, fn):
+        return self._route("default")(fn)
+
+    def create(self, first_time=None, **options):
+        """
+        Create the bot and register collected handlers in their order
+
+        :type first_time: callable
+        :param first_time: coroutine function taking update ID, returns
+            False if the update was already handled
+        :param options: aiotg Bot options
+        """
+        from aiotg import Bot
+
+        bot = type("IdempotentBot", (IdempotentMixin, tracing.BotMixin, Bot), {})(
+            **options
+        )
+        bot.first_time = first_time
+        for method, args, fn in self._routes:
+            if method == "add_callback":
+                fn = acknowledged(fn)
+            fn = traced(fn)
+            if method == "handle":
+                bot.handle(*args)(fn)
+            elif method == "default":
+                bot.default(fn)
+            else:
+                getattr(bot, method)(*args, fn)
+        self._bot = bot
+        return bot
+
+    def __getattr__(self, name):
+        if self._bot is None:
+            raise RuntimeError("Bot is used before it is created")
+        return getattr(self._bot, name)
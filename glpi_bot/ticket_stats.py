@@ -0,0 +1,176 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+from collections import Counter
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+KEY = "stats:{}:entity:{}"
+
+# Counters are kept this many TTLs and shown while they are refreshed
+STALE_FACTOR = 10
+
+# Tasks refreshing counters of an entity
+_refreshing = {}
+# Requests served from Redis, stale among them, and not computed yet
+counters = Counter()
+
+
+def is_overdue(ticket, now):
+    """
+    :type ticket: dict
+    :type now: datetime.datetime
+    :return: True if the time to resolve has passed
+    :rtype: bool
+    """
+    if not ticket.get("time_to_resolve"):
+        return False
+    try:
+        deadline = datetime.datetime.strptime(
+            ticket["time_to_resolve"], "%Y-%m-%d %H:%M:%S"
+        )
+    except ValueError:
+        return False
+    return deadline < now
+
+
+def assignees(ticket):
+    """
+    :type ticket: dict
+    :return: IDs of assigned users as str
+    :rtype: list
+    """
+    return [str(user["users_id"]) for user in ticket.get("users", {}).get("assign", [])]
+
+
+def aggregate(tickets, now=None):
+    """
+    Count unresolved tickets of an entity, in total and by assigned user
+
+    :type tickets: list
+    :type now: datetime.datetime
+    :param tickets: unresolved tickets from listTickets
+    :param now: time to check overdue tickets against
+    :return: counters
+    :rtype: dict
+    """
+    now = now or datetime.datetime.now()
+    assigned = Counter()
+    overdue = Counter()
+    for ticket in tickets:
+        late = is_overdue(ticket, now)
+        for user_id in assignees(ticket):
+            assigned[user_id] += 1
+            if late:
+                overdue[user_id] += 1
+    return {"total": len(tickets), "assigned": assigned, "overdue": overdue}
+
+
+async def unresolved(fetch, page=500):
+    """
+    All unresolved tickets of the active entity, in lean form
+
+    :type fetch: callable
+    :type page: int
+    :param fetch: coroutine function calling GLPI API method
+    :param page: tickets per listTickets call
+    :return: tickets or None if GLPI failed
+    :rtype: list
+    """
+    tickets = []
+    start = 0
+    while True:
+        res = await fetch("listTickets", status="notold", start=start, limit=page)
+        if not isinstance(res, list):
+            logger.warning("listTickets failed: %s", res)
+            return None
+        tickets += res
+        if len(res) < page:
+            return tickets
+        start += page
+
+
+def scope_of(entity, sender_id):
+    """
+    :type entity: str
+    :type sender_id: int
+    :param entity: ID of the chosen entity
+    :param sender_id: ID of chat user
+    :return: who shares ticket queries with the user, users who haven't
+        chosen an entity see their own default entities and share none
+    :rtype: str
+    """
+    return entity or "user-{}".format(sender_id)
+
+
+async def entity_stats(pool, fetch, namespace, scope, ttl, page=500):
+    """
+    Ticket counters of an entity, computed with one paged listTickets
+    query and shared by all its users. Counters older than ttl are
+    returned while a background task computes them again, so menus of
+    a large entity don't wait for GLPI.
+
+    :type fetch: callable
+    :type namespace: str
+    :type scope: str
+    :type ttl: int
+    :type page: int
+    :param fetch: coroutine function calling GLPI API method
+    :param namespace: GLPI instance of the entity
+    :param scope: active entity, see scope_of()
+    :param ttl: seconds after which the counters are refreshed
+    :param page: tickets per listTickets call
+    :return: counters or None if they haven't been computed yet
+    :rtype: dict
+    """
+    key = storage.key(KEY, namespace, scope)
+    cached = await pool.get(key)
+    cached = json.loads(cached) if cached else {}
+    if cached.get("stats"):
+        counters["hit"] += 1
+        if time.time() - cached["computed"] < ttl:
+            return cached["stats"]
+        counters["stale"] += 1
+    else:
+        counters["miss"] += 1
+    if key not in _refreshing:
+        _refreshing[key] = asyncio.ensure_future(
+            refresh(pool, fetch, key, scope, ttl, page)
+        )
+        _refreshing[key].add_done_callback(lambda _: _refreshing.pop(key, None))
+    return cached.get("stats")
+
+
+async def refresh(pool, fetch, key, scope, ttl, page):
+    try:
+        tickets = await unresolved(fetch, page)
+    except Exception:  # noqa
+        logger.exception("Can't count tickets of %s", scope)
+        return
+    if tickets is None:
+        logger.warning("Can't count tickets of %s", scope)
+        return
+    stats = {"stats": aggregate(tickets), "computed": time.time()}
+    await pool.set(key, json.dumps(stats), expire=ttl * STALE_FACTOR)
+
+
+def user_counters(stats, user_id):
+    """
+    :type stats: dict
+    :type user_id: str
+    :param stats: counters of the entity
+    :param user_id: GLPI user ID
+    :return: counters for menu badges
+    :rtype: dict
+    """
+    if not stats:
+        return None
+    return {
+        "assigned": stats["assigned"].get(str(user_id), 0),
+        "overdue": stats["overdue"].get(str(user_id), 0),
+        "total": stats["total"],
+    }
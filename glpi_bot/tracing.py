@@ -0,0 +1,354 @@
+import abc
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+_trace = contextvars.ContextVar("trace", default=None)
+_parent = contextvars.ContextVar("parent", default=None)
+
+# Set by setup(), tracing is off without it
+exporter = None
+sample_rate = 0.0
+slow_threshold = None
+max_spans = 500
+
+
+class Span(object):
+    """
+    Timed operation of a trace, in OTLP terms
+    """
+
+    __slots__ = ("name", "span_id", "parent_id", "start", "end_time", "attributes")
+
+    def __init__(self, name, parent_id=None, **attributes):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end_time = None
+        self.attributes = attributes
+
+    def end(self, **attributes):
+        self.attributes.update(attributes)
+        self.end_time = time.time_ns()
+
+    @property
+    def duration(self):
+        return ((self.end_time or time.time_ns()) - self.start) / 1e9
+
+
+class Trace(object):
+    """
+    Spans of one Telegram update
+    """
+
+    def __init__(self, name, sampled, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.root = Span(name, **attributes)
+        self.spans = [self.root]
+        self.dropped = 0
+
+    def add(self, span):
+        if len(self.spans) < max_spans:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+
+class SpanBlock(object):
+    """
+    Child span of the current one for a block of code, it becomes
+    the parent of spans started inside the block. Does nothing
+    outside of a trace.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self._span = None
+        self._token = None
+
+    def __enter__(self):
+        self._span = start_span(self.name, **self.attributes)
+        if self._span is not None:
+            self._token = _parent.set(self._span.span_id)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return
+        _parent.reset(self._token)
+        if exc_type is not None:
+            self._span.attributes["error"] = exc_type.__name__
+        self._span.end()
+
+    def end(self, **attributes):
+        """
+        Add attributes, the span still ends with the block
+        """
+        if self._span is not None:
+            self._span.attributes.update(attributes)
+
+
+def span(name, **attributes):
+    """
+    :Example:
+
+    >>> with tracing.span("glpi", method=method) as s:
+    >>>     ...
+    >>>     s.end(status="ok")
+    """
+    return SpanBlock(name, **attributes)
+
+
+def setup(export, rate=0.0, slow=None, limit=500):
+    """
+    :type rate: float
+    :type slow: float
+    :type limit: int
+    :param export: exporter of finished traces
+    :param rate: share of traces to export, 0 to 1
+    :param slow: also export traces longer than this many seconds
+    :param limit: maximum spans in a trace
+    """
+    global exporter, sample_rate, slow_threshold, max_spans
+    exporter = export
+    sample_rate = rate
+    slow_threshold = slow
+    max_spans = limit
+
+
+def start_trace(name, **attributes):
+    """
+    Start a trace in the current context, tasks created from it inherit it
+
+    :type name: str
+    :param name: name of the root span
+    :return: trace or None if tracing is off
+    :rtype: Trace
+    """
+    if exporter is None:
+        return None
+    trace = Trace(name, random.random() < sample_rate, **attributes)
+    _trace.set(trace)
+    _parent.set(trace.root.span_id)
+    return trace
+
+
+def finish_trace(**attributes):
+    """
+    End the trace of the current context and export it if it is sampled
+    or slow
+    """
+    trace = _trace.get()
+    if trace is None or trace.root.end_time is not None:
+        return
+    trace.root.end(**attributes)
+    slow = slow_threshold is not None and trace.root.duration >= slow_threshold
+    if trace.sampled or slow:
+        exporter.export(trace)
+
+
+def annotate(**attributes):
+    """
+    Add attributes to the root span of the current trace
+    """
+    trace = _trace.get()
+    if trace is not None:
+        trace.root.attributes.update(attributes)
+
+
+def start_span(name, **attributes):
+    """
+    Start a child span of the current one, end it with Span.end()
+
+    :type name: str
+    :return: span or None outside of a trace
+    :rtype: Span
+    """
+    trace = _trace.get()
+    if trace is None:
+        return None
+    child = Span(name, _parent.get(), **attributes)
+    trace.add(child)
+    return child
+
+
+def end_with(future, child):
+    """
+    End the span when the future or coroutine is done
+    """
+    if child is not None:
+        future = asyncio.ensure_future(future)
+        future.add_done_callback(lambda f: child.end())
+    return future
+
+
+class RedisMixin(object):
+    """
+    Span for every command of aioredis client
+    """
+
+    def execute(self, command, *args, **kwargs):
+        name = command.decode() if isinstance(command, bytes) else str(command)
+        return end_with(
+            super().execute(command, *args, **kwargs),
+            start_span("redis {}".format(name.upper()), db_system="redis"),
+        )
+
+
+class BotMixin(object):
+    """
+    Span for every Telegram Bot API call
+    """
+
+    def api_call(self, method, **params):
+        return end_with(
+            super().api_call(method, **params),
+            start_span("telegram {}".format(method), rpc_method=method),
+        )
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(traces, service="glpi_bot"):
+    """
+    :type traces: list
+    :param traces: finished traces
+    :return: OTLP/JSON ExportTraceServiceRequest
+    :rtype: dict
+    """
+    spans = []
+    for trace in traces:
+        for s in trace.spans:
+            attributes = dict(s.attributes)
+            if s is trace.root and trace.dropped:
+                attributes["dropped_spans"] = trace.dropped
+            item = {
+                "traceId": trace.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": 2 if s is trace.root else 3,
+                "startTimeUnixNano": str(s.start),
+                "endTimeUnixNano": str(s.end_time or trace.root.end_time),
+                "attributes": [
+                    {"key": k, "value": _value(v)} for k, v in attributes.items()
+                ],
+            }
+            if s.parent_id:
+                item["parentSpanId"] = s.parent_id
+            spans.append(item)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": service}}
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+            }
+        ]
+    }
+
+
+class Exporter(abc.ABC):
+    """
+    Collects finished traces and writes them in batches in the background
+    """
+
+    def __init__(self, interval=5, max_queue=1000):
+        """
+        :type interval: float
+        :type max_queue: int
+        :param interval: seconds between writes
+        :param max_queue: traces to keep while the target is unavailable
+        """
+
+        self.interval = interval
+        self.max_queue = max_queue
+        self._queue = []
+
+    def export(self, trace):
+        if len(self._queue) < self.max_queue:
+            self._queue.append(trace)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        try:
+            await self.write(to_otlp(batch))
+        except Exception:  # noqa
+            logger.exception("Export of %s traces failed", len(batch))
+
+    @abc.abstractmethod
+    async def write(self, data):
+        """
+        :type data: dict
+        :param data: batch of traces in OTLP JSON
+        """
+
+
+class FileExporter(Exporter):
+    """
+    Appends batches to a file as OTLP/JSON lines
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def _append(self, line):
+        with open(self.path, "a") as f:
+            f.write(line)
+
+    async def write(self, data):
+        line = json.dumps(data, separators=(",", ":")) + "\n"
+        await asyncio.get_event_loop().run_in_executor(None, self._append, line)
+
+
+class OTLPExporter(Exporter):
+    """
+    Posts batches to an OTLP/HTTP collector
+    """
+
+    def __init__(self, endpoint, **kwargs):
+        """
+        :type endpoint: str
+        :param endpoint: traces URL, like http://collector:4318/v1/traces
+        """
+        super().__init__(**kwargs)
+        self.endpoint = endpoint
+        self._session = None
+
+    async def write(self, data):
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=10)
+            )
+        async with self._session.post(self.endpoint, json=data) as resp:
+            if resp.status >= 300:
+                logger.warning("Collector answered %s", resp.status)
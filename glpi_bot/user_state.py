@@ -0,0 +1,148 @@
+import logging
+import time
+
+import msgpack
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Keys of a user share a hash tag to be in one Redis Cluster slot
+KEY = "user:{{{}}}"
+ENTITIES = "user:{{{}}}:entities"
+# Version the old user hashes were migrated to
+MIGRATED = "user_state:migrated"
+
+VERSION = 1
+# Record is a msgpack array of the version and values in this order.
+# New fields are only appended, so older records are padded with defaults.
+FIELDS = (
+    ("session", ""),
+    ("name", ""),
+    ("id", 0),
+    ("profiles_id", ""),
+    ("entity", ""),
+    ("credential", ""),
+    ("created", 0),
+    ("modified", 0),
+    # GLPI instance, empty for the default one
+    ("backend", ""),
+    # Local digest times, like "08:00,20:00", empty if not subscribed
+    ("digest", ""),
+    # UTC offset, like "+05:00", empty for the default one
+    ("timezone", ""),
+)
+DEFAULTS = dict(FIELDS)
+
+
+def pack(state):
+    """
+    :type state: dict
+    :param state: user state, missing fields get defaults
+    :return: serialized record
+    :rtype: bytes
+    """
+    values = [VERSION]
+    for field, default in FIELDS:
+        value = state.get(field)
+        values.append(default if value in (None, "") else type(default)(value))
+    return msgpack.packb(values)
+
+
+def unpack(raw):
+    """
+    :type raw: bytes
+    :param raw: serialized record
+    :return: user state
+    :rtype: dict
+    """
+    if not raw:
+        return dict(DEFAULTS)
+    values = msgpack.unpackb(raw)
+    if values[0] > VERSION:
+        logger.error("User state version %s is newer than %s", values[0], VERSION)
+        return dict(DEFAULTS)
+    state = dict(DEFAULTS)
+    state.update(zip((field for field, _ in FIELDS), values[1:]))
+    return state
+
+
+async def load(pool, sender_id):
+    """
+    :type sender_id: int
+    :param sender_id: ID of chat user
+    :return: user state
+    :rtype: dict
+    """
+    return unpack(await pool.get(storage.key(KEY, sender_id), encoding=None))
+
+
+async def get(pool, sender_id, field):
+    """
+    :type sender_id: int
+    :type field: str
+    :param sender_id: ID of chat user
+    :param field: field from FIELDS
+    :return: field value
+    """
+    return (await load(pool, sender_id))[field]
+
+
+async def update(pool, sender_id, **fields):
+    """
+    Change fields of user state, retrying if another handler changed
+    the record meanwhile
+
+    :type sender_id: int
+    :param sender_id: ID of chat user
+    :param fields: new values of fields from FIELDS
+    :return: user state
+    :rtype: dict
+    """
+    from aioredis import WatchVariableError
+
+    unknown = set(fields) - set(DEFAULTS)
+    if unknown:
+        raise KeyError("Unknown user state fields: {}".format(", ".join(unknown)))
+    key = storage.key(KEY, sender_id)
+    while True:
+        with await (await storage.node(pool, key)) as redis:
+            await redis.watch(key)
+            state = unpack(await redis.get(key, encoding=None))
+            now = int(time.time())
+            state.update(fields, modified=now)
+            state["created"] = state["created"] or now
+            tr = redis.multi_exec()
+            tr.set(key, pack(state))
+            try:
+                await tr.execute()
+            except WatchVariableError:
+                continue
+        logger.debug("%s: %s", sender_id, sorted(fields))
+        return state
+
+
+async def migrate(pool):
+    """
+    Convert user hashes of old versions, keyed by Telegram user ID
+    and holding the whole sender and doLogin result, to records.
+    Old versions only ran with standalone Redis. The keyspace is
+    scanned once, later starts find the migration done.
+    """
+    if await pool.get(storage.key(MIGRATED)):
+        return
+    count = 0
+    async for key in pool.iscan(count=500):
+        if not key.isdigit() or await pool.type(key) != "hash":
+            continue
+        old = await pool.hgetall(key)
+        state = {field: old.get("glpi_{}".format(field)) for field in DEFAULTS}
+        state.update(created=old.get("created"), modified=old.get("modified"))
+        tr = pool.multi_exec()
+        tr.set(storage.key(KEY, key), pack(state))
+        tr.delete(key)
+        await tr.execute()
+        count += 1
+    await pool.set(storage.key(MIGRATED), VERSION)
+    if count:
+        logger.info("Migrated %s users to state version %s", count, VERSION)
@@ -1,22 +1,12 @@
 import base64
 import datetime
-import hashlib
+import html
 import logging
 import os
 import re
 import time
 
-from transliterate import translit
-
-logger = logging.getLogger("__name__")
-
-
-def unix_time(time_):
-    return int(time.mktime(time_.timetuple()))
-
-
-def norm_time(ts):
-    return datetime.datetime.fromtimestamp(ts)
+logger = logging.getLogger(__name__)
 
 
 def format_date(dt):
@@ -29,54 +19,90 @@ def format_date(dt):
     return fmt.strftime("%d.%m.%Y")
 
 
-def dict_to_keys(**sender):
-    keys = []
-    for k, v in sender.items():
-        if k == "id":
-            keys.insert(0, v)
-        if v is False:
-            v = "False"
-        if v is True:
-            v = "True"
-        else:
-            keys.append(k)
-            keys.append(v)
-    return keys
-
-
-async def set_user(pool, glpi_user, **sender):
-    now = unix_time(datetime.datetime.now())
-    with await pool as redis:
-        await redis.select(0)
-        pairs = dict_to_keys(**sender)
-        tr = redis.multi_exec()
-        logger.debug(pairs)
-        logger.debug(glpi_user)
-        tr.hmset(*pairs)
-        tr.hmset(*glpi_user)
-        tr.hsetnx(pairs[0], "created", now)
-        tr.hset(pairs[0], "modified", now)
-        await tr.execute()
-        logger.debug("%s: {%s}", pairs[0], await redis.hgetall(pairs[0]))
-
-
-async def set_user_field(pool, sender_id, key, value):
-    with await pool as redis:
-        await redis.select(0)
-        await redis.hset(sender_id, key, value)
-        res = await redis.hget(sender_id, key)
-        logger.debug("%s: {%s: %s}", sender_id, key, res)
-
-
-async def get_user_field(pool, sender_id, key):
-    with await pool as redis:
-        await redis.select(0)
-        value = await redis.hget(sender_id, key)
-        logger.debug("%s: {%s: %s}", sender_id, key, value)
-        return value
+def format_traffic(stats):
+    """
+    :type stats: dict
+    :param stats: XML-RPC byte counters by method
+    :return: report on bytes sent and received and saved by compression
+    :rtype: str
+    """
+    lines = ["<b>Трафик GLPI</b> (до сжатия → по сети)"]
+    for method, c in sorted(stats.items()):
+        raw = c["request_raw"] + c["response_raw"]
+        wire = c["request_wire"] + c["response_wire"]
+        saved = 100 - wire * 100 // raw if raw else 0
+        lines.append(
+            "<code>{}</code> ×{}: ↑ {} → {}, ↓ {} → {}, −{}%".format(
+                method,
+                c["calls"],
+                c["request_raw"],
+                c["request_wire"],
+                c["response_raw"],
+                c["response_wire"],
+                saved,
+            )
+        )
+    return "\n".join(lines)
+
+
+def format_health(name, stats, breaker, result):
+    """
+    :type name: str
+    :type stats: dict
+    :type breaker: str
+    :param name: GLPI instance
+    :param stats: health probe history
+    :param breaker: circuit breaker state
+    :param result: answer of the last good status call
+    :return: report on GLPI availability and latency
+    :rtype: str
+    """
+    if stats is None:
+        return "<b>GLPI {}</b>: еще не проверен".format(name)
+    lines = [
+        "<b>GLPI {}</b>: {}".format(
+            name, "✅ доступен" if stats["ok"] else "❌ недоступен"
+        ),
+        "Задержка {:.2f} с, p95 {}".format(
+            stats["latency"],
+            "{:.2f} с".format(stats["p95"]) if stats["p95"] is not None else "—",
+        ),
+        "Доступность {:.1%} за {} проверок, проверен {:.0f} с назад".format(
+            stats["availability"], stats["probes"], time.time() - stats["checked"]
+        ),
+        "Автомат: {}".format(breaker),
+    ]
+    if result:
+        lines.append("<code>{}</code>".format(html.escape(str(result))[:1000]))
+    return "\n".join(lines)
+
+
+def format_workers(stats):
+    """
+    :type stats: dict
+    :param stats: worker pool metrics by pool name
+    :return: report on worker pool queues
+    :rtype: str
+    """
+    lines = ["<b>Пулы потоков и процессов</b>"]
+    for name, c in sorted(stats.items()):
+        lines.append(
+            "<code>{}</code> ×{}: в очереди {}, выполнено {}, "
+            "ожидание {:.2f} с (макс. {:.2f} с)".format(
+                name,
+                c["size"],
+                c["queued"],
+                c["completed"],
+                c["wait_avg"],
+                c["wait_max"],
+            )
+        )
+    return "\n".join(lines)
 
 
 def translit_replace(string):
+    from transliterate import translit
+
     string = re.sub(r'[\\/*?:"<>|\s]', "_", string)
     string = re.sub(r"_+", "_", string)
     return translit(string, "ru", reversed=True)
@@ -91,51 +117,36 @@ def file_to_b64(file):
     :return: base64 string
     :rtype: str
     """
+    chunks = []
     with open(file, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        # Whole 3-byte groups per chunk, so the parts join without padding.
+        # The event loop gets the GIL between chunks of a big file.
+        for chunk in iter(lambda: f.read(3 * 2**18), b""):
+            chunks.append(base64.b64encode(chunk))
+    return b"".join(chunks).decode("utf-8")
 
 
-def b64_to_file(path, filename, b64_str, sha1sum_orig, buf_size=65536):
+def checked_file(tmp_path, filename, sha1sum_calc, sha1sum_orig):
     """
-    Decodes base64 string and saves to file, then checks sha1 sum
+    Gives downloaded file its name if SHA1 sum matches, removes it otherwise
 
-    :type path: str
+    :type tmp_path: str
     :type filename: str
-    :type b64_str: str
+    :type sha1sum_calc: str
     :type sha1sum_orig: str
-    :type buf_size: int
-    :param path: path of the file
+    :param tmp_path: path to downloaded file
     :param filename: name of the file
-    :param b64_str: string with base64 encoded file
+    :param sha1sum_calc: SHA1 sum of downloaded file
     :param sha1sum_orig: SHA1 sum
-    :param buf_size: size of read buffer
     :return: path to file
     :rtype: str
     """
 
-    sha1 = hashlib.sha1()
-
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    doc_path = os.path.join(path, filename)
-
-    if os.path.exists(doc_path):
-        pass
-
-    with open(doc_path, "wb") as f:
-        f.write(base64.b64decode(b64_str))
-
-    with open(doc_path, "rb") as f:
-        while True:
-            data = f.read(buf_size)
-            if not data:
-                break
-            sha1.update(data)
-        sha1sum_calc = sha1.hexdigest()
-        logger.debug("[Checksum] calc: %s get: %s", sha1sum_calc, sha1sum_orig)
-        if sha1sum_calc == sha1sum_orig:
-            return doc_path
-        else:
-            logger.error("Error! sha1 sums don't match")
-            return False
+    logger.debug("[Checksum] calc: %s get: %s", sha1sum_calc, sha1sum_orig)
+    if sha1sum_calc != sha1sum_orig:
+        logger.error("Error! sha1 sums don't match")
+        os.remove(tmp_path)
+        return False
+    doc_path = os.path.join(os.path.dirname(tmp_path), filename)
+    os.replace(tmp_path, doc_path)
+    return doc_path
@@ -1,68 +1,404 @@
+import base64
+import gzip
+import hashlib
 import logging
+import os
+import socket
+import tempfile
+import threading
 from xmlrpc import client
 
 logger = logging.getLogger(__name__)
 
 
+class Traffic(object):
+    """
+    Thread-safe counters of XML-RPC bytes per method, before
+    and after compression
+    """
+
+    FIELDS = ("calls", "request_raw", "request_wire", "response_raw", "response_wire")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def add(self, method, **counts):
+        with self._lock:
+            stats = self._methods.setdefault(method, dict.fromkeys(self.FIELDS, 0))
+            for key, value in counts.items():
+                stats[key] += value
+
+    def stats(self):
+        with self._lock:
+            return {method: dict(stats) for method, stats in self._methods.items()}
+
+
+traffic = Traffic()
+
+
+class CountingReader(object):
+    """
+    File-like wrapper counting bytes read from the response
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+
+class Base64Sink(object):
+    """
+    Decodes base64 text as it arrives, writing bytes to a file
+    and hashing them with SHA1
+    """
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self._rest = ""
+
+    def write(self, text):
+        # Decode whole 4-char groups only, keep the tail for the next chunk
+        text = self._rest + "".join(text.split())
+        cut = len(text) - len(text) % 4
+        self._rest = text[cut:]
+        if cut:
+            chunk = base64.b64decode(text[:cut])
+            self.sha1.update(chunk)
+            self.file.write(chunk)
+            self.size += len(chunk)
+
+    def close(self):
+        """
+        :return: SHA1 of decoded data
+        :rtype: str
+        """
+        if self._rest:
+            raise ValueError("Truncated base64 data")
+        return self.sha1.hexdigest()
+
+
+class StreamingUnmarshaller(client.Unmarshaller):
+    """
+    Unmarshaller passing string value of one struct member to a sink
+    instead of collecting it, other members are unmarshalled as usual
+    """
+
+    def __init__(self, sink, field="base64"):
+        super().__init__(use_datetime=True)
+        self.sink = sink
+        self.field = field
+        self._streaming = False
+
+    def _at_field(self):
+        # Inside the top-level struct, after the member name and before its value
+        return (
+            len(self._marks) == 1
+            and (len(self._stack) - self._marks[-1]) % 2 == 1
+            and self._stack[-1] == self.field
+        )
+
+    def start(self, tag, attrs):
+        super().start(tag, attrs)
+        if tag == "value" and self._at_field():
+            self._streaming = True
+
+    def data(self, text):
+        if self._streaming:
+            self.sink.write(text)
+        else:
+            super().data(text)
+
+    def end(self, tag):
+        if not self._streaming:
+            return super().end(tag)
+        if tag in ("string", "value"):
+            # Value itself stays out of the result
+            self._streaming = False
+            self._value = 0
+            self._data = []
+            self.append(None)
+
+
+class TransportMixin(object):
+    """
+    Socket timeout, abort support, gzip and traffic accounting
+    for XML-RPC transports
+    """
+
+    def __init__(self, timeout=None, gzip_response=True, gzip_threshold=None, **kwargs):
+        """
+        :type timeout: float
+        :type gzip_response: bool
+        :type gzip_threshold: int
+        :param timeout: socket timeout in seconds
+        :param gzip_response: ask the server for gzip-compressed responses
+        :param gzip_threshold: compress request bodies bigger than this
+        """
+        super().__init__(**kwargs)
+        self.timeout = timeout
+        self.accept_gzip_encoding = gzip_response
+        self.encode_threshold = gzip_threshold or None
+        self.method = None
+        self.unmarshaller = None
+        # Byte counters of the last request
+        self.sizes = {}
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        if conn.sock is not None:
+            # Kept-alive connection of a previous call
+            conn.sock.settimeout(self.timeout)
+        return conn
+
+    def abort(self):
+        """
+        Shut down the socket of a request in progress, so the thread
+        blocked on it fails at once instead of waiting for the timeout
+        """
+        conn = self._connection[1]
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def count(self, **counters):
+        if self.method is not None:
+            traffic.add(self.method, **counters)
+        self.sizes.update(counters)
+
+    def getparser(self):
+        if self.unmarshaller is None:
+            return super().getparser()
+        return client.ExpatParser(self.unmarshaller), self.unmarshaller
+
+    def send_request(self, host, handler, request_body, debug):
+        self.sizes = {}
+        self.count(calls=1, request_raw=len(request_body))
+        return super().send_request(host, handler, request_body, debug)
+
+    def send_content(self, connection, request_body):
+        if self.encode_threshold and self.encode_threshold < len(request_body):
+            connection.putheader("Content-Encoding", "gzip")
+            request_body = client.gzip_encode(request_body)
+        self.count(request_wire=len(request_body))
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+
+    def parse_response(self, response):
+        wire = CountingReader(response)
+        stream = wire
+        if response.getheader("Content-Encoding", "") == "gzip":
+            # Decompress while reading instead of buffering the whole body
+            stream = gzip.GzipFile(mode="rb", fileobj=wire)
+        p, u = self.getparser()
+        raw = 0
+        while True:
+            data = stream.read(65536)
+            if not data:
+                break
+            raw += len(data)
+            p.feed(data)
+        if stream is not wire:
+            stream.close()
+        p.close()
+        self.count(response_raw=raw, response_wire=wire.count)
+        logger.debug(
+            "%s: response %s bytes, %s on the wire", self.method, raw, wire.count
+        )
+        return u.close()
+
+
+class GLPITransport(TransportMixin, client.Transport):
+    """
+    HTTP transport for GLPI webservices
+    """
+
+
+class GLPISafeTransport(TransportMixin, client.SafeTransport):
+    """
+    HTTPS transport for GLPI webservices
+    """
+
+
+def method_doc(attr, _help):
+    """
+    Format docstring for wrapped method
+    """
+
+    ret = "Wrapper for GLPI webservices %s method:\n\n" % attr
+    ret += "It could be a good idea to see method's reference page:\n"
+    ret += "https://forge.glpi-project.org/projects/webservices/wiki/Glpi%s\n\n" % attr
+    ret += ":param module: webservices module to call (default: glpi)\n"
+    ret += ":type module: str\n"
+    ret += ":param kwargs: options for %s method:\n\n" % attr
+
+    for (key, value) in _help.items():
+        ret += "\t- %s: %s\n" % (key, value)
+
+    ret += "\n:type kwargs: dict"
+
+    return ret
+
+
+class Method(object):
+    # Webservices method of XMLRPCClient. The docstring comes from the
+    # help of the method, asked from GLPI only when it is read, so calls
+    # don't pay for an extra request.
+
+    def __init__(self, glpi, name):
+        self.glpi = glpi
+        self.__name__ = name
+
+    def __call__(self, module="glpi", **kwargs):
+        return self.glpi.call(self.__name__, module, **kwargs)
+
+    @property
+    def __doc__(self):
+        return method_doc(self.__name__, self(help=True))
+
+
 class XMLRPCClient(object):
     """
     Python XML-RPC client to interact with GLPI webservices plugin
     """
 
-    def __init__(self, baseurl, username, password):
+    def __init__(
+        self,
+        baseurl,
+        username,
+        password,
+        timeout=None,
+        gzip_response=True,
+        gzip_threshold=None,
+    ):
         """
         :type baseurl: str
         :type username: str
         :type password: str
+        :type timeout: float
+        :type gzip_response: bool
+        :type gzip_threshold: int
         :param baseurl: Base URL of your GLPI instance
         :param username: Webservices API user
         :param password: Webservices API password
+        :param timeout: socket timeout in seconds (default: no timeout)
+        :param gzip_response: accept gzip-compressed responses
+        :param gzip_threshold: compress requests bigger than this (default: never)
         """
 
         self.serviceurl = baseurl + "/plugins/webservices/xmlrpc.php"
+        transport_class = GLPITransport
+        if self.serviceurl.startswith("https"):
+            transport_class = GLPISafeTransport
+        transport = transport_class(
+            timeout=timeout,
+            gzip_response=gzip_response,
+            gzip_threshold=gzip_threshold,
+            use_datetime=True,
+        )
         self.server = client.ServerProxy(
-            self.serviceurl, allow_none=True, use_datetime=True
+            self.serviceurl, transport=transport, allow_none=True
         )
         self.session = None
         self.params = {"username": username, "password": password}
 
     def __getattr__(self, attr):
-        def _get_doc(attr, _help):
-            """
-            Format docstring for wrapped method
-            """
-
-            ret = "Wrapper for GLPI webservices %s method:\n\n" % attr
-            ret += "It could be a good idea to see method's reference page:\n"
-            ret += (
-                "https://forge.glpi-project.org/projects/webservices/wiki/Glpi%s\n\n"
-                % attr
-            )
-            ret += ":param module: webservices module to call (default: glpi)\n"
-            ret += ":type module: str\n"
-            ret += ":param kwargs: options for %s method:\n\n" % attr
+        return Method(self, attr)
+
+    def call(self, method, module="glpi", **kwargs):
+        """
+        :type method: str
+        :type module: str
+        :param method: webservices method to call
+        :param module: webservices module to call (default: glpi)
+        :param kwargs: options for the method
+        """
+        params = {}
+        if self.session:
+            params["session"] = self.session
+
+        params = {**self.params, **params, **kwargs}
+
+        # Requests for help aren't calls of the method
+        self.server("transport").method = None if kwargs.get("help") else method
+        called_module = getattr(self.server, module)
+        return getattr(called_module, method)(params)
 
-            for (key, value) in _help.items():
-                ret += "\t- %s: %s\n" % (key, value)
+    def download_document(self, path, module="glpi", **kwargs):
+        """
+        Call getDocument, streaming the file straight to disk, so memory
+        use doesn't depend on the file size
 
-            ret += "\n:type kwargs: dict"
+        :type path: str
+        :type module: str
+        :param path: directory for the file
+        :param module: webservices module to call (default: glpi)
+        :param kwargs: options for getDocument method
+        :return: document fields, with path of the written temporary file
+            and its SHA1 in place of base64
+        :rtype: dict
+        """
 
-            return ret
+        params = {}
+        if self.session:
+            params["session"] = self.session
+        params = {**self.params, **params, **kwargs}
 
-        def call(module="glpi", **kwargs):
-            params = {}
-            if self.session:
-                params["session"] = self.session
+        os.makedirs(path, exist_ok=True)
+        transport = self.server("transport")
+        with tempfile.NamedTemporaryFile(dir=path, delete=False) as f:
+            sink = Base64Sink(f)
+            transport.method = "getDocument"
+            transport.unmarshaller = StreamingUnmarshaller(sink)
+            try:
+                res = getattr(self.server, module).getDocument(params)
+                res["sha1"] = sink.close()
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+            finally:
+                transport.unmarshaller = None
+        del res["base64"]
+        res["path"] = f.name
+        return res
 
-            params = {**self.params, **params, **kwargs}
+    def abort(self):
+        """
+        Abort the call in progress, if any
+        """
+        self.server("transport").abort()
 
-            called_module = getattr(self.server, module)
-            return getattr(called_module, attr)(params)
+    def set_timeout(self, timeout):
+        """
+        :type timeout: float
+        :param timeout: socket timeout for the next calls
+        """
+        self.server("transport").timeout = timeout
 
-        call.__name__ = attr
-        call.__doc__ = _get_doc(attr, call(help=True))
-        logger.debug("call")
-        return call
+    def close(self):
+        """
+        Close the kept-alive connection
+        """
+        self.server("close")()
+
+    @property
+    def sizes(self):
+        """
+        :return: byte counters of the last call
+        :rtype: dict
+        """
+        return self.server("transport").sizes
 
     def connect(self, login_name, login_password):
         """
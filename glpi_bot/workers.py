@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def _timed(func, *args):
+    # Runs in the worker, tells when the task left the queue
+    return time.time(), func(*args)
+
+
+class WorkerPool(object):
+    """
+    Executor with queue metrics, created on first use
+    """
+
+    def __init__(self, name, executor_class, size):
+        """
+        :type name: str
+        :type executor_class: type
+        :type size: int
+        :param name: pool name for logs and metrics
+        :param executor_class: executor type, like ThreadPoolExecutor
+        :param size: number of workers
+        """
+
+        self.name = name
+        self.executor_class = executor_class
+        self.size = size
+        self._executor = None
+        self.submitted = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = self.executor_class(max_workers=self.size)
+        return self._executor
+
+    async def run(self, func, *args):
+        submitted = time.time()
+        self.submitted += 1
+        try:
+            started, res = await asyncio.get_event_loop().run_in_executor(
+                self.executor, _timed, func, *args
+            )
+        finally:
+            self.completed += 1
+        finished = time.time()
+        wait = started - submitted
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.run_total += finished - started
+        if wait > 1:
+            logger.warning(
+                "%s waited %.1f s in %s pool", func.__name__, wait, self.name
+            )
+        return res
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "queued": self.submitted - self.completed,
+            "completed": self.completed,
+            "wait_avg": self.wait_total / self.completed if self.completed else 0,
+            "wait_max": self.wait_max,
+            "run_total": self.run_total,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class Workers(object):
+    """
+    Threads for file I/O and base64 of documents, so document transfers
+    don't stall the event loop. Threads, not processes: a process would
+    pickle the whole file content to it and back.
+    """
+
+    def __init__(self, io_size):
+        """
+        :type io_size: int
+        :param io_size: threads for file I/O and base64
+        """
+
+        self.io_pool = WorkerPool("io", ThreadPoolExecutor, io_size)
+
+    async def io(self, func, *args):
+        return await self.io_pool.run(func, *args)
+
+    def stats(self):
+        return {self.io_pool.name: self.io_pool.stats()}
+
+    def shutdown(self):
+        self.io_pool.shutdown()
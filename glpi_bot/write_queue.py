@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+import resilience
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Lists moved between with RPOPLPUSH and written together in transactions
+# share a hash tag
+QUEUE = storage.key("{{write_queue}}")
+# Jobs taken by one worker, so jobs of a running worker aren't recovered
+PROCESSING = "{{write_queue}}:processing:{}"
+# Single list of workers before they had their own
+LEGACY_PROCESSING = storage.key("{{write_queue}}:processing")
+# Tickets with held jobs, scored by the time to retry the first one
+DELAYED = storage.key("{{write_queue}}:delayed")
+# Jobs of a ticket held behind its job waiting for a retry, that job first
+HELD = "{{write_queue}}:held:{}"
+FAILED = storage.key("{{write_queue}}:failed")
+DONE = "write_queue:done:{}"
+# Worker writing the held jobs of a ticket
+CLAIM = "write_queue:claim:{}"
+# Longer than any GLPI write, so a claim only expires if its worker has died
+CLAIM_TTL = 600
+# Workers and their leases, a worker without a lease has stopped
+WORKERS = storage.key("write_queue:workers")
+LEASE = "write_queue:lease:{}"
+LEASE_TTL = 30
+# Seconds to wait for a new job before checking for due retries
+POLL = 1
+
+
+class RetryLater(Exception):
+    """
+    Raised by the job executor when GLPI is temporarily unavailable
+    """
+
+
+async def put(pool, kind, **job):
+    """
+    Store GLPI write job in the queue
+
+    :type kind: str
+    :param kind: job type
+    :param job: data for the job executor, must be JSON serializable.
+        Jobs are written in order per "ticket" of a "backend". A "path"
+        is a temporary file of the job, removed when the job is given up.
+    :return: job ID, it is also the idempotency key of the write
+    :rtype: str
+    """
+    job_id = job.pop("id", None) or uuid.uuid4().hex
+    job = {"id": job_id, "kind": kind, "attempts": 0, "created": time.time(), **job}
+    await pool.lpush(QUEUE, json.dumps(job))
+    logger.debug("Queued %s job %s", kind, job_id)
+    return job_id
+
+
+def ticket_of(job):
+    """
+    :type job: dict
+    :return: ticket the job writes to, unique across GLPI instances
+    :rtype: str
+    """
+    return "{}:{}".format(job.get("backend") or "", job["ticket"])
+
+
+async def requeue(pool, processing):
+    """
+    Move jobs of a processing list back to the end of the queue workers
+    take from, oldest last, so they are written before newer jobs
+
+    :type processing: str
+    :param processing: processing list of a worker
+    :return: number of moved jobs
+    :rtype: int
+    """
+    count = 0
+    while True:
+        # Newest first, BRPOPLPUSH puts jobs at the head
+        raw = await pool.lindex(processing, 0)
+        if raw is None:
+            return count
+        # A crash in between queues the job twice, DONE skips the copy
+        await pool.rpush(QUEUE, raw)
+        await pool.lrem(processing, 1, raw)
+        count += 1
+
+
+async def recover(pool):
+    """
+    Return jobs of workers that stopped without finishing them to the queue
+    """
+    count = await requeue(pool, LEGACY_PROCESSING)
+    for worker_id in await pool.smembers(WORKERS):
+        if await pool.exists(storage.key(LEASE, worker_id)):
+            continue
+        # Only one process recovers a worker
+        if await pool.srem(WORKERS, worker_id):
+            count += await requeue(pool, storage.key(PROCESSING, worker_id))
+    if count:
+        logger.warning("Recovered %s unfinished write jobs", count)
+    return count
+
+
+async def heartbeat(pool, worker_id):
+    """
+    Keep the lease of the worker and recover jobs of stopped workers
+    """
+    while True:
+        await pool.set(storage.key(LEASE, worker_id), 1, expire=LEASE_TTL)
+        await pool.sadd(WORKERS, worker_id)
+        try:
+            await recover(pool)
+        except Exception:  # noqa
+            logger.exception("Recovery of write jobs failed")
+        await asyncio.sleep(LEASE_TTL / 3)
+
+
+async def worker(pool, execute, fail, max_attempts, retry_cap, done_ttl, stopping=None):
+    """
+    Flush write jobs one by one, in the order they were queued for each
+    ticket, so writes to one ticket always land in order. A job that fails
+    for a transient reason is held with the later jobs of its ticket and
+    retried after a delay, while jobs of other tickets go on.
+
+    :type execute: callable
+    :type fail: callable
+    :type max_attempts: int
+    :type retry_cap: float
+    :type done_ttl: int
+    :type stopping: asyncio.Event
+    :param execute: coroutine function making the write, raises RetryLater
+    :param fail: coroutine function called with the job and error on failure
+    :param max_attempts: attempts before the job is given up
+    :param retry_cap: maximum delay between attempts
+    :param done_ttl: seconds to remember finished job IDs
+    :param stopping: set on shutdown, the worker returns when the write
+        in progress is done, held jobs keep their attempts and retry time
+        for the next process
+    """
+    stopping = stopping or asyncio.Event()
+    worker_id = uuid.uuid4().hex
+    processing = storage.key(PROCESSING, worker_id)
+    await pool.set(storage.key(LEASE, worker_id), 1, expire=LEASE_TTL)
+    await pool.sadd(WORKERS, worker_id)
+    lease = asyncio.ensure_future(heartbeat(pool, worker_id))
+    options = (execute, fail, max_attempts, retry_cap, done_ttl)
+    try:
+        while not stopping.is_set():
+            await flush_due(pool, stopping, *options)
+            await work(pool, processing, *options)
+    finally:
+        lease.cancel()
+    # Stopped between writes, nothing is written twice
+    if await requeue(pool, processing):
+        logger.info("Left write jobs for the next process")
+    await pool.srem(WORKERS, worker_id)
+    await pool.delete(storage.key(LEASE, worker_id))
+
+
+async def work(pool, processing, *options):
+    """
+    Take the next job from the queue and write it, unless an earlier job
+    of its ticket is held
+    """
+    with await (await storage.node(pool, QUEUE)) as redis:
+        raw = await redis.brpoplpush(QUEUE, processing, timeout=POLL)
+    if raw is None:
+        return
+    job = json.loads(raw)
+    ticket = ticket_of(job)
+    held = storage.key(HELD, ticket)
+
+    tr = (await storage.node(pool, QUEUE)).multi_exec()
+    if await is_done(pool, job):
+        pass
+    elif await pool.exists(held):
+        # An earlier job of the ticket waits for a retry
+        tr.rpush(held, raw)
+        tr.zadd(DELAYED, time.time(), ticket, exist=pool.ZSET_IF_NOT_EXIST)
+    else:
+        delay = await attempt(pool, job, *options)
+        if delay is not None:
+            # Later jobs of the ticket queue up behind this one
+            tr.lpush(held, json.dumps(job))
+            tr.zadd(DELAYED, time.time() + delay, ticket)
+    tr.lrem(processing, 1, raw)
+    await tr.execute()
+
+
+async def flush_due(pool, stopping, *options):
+    """
+    Write held jobs of the tickets whose retry time has come
+    """
+    for ticket in await pool.zrangebyscore(
+        DELAYED, max=time.time(), offset=0, count=10
+    ):
+        if stopping.is_set():
+            return
+        claim = storage.key(CLAIM, ticket)
+        if not await pool.set(claim, 1, expire=CLAIM_TTL, exist=pool.SET_IF_NOT_EXIST):
+            # Another worker writes them
+            continue
+        try:
+            await flush(pool, ticket, stopping, *options)
+        finally:
+            await pool.delete(claim)
+
+
+async def flush(pool, ticket, stopping, *options):
+    """
+    Write held jobs of a ticket in order, until one has to wait again
+    """
+    held = storage.key(HELD, ticket)
+    # Found again if the worker dies while writing
+    await pool.zadd(DELAYED, time.time() + CLAIM_TTL, ticket)
+    while not stopping.is_set():
+        raw = await pool.lindex(held, 0)
+        if raw is None:
+            break
+        job = json.loads(raw)
+        if not await is_done(pool, job):
+            delay = await attempt(pool, job, *options)
+            if delay is not None:
+                tr = (await storage.node(pool, QUEUE)).multi_exec()
+                tr.lset(held, 0, json.dumps(job))
+                tr.zadd(DELAYED, time.time() + delay, ticket)
+                await tr.execute()
+                return
+        await pool.lpop(held)
+    await pool.zrem(DELAYED, ticket)
+    # Jobs held meanwhile, or left when stopping, are written at once
+    if await pool.exists(held):
+        await pool.zadd(DELAYED, time.time(), ticket)
+
+
+async def is_done(pool, job):
+    if await pool.exists(storage.key(DONE, job["id"])):
+        logger.info("Skipped already written job %s", job["id"])
+        return True
+    return False
+
+
+async def attempt(pool, job, execute, fail, max_attempts, retry_cap, done_ttl):
+    """
+    Make one attempt to write the job
+
+    :type job: dict
+    :param job: the job, its attempts are counted
+    :return: seconds to wait before the next attempt, None if the job is
+        written or given up
+    :rtype: float
+    """
+    job["attempts"] += 1
+    try:
+        await execute(job)
+    except RetryLater as err:
+        if job["attempts"] < max_attempts:
+            delay = resilience.retry_delay(job["attempts"], base=1, cap=retry_cap)
+            logger.warning(
+                "Job %s attempt %s failed (%s), retry in %.1f s",
+                job["id"],
+                job["attempts"],
+                err,
+                delay,
+            )
+            return delay
+        await give_up(pool, job, err, fail)
+    except Exception as err:  # noqa
+        logger.exception("Job %s failed", job["id"])
+        await give_up(pool, job, err, fail)
+    else:
+        await pool.set(storage.key(DONE, job["id"]), 1, expire=done_ttl)
+        logger.debug("Job %s written", job["id"])
+    return None
+
+
+async def give_up(pool, job, err, fail):
+    await pool.lpush(FAILED, json.dumps({**job, "error": str(err)}))
+    try:
+        await fail(job, err)
+    except Exception:  # noqa
+        logger.exception("Failure handler of job %s failed", job["id"])
+    if job.get("path"):
+        # Nothing will upload the file any more
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, os.remove, job["path"])
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,210 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+# Bot modules import each other by name, like when bot.py runs
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "glpi_bot")
+)
+
+
+class FakeRedis(object):
+    """
+    In-memory stand-in for the aioredis commands the tested modules use
+    """
+
+    SET_IF_NOT_EXIST = "SET_IF_NOT_EXIST"
+    ZSET_IF_NOT_EXIST = "ZSET_IF_NOT_EXIST"
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            del self.data[key]
+            del self.expires[key]
+        value = self.data.get(key)
+        # Redis deletes emptied lists, sets and sorted sets
+        return isinstance(value, (str, bytes)) or bool(value)
+
+    async def set(self, key, value, expire=0, exist=None):
+        if exist == self.SET_IF_NOT_EXIST and self._alive(key):
+            return False
+        self.data[key] = value if isinstance(value, (str, bytes)) else str(value)
+        self.expires.pop(key, None)
+        if expire:
+            self.expires[key] = time.monotonic() + expire
+        return True
+
+    async def get(self, key, encoding=None):
+        return self.data.get(key) if self._alive(key) else None
+
+    async def exists(self, key):
+        return int(self._alive(key))
+
+    async def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    async def expire(self, key, timeout):
+        self.expires[key] = time.monotonic() + timeout
+
+    async def ttl(self, key):
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(self.expires[key] - time.monotonic())
+
+    async def rename(self, key, newkey):
+        self.data[newkey] = self.data.pop(key)
+        self.expires.pop(newkey, None)
+
+    async def hmset_dict(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    async def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    async def hget(self, key, field):
+        return (self.data.get(key) or {}).get(field)
+
+    async def hgetall(self, key):
+        return dict(self.data.get(key) or {})
+
+    async def type(self, key):
+        value = self.data.get(key)
+        # Sorted sets are dicts too, tests don't mix them with hashes
+        types = {str: "string", bytes: "string", dict: "hash", list: "list"}
+        return types.get(type(value), "none") if value is not None else "none"
+
+    async def iscan(self, count=None):
+        self.scans = getattr(self, "scans", 0) + 1
+        for key in list(self.data):
+            yield key
+
+    async def hmget(self, key, *fields):
+        return [(self.data.get(key) or {}).get(field) for field in fields]
+
+    async def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(str(m) for m in members)
+
+    async def srem(self, key, member):
+        members = self.data.get(key, set())
+        removed = int(str(member) in members)
+        members.discard(str(member))
+        return removed
+
+    async def smembers(self, key):
+        return list(self.data.get(key, set()))
+
+    async def lpush(self, key, *values):
+        for value in values:
+            self.data.setdefault(key, []).insert(0, value)
+
+    async def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+
+    async def lindex(self, key, index):
+        items = self.data.get(key) or []
+        return items[index] if -len(items) <= index < len(items) else None
+
+    async def lrem(self, key, count, value):
+        items = self.data.get(key) or []
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    async def lrange(self, key, start=0, stop=-1):
+        return list(self.data.get(key) or [])
+
+    async def lpop(self, key):
+        items = self.data.get(key) or []
+        return items.pop(0) if items else None
+
+    async def lset(self, key, index, value):
+        self.data[key][index] = value
+
+    async def zadd(self, key, score, member, exist=None):
+        scores = self.data.setdefault(key, {})
+        if exist == self.ZSET_IF_NOT_EXIST and member in scores:
+            return 0
+        scores[member] = score
+        return 1
+
+    async def zrem(self, key, member):
+        return int(self.data.get(key, {}).pop(member, None) is not None)
+
+    async def zrangebyscore(self, key, min=float("-inf"), max=float("inf"), **_):
+        scores = self.data.get(key, {})
+        return sorted((m for m in scores if min <= scores[m] <= max), key=scores.get)
+
+    async def watch(self, *keys):
+        pass
+
+    def multi_exec(self):
+        return _Transaction(self)
+
+    async def brpoplpush(self, source, destination, timeout=0):
+        deadline = time.monotonic() + timeout
+        while not self.data.get(source):
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(0.01)
+        value = self.data[source].pop()
+        self.data.setdefault(destination, []).insert(0, value)
+        return value
+
+    def items(self, key):
+        """
+        :return: list from the end BRPOPLPUSH takes, the next job first
+        """
+        return list(reversed(self.data.get(key) or []))
+
+    def __await__(self):
+        # "with await pool as redis" of a dedicated connection
+        yield from []
+        return _Connection(self)
+
+
+class _Transaction(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+
+        return command
+
+    async def execute(self):
+        return [await func(*args, **kwargs) for func, args, kwargs in self.commands]
+
+
+class _Connection(object):
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __enter__(self):
+        return self.redis
+
+    def __exit__(self, *exc):
+        pass
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    loop.close()
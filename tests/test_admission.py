@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import admission
+
+
+def limits(**kwargs):
+    options = {"glpi_limit": 1, "transfer_limit": 1, "user_limit": 1, "wait": 0.01}
+    return admission.Admission(**{**options, **kwargs})
+
+
+def test_user_over_limit_is_shed(run):
+    async def scenario():
+        control = limits(user_limit=2)
+        async with control.user(1), control.user(1):
+            with pytest.raises(admission.Busy):
+                async with control.user(1):
+                    pass
+            # Other users have their own limit
+            async with control.user(2):
+                pass
+        return control.in_flight
+
+    assert run(scenario()) == {}
+
+
+def test_user_slot_released_on_error(run):
+    async def scenario():
+        control = limits()
+        with pytest.raises(RuntimeError):
+            async with control.user(1):
+                raise RuntimeError
+        async with control.user(1):
+            pass
+
+    run(scenario())
+
+
+def test_glpi_slot_waits_then_gives_up(run):
+    async def scenario():
+        control = limits(wait=0.05)
+        async with control.glpi("a"):
+            with pytest.raises(admission.Busy):
+                async with control.glpi("a"):
+                    pass
+            # Each instance has its own slots
+            async with control.glpi("b"):
+                pass
+
+    run(scenario())
+
+
+def test_glpi_slot_freed_while_waiting(run):
+    order = []
+
+    async def call(control, n, delay):
+        async with control.glpi("a"):
+            order.append(n)
+            await asyncio.sleep(delay)
+
+    async def scenario():
+        control = limits(wait=1)
+        await asyncio.gather(call(control, 1, 0.02), call(control, 2, 0))
+
+    run(scenario())
+    assert order == [1, 2]
+
+
+def test_transfer_slots_are_shared(run):
+    async def scenario():
+        control = limits(transfer_limit=2)
+        async with control.transfer(), control.transfer():
+            with pytest.raises(admission.Busy):
+                async with control.transfer():
+                    pass
+        async with control.transfer():
+            pass
+
+    run(scenario())
@@ -0,0 +1,238 @@
+import asyncio
+import xmlrpc.client
+
+import pytest
+
+import admission
+import bot
+import sessions as glpi_sessions
+import settings
+import telegram
+import user_state
+
+
+class Chat(object):
+    def __init__(self, sender_id=1, message_id=10):
+        self.id = sender_id
+        self.sender = {"id": sender_id}
+        self.message = {"message_id": message_id}
+        self.sent = []
+
+    def send_text(self, text, **options):
+        self.sent.append(text)
+
+
+class CallbackQuery(object):
+    def __init__(self, sender_id=1, data="ticket:1"):
+        self.src = {"from": {"id": sender_id}}
+        self.data = data
+        self.answers = []
+
+    def answer(self, text=None, **options):
+        self.answers.append(text)
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    limits = admission.Admission(1, 1, 1, 0.01)
+    monkeypatch.setattr(bot, "limits", limits)
+    return limits
+
+
+def test_admitted_sheds_updates_over_user_limit(limits, run):
+    release = asyncio.Event()
+    handled = []
+
+    @bot.admitted
+    async def handler(chat, match):
+        handled.append(chat.sender["id"])
+        await release.wait()
+        return "done"
+
+    async def scenario():
+        first = asyncio.ensure_future(handler(Chat(1), None))
+        await asyncio.sleep(0)
+        busy, other = Chat(1), Chat(2)
+        await handler(busy, None)
+        other_task = asyncio.ensure_future(handler(other, None))
+        await asyncio.sleep(0)
+        release.set()
+        return busy.sent, await first, await other_task
+
+    sent, first, other = run(scenario())
+    assert sent == [settings.BUSY_TEXT]
+    assert (first, other) == ("done", "done")
+    assert handled == [1, 2]
+    assert limits.in_flight == {}
+
+
+def test_admitted_answers_callback_when_busy(limits, run):
+    @bot.admitted
+    async def handler(chat, cq, match):
+        return "done"
+
+    async def scenario():
+        async with limits.user(1):
+            cq = CallbackQuery(1)
+            assert await handler(Chat(1), cq, None) is None
+            return cq.answers
+
+    assert run(scenario()) == [settings.BUSY_TEXT]
+
+
+class Reaction(object):
+    def __init__(self):
+        self.events = []
+
+    def loading(self, delay, show, restore):
+        self.events.append("loading")
+
+    def superseded(self):
+        self.events.append("superseded")
+
+
+def render(rendered):
+    @bot.latest_only
+    async def handler(chat, cq, match):
+        await asyncio.sleep(match)
+        rendered.append(cq.data)
+
+    return handler
+
+
+def test_latest_only_cancels_previous_tap_on_message(run):
+    rendered = []
+    handler = render(rendered)
+
+    async def scenario():
+        first = asyncio.ensure_future(handler(Chat(), CallbackQuery(data="1"), 0.05))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(handler(Chat(), CallbackQuery(data="2"), 0))
+        await asyncio.gather(first, second)
+
+    run(scenario())
+    assert rendered == ["2"]
+    assert bot.rendering == {}
+
+
+def test_latest_only_keeps_taps_on_other_messages(run):
+    rendered = []
+    handler = render(rendered)
+
+    async def scenario():
+        await asyncio.gather(
+            handler(Chat(message_id=10), CallbackQuery(data="1"), 0.02),
+            handler(Chat(message_id=11), CallbackQuery(data="2"), 0),
+        )
+
+    run(scenario())
+    assert rendered == ["2", "1"]
+
+
+class Bot(object):
+    def edit_message_reply_markup(self, chat_id, message_id, markup):
+        pass
+
+
+def test_latest_only_superseded_handler_does_not_restore_message(monkeypatch, run):
+    monkeypatch.setattr(bot, "bot", Bot())
+    handler = render([])
+    reactions = [Reaction(), Reaction()]
+
+    async def tap(reaction, data, delay):
+        telegram.feedback.set(reaction)
+        await handler(Chat(), CallbackQuery(data=data), delay)
+
+    async def scenario():
+        first = asyncio.ensure_future(tap(reactions[0], "1", 0.05))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, tap(reactions[1], "2", 0))
+
+    run(scenario())
+    assert reactions[0].events == ["loading", "superseded"]
+    assert reactions[1].events == ["loading"]
+
+
+class Backends(object):
+    def get(self, name):
+        return name
+
+
+@pytest.fixture
+def glpi(monkeypatch, redis):
+    from cryptography.fernet import Fernet
+
+    manager = glpi_sessions.SessionManager(600, 60, 3600, Fernet.generate_key())
+    calls = []
+
+    async def login(backend, login_name, login_password):
+        calls.append(("doLogin", login_name))
+        await asyncio.sleep(0.01)
+        if login_password != "secret":
+            return "Неверный логин или пароль"
+        return {"session": "new"}
+
+    async def glpi_request(backend, method, params):
+        calls.append((method, params["entity"]))
+        if params["entity"] == "gone":
+            raise xmlrpc.client.Fault(13, "Entity not found")
+
+    monkeypatch.setattr(bot, "pool", redis)
+    monkeypatch.setattr(bot, "sessions", manager)
+    monkeypatch.setattr(bot, "instances", Backends())
+    monkeypatch.setattr(bot, "login", login)
+    monkeypatch.setattr(bot, "glpi_request", glpi_request)
+    return calls
+
+
+def logged_in(redis, password="secret", entity="", session="expired"):
+    return user_state.update(
+        redis,
+        1,
+        session=session,
+        backend="glpi",
+        entity=entity,
+        credential=bot.sessions.seal("ivan", password) if password else "",
+    )
+
+
+def test_relogin_renews_session_and_entity(glpi, redis, run):
+    run(logged_in(redis, entity="5"))
+
+    assert run(bot.relogin(1, "expired"))
+    assert run(user_state.get(redis, 1, "session")) == "new"
+    assert glpi == [("doLogin", "ivan"), ("setMyEntity", "5")]
+    assert bot.sessions.age(1) is not None
+
+
+def test_concurrent_relogins_log_in_once(glpi, redis, run):
+    run(logged_in(redis))
+
+    async def both():
+        return await asyncio.gather(
+            bot.relogin(1, "expired"), bot.relogin(1, "expired")
+        )
+
+    assert run(both()) == [True, True]
+    assert glpi == [("doLogin", "ivan")]
+
+
+def test_relogin_without_credential(glpi, redis, run):
+    run(logged_in(redis, password=None))
+
+    assert not run(bot.relogin(1, "expired"))
+    assert glpi == []
+
+
+def test_relogin_with_changed_password(glpi, redis, run):
+    run(logged_in(redis, password="old"))
+
+    assert not run(bot.relogin(1, "expired"))
+    assert run(user_state.get(redis, 1, "session")) == "expired"
+
+
+def test_relogin_forgets_entity_that_is_gone(glpi, redis, run):
+    run(logged_in(redis, entity="gone"))
+
+    assert run(bot.relogin(1, "expired"))
+    assert run(user_state.get(redis, 1, "entity")) == ""
@@ -0,0 +1,59 @@
+import dictionaries
+import storage
+
+
+def fetcher(calls, objects):
+    async def fetch(method, **kwargs):
+        calls.append(method)
+        if objects is None:
+            return False
+        if method == "getObject":
+            return {"id": kwargs["id"], "name": "New"}
+        return objects[kwargs["start"] : kwargs["start"] + kwargs["limit"]]
+
+    return fetch
+
+
+def names(redis, run, fetch, ids):
+    return run(dictionaries.names(redis, fetch, "glpi", "Entity", ids, page=2))
+
+
+def test_names_come_from_loaded_dictionary(redis, run):
+    calls = []
+    objects = [
+        {"id": 1, "name": "Root", "completename": "Root"},
+        {"id": 2, "name": "IT", "completename": "Root > IT"},
+        {"id": 3, "name": "HR"},
+    ]
+    fetch = fetcher(calls, objects)
+
+    assert names(redis, run, fetch, [2, "3", None, 0]) == {
+        "2": "Root > IT",
+        "3": "HR",
+    }
+    assert names(redis, run, fetch, [1]) == {"1": "Root"}
+    assert calls == ["listObjects", "listObjects"]
+    # Created after the load
+    assert names(redis, run, fetch, [4]) == {"4": "New"}
+    assert calls[-1] == "getObject"
+
+
+def test_failed_load_is_not_retried_at_once(redis, run):
+    calls = []
+    failing = fetcher(calls, None)
+
+    assert names(redis, run, failing, [2]) == {"2": "#2"}
+    assert names(redis, run, failing, [2, 3]) == {"2": "#2", "3": "#3"}
+    assert calls == ["listObjects"]
+
+    key = storage.key(dictionaries.KEY, "glpi", "Entity")
+    run(redis.delete("{}:failed".format(key)))
+    assert names(redis, run, fetcher(calls, [{"id": 2, "name": "IT"}]), [2]) == {
+        "2": "IT"
+    }
+
+
+def test_user_display_name():
+    user = {"name": "ivanov", "realname": "Иванов", "firstname": "Иван"}
+    assert dictionaries.display_name("User", user) == "Иванов Иван"
+    assert dictionaries.display_name("User", {"name": "ivanov"}) == "ivanov"
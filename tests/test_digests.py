@@ -0,0 +1,115 @@
+import datetime
+
+import pytest
+
+import digests
+import storage
+import user_state
+
+UTC = datetime.timezone.utc
+
+
+def test_parse_times_sorts_and_dedupes():
+    assert digests.parse_times("20:00, 08:00,08:00") == [
+        datetime.time(8),
+        datetime.time(20),
+    ]
+    with pytest.raises(ValueError):
+        digests.parse_times(" , ")
+
+
+@pytest.mark.parametrize(
+    "value,offset",
+    [("+05:00", 300), ("+5", 300), ("UTC-3", -180), ("gmt+0530", 330), ("Z", 0)],
+)
+def test_parse_timezone(value, offset):
+    tz = digests.parse_timezone(value)
+    assert tz.utcoffset(None) == datetime.timedelta(minutes=offset)
+
+
+@pytest.mark.parametrize("value", ["+15", "5", "Europe/Moscow"])
+def test_parse_timezone_rejects(value):
+    with pytest.raises(ValueError):
+        digests.parse_timezone(value)
+
+
+def test_format_timezone():
+    assert digests.format_timezone(digests.parse_timezone("-3:30")) == "-03:30"
+
+
+def test_slots_of_shifts():
+    tz = digests.parse_timezone("+05:00")
+    times = digests.parse_times("08:00,20:00")
+    # 21:30 local
+    slot, previous = digests.slots(
+        times, tz, datetime.datetime(2020, 3, 1, 16, 30, tzinfo=UTC)
+    )
+    assert slot == datetime.datetime(2020, 3, 1, 20, tzinfo=tz)
+    assert previous == datetime.datetime(2020, 3, 1, 8, tzinfo=tz)
+
+
+def test_slots_before_first_time_of_day():
+    tz = digests.parse_timezone("+05:00")
+    times = digests.parse_times("09:00")
+    # 01:00 local, the next day in the time zone of the user
+    slot, previous = digests.slots(
+        times, tz, datetime.datetime(2020, 3, 1, 20, tzinfo=UTC)
+    )
+    assert slot == datetime.datetime(2020, 3, 1, 9, tzinfo=tz)
+    assert previous == datetime.datetime(2020, 2, 29, 9, tzinfo=tz)
+
+
+def test_collect_picks_tickets_of_user():
+    def ticket(id, users_id, date_mod, time_to_resolve=None):
+        return {
+            "id": id,
+            "date_mod": date_mod,
+            "time_to_resolve": time_to_resolve,
+            "users": {"assign": [{"users_id": users_id}]},
+        }
+
+    tickets = [
+        ticket(1, "7", "2020-03-01 10:00:00", "2020-03-01 12:00:00"),
+        ticket(2, 7, "2020-02-28 10:00:00"),
+        ticket(3, "9", "2020-03-01 10:00:00"),
+    ]
+    digest = digests.collect(
+        tickets,
+        7,
+        datetime.datetime(2020, 3, 1, 8),
+        datetime.datetime(2020, 3, 1, 20),
+    )
+    assert [t["id"] for t in digest["assigned"]] == [1, 2]
+    assert [t["id"] for t in digest["overdue"]] == [1]
+    assert [t["id"] for t in digest["updated"]] == [1]
+
+
+def subscriber(redis, run, sender_id=42):
+    # Digest time has just passed
+    now = datetime.datetime.now(UTC) - datetime.timedelta(minutes=1)
+    state = {"session": "abc", "id": 7, "digest": now.strftime("%H:%M")}
+    run(redis.set(storage.key(user_state.KEY, sender_id), user_state.pack(state)))
+    run(redis.sadd(storage.key(digests.SUBSCRIBERS), sender_id))
+
+
+def send_due(redis, fetch, sent):
+    return digests.send_due(
+        redis, fetch, lambda chat_id, text: sent.append(chat_id), 3600, "+00:00"
+    )
+
+
+def test_failed_query_releases_claimed_digests(redis, run):
+    subscriber(redis, run)
+    sent = []
+
+    async def busy(members):
+        raise RuntimeError("GLPI is busy")
+
+    async def fetch(members):
+        return []
+
+    assert run(send_due(redis, busy, sent)) == 0
+    assert run(send_due(redis, fetch, sent)) == 1
+    # Claimed by the run that sent it
+    assert run(send_due(redis, fetch, sent)) == 0
+    assert sent == [42]
@@ -0,0 +1,63 @@
+import asyncio
+from xml.parsers.expat import ExpatError
+
+import pytest
+
+import backends
+import bot
+
+
+class Client(object):
+    sizes = {}
+
+    def abort(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Pool(object):
+    size = 1
+
+    def __init__(self, call):
+        self.run = call
+
+
+@pytest.fixture
+def backend():
+    backend = backends.Backend("test", "http://glpi", "user", "password", 1)
+    backend.checkout = lambda timeout: Client()
+    # Open circuit that lets a trial call through
+    backend.breaker.state = backend.breaker.OPEN
+    backend.breaker.opened_at = -backend.breaker.recovery_timeout
+    return backend
+
+
+def test_cancelled_trial_does_not_wedge_breaker(backend, run):
+    async def hang(call):
+        await asyncio.sleep(60)
+
+    backend.pool = Pool(hang)
+
+    async def scenario():
+        task = asyncio.ensure_future(bot.glpi_request(backend, "doLogin", {}))
+        await asyncio.sleep(0.01)
+        assert backend.breaker.state == backend.breaker.HALF_OPEN
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(scenario())
+    assert backend.breaker.allow()
+
+
+def test_broken_response_reopens_circuit(backend, run):
+    async def broken(call):
+        raise ExpatError("no element found")
+
+    backend.pool = Pool(broken)
+
+    assert run(bot.glpi_request(backend, "doLogin", {})) is False
+    assert backend.breaker.state == backend.breaker.OPEN
+    assert not backend.breaker.allow()
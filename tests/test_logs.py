@@ -0,0 +1,52 @@
+import logging
+import queue
+import threading
+
+import logs
+
+
+def record(msg, *args):
+    return logging.LogRecord("bot", logging.DEBUG, __file__, 1, msg, args, None)
+
+
+def prepared(rec):
+    records = queue.Queue()
+    logs.LazyQueueHandler(records).handle(rec)
+    return records.get_nowait()
+
+
+def test_payload_is_formatted_from_copy():
+    ticket = {"id": 1, "followups": []}
+    rec = prepared(record("Ticket %s", logs.Payload(ticket)))
+    # Changed by the event loop before the listener formats the record
+    ticket["followups"].append("new")
+    assert rec.getMessage() == "Ticket {'followups': [], 'id': 1}"
+
+
+def test_other_messages_are_formatted_at_once():
+    ids = [1]
+    rec = prepared(record("IDs %s", ids))
+    ids.append(2)
+    assert rec.getMessage() == "IDs [1]"
+    assert rec.args is None
+
+
+def test_payload_that_cant_be_copied():
+    lock = threading.Lock()
+    rec = prepared(record("%s %s", logs.Payload([lock]), lock))
+    assert rec.getMessage().startswith("[<unlocked _thread.lock")
+
+
+def test_payload_is_cut():
+    assert str(logs.Payload("x" * 30, limit=10)) == "'xxxxxxxxx... (32 chars)"
+
+
+def test_sampling_filter():
+    sampling = logs.SamplingFilter({"bot": 0, "bot.test_sampling_filter": 1})
+    rec = record("sampled")
+    rec.funcName = "test_sampling_filter"
+    assert sampling.filter(rec)
+    rec.funcName = "other"
+    assert not sampling.filter(rec)
+    rec.levelno = logging.INFO
+    assert sampling.filter(rec)
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+import resilience
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = resilience.CircuitBreaker(3, 10)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == breaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_failures(clock):
+    breaker = resilience.CircuitBreaker(2, 10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == breaker.CLOSED
+
+
+def test_breaker_lets_single_trial_after_recovery(clock):
+    breaker = resilience.CircuitBreaker(1, 10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_failed_trial_reopens(clock):
+    breaker = resilience.CircuitBreaker(5, 10)
+    for _ in range(5):
+        breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+    clock[0] += 10
+    assert breaker.allow()
+
+
+def test_breaker_released_trial_allows_next_call(clock):
+    breaker = resilience.CircuitBreaker(1, 10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    # Trial was cancelled or shed, without success or failure
+    breaker.release()
+    assert breaker.state == breaker.OPEN
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+
+
+def test_breaker_release_keeps_closed_circuit(clock):
+    breaker = resilience.CircuitBreaker(1, 10)
+    breaker.release()
+    assert breaker.state == breaker.CLOSED
+
+
+def test_adaptive_timeout_is_clamped():
+    timeouts = resilience.AdaptiveTimeout(5, 1, 30, maximums={"getDocument": 120})
+    assert timeouts.get("getTicket") == 5
+    timeouts.observe("getTicket", 0.1)
+    assert timeouts.get("getTicket") == 1
+    timeouts.observe("getDocument", 100)
+    assert timeouts.get("getDocument") == 120
+    timeouts.observe("listTickets", 100)
+    assert timeouts.get("listTickets") == 30
+
+
+def test_adaptive_timeout_follows_latency():
+    timeouts = resilience.AdaptiveTimeout(5, 0.1, 30)
+    timeouts.observe("getTicket", 2)
+    # Smoothed latency plus four deviations
+    assert timeouts.get("getTicket") == pytest.approx(2 + 4 * 1)
+    for _ in range(50):
+        timeouts.observe("getTicket", 0.5)
+    assert timeouts.get("getTicket") == pytest.approx(0.5, abs=0.1)
+
+
+def test_response_cache_evicts_oldest_and_expired(clock):
+    cache = resilience.ResponseCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    clock[0] += 61
+    assert cache.get("c") is None
+    assert cache.stats()["hit_rate"] == 0.5
+
+
+def test_health_history_p95():
+    health = resilience.HealthHistory(100)
+    for latency in range(1, 21):
+        health.record(True, latency / 10, result={"glpi": "9.5"})
+    health.record(False, 30)
+    stats = health.stats()
+    assert stats["p95"] == 1.9
+    assert stats["availability"] == 20 / 21
+    assert not stats["ok"]
+    assert health.result == {"glpi": "9.5"}
+
+
+def test_stale_flag_of_subtasks_reaches_handler(run):
+    async def names():
+        resilience.mark_stale()
+
+    async def handler():
+        resilience.track_stale()
+        await asyncio.gather(names(), asyncio.sleep(0))
+        return resilience.is_stale()
+
+    assert run(handler())
+
+
+def test_stale_flag_is_per_handler(run):
+    async def handler(cached):
+        resilience.track_stale()
+        if cached:
+            resilience.mark_stale()
+        await asyncio.sleep(0)
+        return resilience.is_stale()
+
+    async def both():
+        return await asyncio.gather(handler(True), handler(False))
+
+    assert run(both()) == [True, False]
@@ -0,0 +1,117 @@
+import asyncio
+import functools
+
+import idempotency
+import telegram
+
+
+class Bot(object):
+    """
+    Part of aiotg Bot the mixin builds on: handlers run in their own tasks
+    """
+
+    def __init__(self, handler):
+        self._offset = 0
+        self.handler = telegram.traced(handler)
+
+    def _process_update(self, update):
+        asyncio.ensure_future(self.handler(update))
+
+
+class IdempotentBot(telegram.IdempotentMixin, Bot):
+    pass
+
+
+def idempotent_bot(redis, handler):
+    bot = IdempotentBot(handler)
+    bot.first_time = functools.partial(idempotency.first_time, redis, ttl=60)
+    return bot
+
+
+def test_repeated_update_is_handled_once(redis, run):
+    handled = []
+
+    async def handler(update):
+        handled.append(update["update_id"])
+
+    async def scenario():
+        # Another replica shares Redis
+        bots = [idempotent_bot(redis, handler), idempotent_bot(redis, handler)]
+        for bot in bots + bots:
+            bot._process_update({"update_id": 5})
+        await asyncio.sleep(0.01)
+        return [bot._offset for bot in bots]
+
+    assert run(scenario()) == [5, 5]
+    assert handled == [5]
+
+
+def test_bot_without_dedup_handles_every_update(run):
+    handled = []
+
+    async def handler(update):
+        handled.append(update["update_id"])
+
+    async def scenario():
+        bot = IdempotentBot(handler)
+        bot._process_update({"update_id": 5})
+        bot._process_update({"update_id": 5})
+        await asyncio.sleep(0.01)
+
+    run(scenario())
+    assert handled == [5, 5]
+
+
+def test_write_id_is_stable():
+    first = idempotency.write_id(1, 10, {"ticket": 7, "text": "Готово"})
+    again = idempotency.write_id(1, 10, {"text": "Готово", "ticket": 7})
+    assert first == again
+    assert first != idempotency.write_id(1, 11, {"ticket": 7, "text": "Готово"})
+
+
+def test_drain_waits_for_handlers(redis, run):
+    handled = []
+
+    async def handler(update):
+        await asyncio.sleep(0.02)
+        handled.append(update["update_id"])
+
+    async def scenario():
+        bot = idempotent_bot(redis, handler)
+        bot._process_update({"update_id": 1})
+        bot._process_update({"update_id": 2})
+        return await bot.drain(1), bot._in_flight
+
+    assert run(scenario()) == ([], {})
+    assert handled == [1, 2]
+
+
+def test_unhandled_updates_are_handed_over(redis, run):
+    handled = []
+
+    async def slow(update):
+        await asyncio.sleep(update["delay"])
+        handled.append(("old", update["update_id"]))
+
+    async def handler(update):
+        handled.append(("new", update["update_id"]))
+
+    async def scenario():
+        old = idempotent_bot(redis, slow)
+        for update_id, delay in ((1, 0), (2, 60), (3, 60)):
+            old._process_update({"update_id": update_id, "delay": delay})
+        await asyncio.sleep(0.01)
+        unhandled = await old.drain(0.05)
+        await idempotency.hand_over(redis, old._offset, unhandled, 60)
+
+        new = idempotent_bot(redis, handler)
+        new.resume(*await idempotency.take_over(redis))
+        await new.drain(1)
+        return [u["update_id"] for u in unhandled], new._offset
+
+    assert run(scenario()) == ([2, 3], 3)
+    assert handled == [("old", 1), ("new", 2), ("new", 3)]
+
+
+def test_take_over_without_previous_process(redis, run):
+    assert run(idempotency.take_over(redis)) == (0, [])
@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+import storage
+import ticket_stats
+
+
+def ticket(users_id, time_to_resolve=None):
+    return {
+        "time_to_resolve": time_to_resolve,
+        "users": {"assign": [{"users_id": users_id}]},
+    }
+
+
+TICKETS = [ticket(7, "2000-01-01 00:00:00"), ticket("7"), ticket(9)]
+
+
+def fetcher(calls, result=TICKETS):
+    async def fetch(method, **kwargs):
+        calls.append(kwargs["start"])
+        await asyncio.sleep(0.01)
+        if isinstance(result, Exception):
+            raise result
+        return result[kwargs["start"] : kwargs["start"] + kwargs["limit"]]
+
+    return fetch
+
+
+async def settle():
+    while ticket_stats._refreshing:
+        await asyncio.sleep(0.01)
+
+
+def test_first_request_computes_in_background(redis, run):
+    calls = []
+
+    async def scenario():
+        fetch = fetcher(calls)
+        first = await ticket_stats.entity_stats(redis, fetch, "glpi", "1", 60, page=2)
+        # A refresh in progress isn't started again
+        await ticket_stats.entity_stats(redis, fetch, "glpi", "1", 60, page=2)
+        await settle()
+        return first, await ticket_stats.entity_stats(redis, fetch, "glpi", "1", 60)
+
+    first, stats = run(scenario())
+    assert first is None
+    assert calls == [0, 2]
+    assert ticket_stats.user_counters(stats, 7) == {
+        "assigned": 2,
+        "overdue": 1,
+        "total": 3,
+    }
+
+
+def test_stale_counters_are_shown_while_refreshed(redis, run):
+    key = storage.key(ticket_stats.KEY, "glpi", "1")
+    old = {"total": 1, "assigned": {}, "overdue": {}}
+    run(redis.set(key, json.dumps({"stats": old, "computed": 0})))
+
+    async def scenario():
+        stats = await ticket_stats.entity_stats(redis, fetcher([]), "glpi", "1", 60)
+        await settle()
+        return stats
+
+    assert run(scenario()) == old
+    assert json.loads(run(redis.get(key)))["stats"]["total"] == 3
+
+
+def test_failed_refresh_keeps_nothing(redis, run):
+    async def scenario():
+        fetch = fetcher([], RuntimeError("GLPI is busy"))
+        await ticket_stats.entity_stats(redis, fetch, "glpi", "1", 60)
+        await settle()
+
+    run(scenario())
+    assert run(redis.get(storage.key(ticket_stats.KEY, "glpi", "1"))) is None
+
+
+def test_user_without_entity_has_own_scope():
+    assert ticket_stats.scope_of("", 42) != ticket_stats.scope_of("", 43)
+    assert ticket_stats.scope_of("5", 42) == ticket_stats.scope_of("5", 43)
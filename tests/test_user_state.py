@@ -0,0 +1,43 @@
+import msgpack
+
+import storage
+import user_state
+
+
+def test_round_trip_fills_defaults():
+    state = user_state.unpack(
+        user_state.pack({"session": "abc", "id": "42", "entity": None})
+    )
+    assert state["session"] == "abc"
+    assert state["id"] == 42
+    assert state["entity"] == ""
+    assert state["timezone"] == ""
+    assert set(state) == set(user_state.DEFAULTS)
+
+
+def test_older_record_is_padded():
+    state = user_state.unpack(msgpack.packb([1, "abc", "Ivan"]))
+    assert state["name"] == "Ivan"
+    assert state["digest"] == ""
+
+
+def test_newer_record_is_ignored():
+    raw = msgpack.packb([user_state.VERSION + 1, "abc"])
+    assert user_state.unpack(raw) == user_state.DEFAULTS
+
+
+def test_missing_record():
+    assert user_state.unpack(None) == user_state.DEFAULTS
+
+
+def test_migrate_converts_old_hashes_once(redis, run):
+    old = {"glpi_session": "abc", "glpi_id": "42", "glpi_name": "ivanov"}
+    run(redis.hmset_dict("1122", old))
+
+    run(user_state.migrate(redis))
+    state = user_state.unpack(run(redis.get(storage.key(user_state.KEY, "1122"))))
+    assert (state["session"], state["id"], state["name"]) == ("abc", 42, "ivanov")
+    assert run(redis.exists("1122")) == 0
+
+    run(user_state.migrate(redis))
+    assert redis.scans == 1
@@ -0,0 +1,30 @@
+import base64
+import os
+
+import utils
+
+
+def test_file_to_b64_joins_chunks(tmp_path):
+    path = tmp_path / "scan.pdf"
+    # Over two chunks and not a multiple of 3 bytes
+    content = os.urandom(2 * 3 * 2**18 + 1000)
+    path.write_bytes(content)
+    assert utils.file_to_b64(str(path)) == base64.b64encode(content).decode()
+
+
+def test_file_to_b64_of_empty_file(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    assert utils.file_to_b64(str(path)) == ""
+
+
+def test_checked_file_renames_or_removes(tmp_path):
+    good = tmp_path / "tmp1"
+    good.write_bytes(b"1")
+    assert utils.checked_file(str(good), "a.txt", "ab", "ab") == str(tmp_path / "a.txt")
+    assert (tmp_path / "a.txt").exists()
+
+    bad = tmp_path / "tmp2"
+    bad.write_bytes(b"2")
+    assert utils.checked_file(str(bad), "b.txt", "ab", "cd") is False
+    assert not bad.exists()
@@ -0,0 +1,124 @@
+import base64
+import io
+import os
+from xmlrpc import client
+
+import pytest
+
+import webservices_xmlrpc
+
+
+def response(content, **fields):
+    document = {"id": "1", "filename": "scan.pdf", **fields}
+    document["base64"] = base64.b64encode(content).decode()
+    return client.dumps(({"document": document, **document},), methodresponse=True)
+
+
+def unmarshal(xml, chunk=7):
+    out = io.BytesIO()
+    sink = webservices_xmlrpc.Base64Sink(out)
+    unmarshaller = webservices_xmlrpc.StreamingUnmarshaller(sink)
+    parser = client.ExpatParser(unmarshaller)
+    # Small chunks split base64 text between data() calls
+    for i in range(0, len(xml), chunk):
+        parser.feed(xml[i : i + chunk])
+    parser.close()
+    return unmarshaller.close()[0], sink, out.getvalue()
+
+
+def test_streaming_unmarshaller_writes_document_to_sink():
+    content = os.urandom(10000)
+    result, sink, written = unmarshal(response(content, mime="application/pdf"))
+
+    assert written == content
+    assert sink.size == len(content)
+    assert sink.close() == webservices_xmlrpc.hashlib.sha1(content).hexdigest()
+    assert result["base64"] is None
+    assert result["mime"] == "application/pdf"
+    assert result["filename"] == "scan.pdf"
+
+
+def test_streaming_unmarshaller_keeps_nested_field():
+    content = b"nested document"
+    result, _, written = unmarshal(response(content))
+
+    # Only the top-level member is streamed
+    assert written == content
+    assert base64.b64decode(result["document"]["base64"]) == content
+
+
+def test_base64_sink_decodes_whitespace_and_split_groups():
+    out = io.BytesIO()
+    sink = webservices_xmlrpc.Base64Sink(out)
+    encoded = base64.encodebytes(b"x" * 100).decode()
+    for i in range(0, len(encoded), 5):
+        sink.write(encoded[i : i + 5])
+    sink.close()
+    assert out.getvalue() == b"x" * 100
+
+
+def test_base64_sink_rejects_truncated_data():
+    sink = webservices_xmlrpc.Base64Sink(io.BytesIO())
+    sink.write("eHh4eA")
+    with pytest.raises(ValueError):
+        sink.close()
+
+
+class Connection(object):
+    def __init__(self):
+        self.headers = {}
+        self.body = None
+
+    def putheader(self, name, value):
+        self.headers[name] = value
+
+    def endheaders(self, body):
+        self.body = body
+
+
+class Response(io.BytesIO):
+    def __init__(self, body, encoding=""):
+        super().__init__(body)
+        self.encoding = encoding
+
+    def getheader(self, name, default=None):
+        return self.encoding if name == "Content-Encoding" else default
+
+
+def transport(**kwargs):
+    return webservices_xmlrpc.GLPITransport(use_datetime=True, **kwargs)
+
+
+@pytest.mark.parametrize("size, compressed", [(100, False), (101, True)])
+def test_request_compressed_above_threshold(size, compressed):
+    t = transport(gzip_threshold=100)
+    connection = Connection()
+    body = b"x" * size
+    t.send_content(connection, body)
+
+    assert ("Content-Encoding" in connection.headers) == compressed
+    sent = client.gzip_decode(connection.body) if compressed else connection.body
+    assert sent == body
+    assert connection.headers["Content-Length"] == str(len(connection.body))
+    assert t.sizes["request_wire"] == len(connection.body)
+
+
+def test_request_not_compressed_without_threshold():
+    connection = Connection()
+    transport().send_content(connection, b"x" * 100000)
+    assert "Content-Encoding" not in connection.headers
+
+
+@pytest.mark.parametrize("encoding", ["", "gzip"])
+def test_response_decompressed_while_parsing(encoding):
+    t = transport()
+    xml = client.dumps(({"name": "x" * 10000},), methodresponse=True).encode()
+    body = client.gzip_encode(xml) if encoding else xml
+
+    assert t.parse_response(Response(body, encoding)) == ({"name": "x" * 10000},)
+    assert t.sizes == {"response_raw": len(xml), "response_wire": len(body)}
+
+
+def test_transport_asks_for_gzip_response():
+    assert transport().accept_gzip_encoding
+    assert not transport(gzip_response=False).accept_gzip_encoding
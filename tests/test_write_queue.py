@@ -0,0 +1,162 @@
+import asyncio
+import json
+
+import pytest
+
+import storage
+import write_queue
+
+
+@pytest.fixture(autouse=True)
+def poll(monkeypatch):
+    # Retries are due in milliseconds, don't wait for new jobs long
+    monkeypatch.setattr(write_queue, "POLL", 0.01)
+
+
+def numbers(redis, key=write_queue.QUEUE):
+    return [json.loads(raw)["n"] for raw in redis.items(key)]
+
+
+async def queue(redis, *ns, ticket="1"):
+    return [
+        await write_queue.put(redis, "followup", n=n, ticket=ticket, backend="")
+        for n in ns
+    ]
+
+
+async def take(redis, worker_id):
+    await redis.sadd(write_queue.WORKERS, worker_id)
+    return await redis.brpoplpush(
+        write_queue.QUEUE, storage.key(write_queue.PROCESSING, worker_id)
+    )
+
+
+def test_recover_returns_jobs_before_newer_ones(redis, run):
+    run(queue(redis, 1, 2, 3))
+    run(take(redis, "stopped"))
+
+    assert run(write_queue.recover(redis)) == 1
+    assert numbers(redis) == [1, 2, 3]
+    assert "stopped" not in run(redis.smembers(write_queue.WORKERS))
+
+
+def test_recover_keeps_order_of_several_jobs(redis, run):
+    run(queue(redis, 1, 2, 3))
+    run(take(redis, "stopped"))
+    run(take(redis, "stopped"))
+
+    run(write_queue.recover(redis))
+    assert numbers(redis) == [1, 2, 3]
+
+
+def test_recover_skips_workers_with_lease(redis, run):
+    run(queue(redis, 1, 2))
+    run(take(redis, "running"))
+    run(redis.set(storage.key(write_queue.LEASE, "running"), 1, expire=30))
+
+    assert run(write_queue.recover(redis)) == 0
+    assert numbers(redis) == [2]
+    assert numbers(redis, storage.key(write_queue.PROCESSING, "running")) == [1]
+
+
+def test_recover_legacy_processing_list(redis, run):
+    run(queue(redis, 1, 2))
+    run(redis.brpoplpush(write_queue.QUEUE, write_queue.LEGACY_PROCESSING))
+
+    assert run(write_queue.recover(redis)) == 1
+    assert numbers(redis) == [1, 2]
+
+
+def worker(redis, execute, fail=None, stopping=None, max_attempts=3):
+    async def failed(job, err):
+        pass
+
+    return write_queue.worker(
+        redis, execute, fail or failed, max_attempts, 0.01, 60, stopping
+    )
+
+
+def test_worker_writes_in_order_and_once(redis, run):
+    written = []
+    stopping = asyncio.Event()
+
+    async def execute(job):
+        written.append(job["n"])
+        if len(written) == 3:
+            stopping.set()
+
+    async def scenario():
+        ids = await queue(redis, 1, 2)
+        # Same write delivered again gets the same ID
+        await write_queue.put(redis, "followup", id=ids[0], n=1, ticket="1")
+        await queue(redis, 3)
+        await asyncio.wait_for(worker(redis, execute, stopping=stopping), 10)
+
+    run(scenario())
+    assert written == [1, 2, 3]
+    assert run(redis.smembers(write_queue.WORKERS)) == []
+
+
+def test_worker_gives_up_after_max_attempts(redis, run, tmp_path):
+    failed = []
+    stopping = asyncio.Event()
+    path = tmp_path / "document.pdf"
+    path.write_bytes(b"%PDF")
+
+    async def execute(job):
+        raise write_queue.RetryLater("GLPI is unavailable")
+
+    async def fail(job, err):
+        failed.append((job["n"], job["attempts"], str(err)))
+        stopping.set()
+
+    async def scenario():
+        await write_queue.put(redis, "document", n=1, ticket="1", path=str(path))
+        await asyncio.wait_for(worker(redis, execute, fail, stopping), 10)
+
+    run(scenario())
+    assert failed == [(1, 3, "GLPI is unavailable")]
+    assert len(redis.items(write_queue.FAILED)) == 1
+    assert not path.exists()
+    assert numbers(redis) == []
+
+
+def test_failing_ticket_does_not_hold_other_tickets(redis, run):
+    written = []
+    stopping = asyncio.Event()
+
+    async def execute(job):
+        # Ticket 1 is failing until writes to ticket 2 are done
+        if job["ticket"] == "1" and len(written) < 2:
+            raise write_queue.RetryLater("GLPI is unavailable")
+        written.append((job["ticket"], job["n"]))
+        if len(written) == 4:
+            stopping.set()
+
+    async def scenario():
+        await queue(redis, 1, 2, ticket="1")
+        await queue(redis, 3, 4, ticket="2")
+        await asyncio.wait_for(worker(redis, execute, None, stopping, 10), 10)
+
+    run(scenario())
+    assert written == [("2", 3), ("2", 4), ("1", 1), ("1", 2)]
+    assert run(redis.zrangebyscore(write_queue.DELAYED)) == []
+
+
+def test_stopped_worker_keeps_retry_state(redis, run):
+    stopping = asyncio.Event()
+
+    async def execute(job):
+        stopping.set()
+        raise write_queue.RetryLater("GLPI is unavailable")
+
+    async def scenario():
+        await queue(redis, 1, 2)
+        await asyncio.wait_for(worker(redis, execute, stopping=stopping), 10)
+
+    run(scenario())
+    held = storage.key(write_queue.HELD, ":1")
+    assert [json.loads(raw)["attempts"] for raw in run(redis.lrange(held))] == [1]
+    assert run(redis.zrangebyscore(write_queue.DELAYED)) == [":1"]
+    assert numbers(redis) == [2]
+    assert run(redis.smembers(write_queue.WORKERS)) == []